@@ -0,0 +1,171 @@
+"""Helpers shared by the scripts in this directory.
+
+This is imported by blooming_reads.py, dedup_circular_sam.py and
+re_pair_circular_sam.py, so needs to be kept in the same directory as
+them. It holds:
+
+ - byte_words, field_words and field_hashes, for comparing, sorting
+   and hashing fields of a block of SAM text with NumPy, without
+   splitting it into lines or fields in Python.
+ - partition_count and partition_lines, for splitting a SAM file too
+   large to sort in memory into temporary files by a hash of a key
+   (e.g. the read name), so that each can be processed in turn.
+ - ordered_results, for running jobs on a multiprocessing pool while
+   keeping their results in order and bounding how many are queued.
+
+NumPy is only needed for the SAM block helpers, so is optional here
+(np is None if it is missing), leaving each script to check for it.
+"""
+
+import os
+import math
+import itertools
+from collections import deque
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+#Masks keeping the first 0 to 8 bytes of a little endian 64 bit word
+_byte_masks = None if np is None else \
+    np.array([(1 << (8 * i)) - 1 for i in range(8)] + [(1 << 64) - 1], np.uint64)
+
+
+def byte_words(data):
+    """Array of the (unaligned) little endian 64 bit word starting at each byte of data.
+
+    Padded with nulls, so there is a word for every offset up to the
+    end of the data.
+    """
+    return np.ndarray((len(data) + 1,), "<u8", data + "\0" * 8, 0, (1,))
+
+
+def field_words(words, starts, ends):
+    """List of arrays of 64 bit words covering each field, most significant first.
+
+    Takes an array from byte_words, and the start and end offsets of
+    the fields. Each word is big endian with any bytes past the end of
+    the field zeroed, so the fields sort (and compare) as the strings
+    would.
+
+    >>> data = "ABC\\tABCDEFGHIJ\\n"
+    >>> for word in field_words(byte_words(data), np.array([0, 4]), np.array([3, 14])):
+    ...     print(["%016x" % w for w in word])
+    ['4142430000000000', '4142434445464748']
+    ['0000000000000000', '494a000000000000']
+    """
+    lengths = ends - starts
+    width = lengths.max() if len(lengths) else 0
+    keys = []
+    for i in range(0, width, 8):
+        word = words[np.minimum(starts + i, len(words) - 1)]
+        word &= _byte_masks[np.clip(lengths - i, 0, 8)]
+        keys.append(word.byteswap())
+    return keys
+
+
+def field_hashes(words, starts, ends):
+    """Array of 64 bit hashes of each field (see byte_words and field_words).
+
+    Equal fields get equal hashes, whatever their offsets:
+
+    >>> data = "read1\\tread2\\tread1\\n"
+    >>> hashes = field_hashes(byte_words(data), np.array([0, 6, 12]), np.array([5, 11, 17]))
+    >>> hashes[0] == hashes[2], hashes[0] == hashes[1]
+    (True, False)
+    """
+    hashes = (ends - starts).astype(np.uint64)
+    for word in field_words(words, starts, ends):
+        hashes *= np.uint64(0x9E3779B97F4A7C15)
+        hashes ^= word
+    #Mix the high bits down, as only the low bits may be used
+    hashes ^= hashes >> np.uint64(32)
+    hashes *= np.uint64(0x9E3779B97F4A7C15)
+    return hashes >> np.uint64(16)
+
+
+def partition_count(size, threads, memory, overhead=3.0):
+    """Number of partitions to split a SAM file into, given its size in bytes (or None).
+
+    Processing a partition in memory takes roughly overhead times its
+    size, and there will be one partition per process at a time, so
+    this aims to keep that all under the memory given in megabytes.
+    """
+    if size is None:
+        #Reading from a pipe, assume plenty
+        return max(256, threads)
+    return max(threads, int(math.ceil(overhead * threads * size / (memory * 1024 * 1024))))
+
+
+def partition_lines(input_handle, line, directory, count, memory, key_spans, block=1 << 22):
+    """Split SAM lines into temporary files by a hash of a key at the start of each line.
+
+    Starts with the given line, then reads the rest of the handle in
+    blocks. The key_spans function is given each block of whole lines,
+    and returns integer arrays of the start and end of each line, and
+    the end of its key (e.g. the read name), which are hashed with whole
+    array operations (see field_hashes). The lines for each partition are
+    buffered in memory, and appended to its file whenever half of the
+    memory given (in megabytes) is used. Only one file is open at a time,
+    so there can be more partitions than the limit on open files. Returns
+    a list of the count filenames (in the given directory), so every line
+    with the same key is in the same file.
+    """
+    filenames = [os.path.join(directory, "part%05i.sam" % i) for i in range(count)]
+    for filename in filenames:
+        open(filename, "wb").close()
+    buffers = [[] for filename in filenames]
+    limit = memory * 1024 * 1024 // 2
+    buffered = 0
+    data = line
+    while True:
+        more = input_handle.read(block)
+        data += more
+        if more:
+            cut = data.rfind("\n") + 1
+        else:
+            if data and not data.endswith("\n"):
+                data += "\n"
+            cut = len(data)
+        if cut:
+            chunk = data[:cut]
+            data = data[cut:]
+            starts, ends, key_ends = key_spans(chunk)
+            partitions = field_hashes(byte_words(chunk), starts, key_ends) % np.uint64(count)
+            order = np.argsort(partitions, kind="mergesort")
+            bounds = np.searchsorted(partitions[order], np.arange(count + 1)).tolist()
+            starts = starts[order].tolist()
+            ends = ends[order].tolist()
+            for i in np.flatnonzero(np.diff(bounds)).tolist():
+                buffers[i].append("".join([chunk[start:end] for start, end
+                                           in zip(starts[bounds[i]:bounds[i + 1]],
+                                                  ends[bounds[i]:bounds[i + 1]])]))
+            buffered += len(chunk)
+        if buffered > limit or not more:
+            for filename, buffer in zip(filenames, buffers):
+                if buffer:
+                    handle = open(filename, "ab")
+                    handle.write("".join(buffer))
+                    handle.close()
+                    del buffer[:]
+            buffered = 0
+        if not more:
+            break
+    return filenames
+
+
+def ordered_results(pool, function, jobs, queued):
+    """Apply a function to each job using a worker pool, yielding the results in order.
+
+    Only up to the given number of jobs are queued at once, to bound the
+    memory used.
+    """
+    pending = deque()
+    while True:
+        for job in itertools.islice(jobs, queued - len(pending)):
+            pending.append(pool.apply_async(function, (job,)))
+        if not pending:
+            break
+        yield pending.popleft().get()
@@ -23,11 +23,88 @@ but also we're only going to search for k-mers within each read,
 not perform a full alignment).
 
 We search reads against both the forward and reverse strand of the
-reference. Currently this is done when building the filter, which
-is problably faster at the cost of more memory (bigger filter). The
-alternative would be to make a filter from the reference forward
-strands only, and to check the reads and the reverse complement of
-each read against it. I expect that to be slower.
+reference. Each k-mer is held as a canonical 2-bit packed integer
+code (the smaller of the forward and reverse complement codes, with
+A=0, C=1, G=2, T=3 and the first base most significant), so a single
+entry covers both strands. Reads are packed into one integer per
+run of unambiguous bases, and the codes for each window are taken
+from that by shifting and masking, rather than slicing out a new
+string for every position. Possible matches from the Bloom filter
+are confirmed against a sorted array of all the reference k-mers,
+which at 8 bytes per k-mer (plus a small prefix bitmap) is several
+times smaller than a Python set of them. When checking reads one at
+a time (-b 0), the k-mers can instead be looked up as strings sliced
+out of each read (--kmer-strings), which is quicker from Python but
+takes over twice the memory.
+
+The Bloom filter is built in, using a NumPy array split into cache
+line sized blocks (all the bits for a k-mer are in one block, so each
+lookup touches just one block). Alternatively the dablooms library
+can be used (if installed), or the Bloom filter can be left out and
+k-mers looked up in the sorted array directly.
+
+Reads can be filtered one at a time, or (the default) in batches of
+several thousand records, where the reads are turned into a matrix of
+2-bit base codes, the k-mer codes for every window of every read are
+calculated with whole array operations, and these are looked up in a
+sorted array of the reference k-mers. This removes the per-read Python
+overhead which otherwise dominates on short reads.
+
+By default a single k-mer hit is enough to keep a read (or pair), but
+to ignore spurious hits (e.g. from repeats) a minimum number of hits,
+and/or a minimum fraction of the k-mers being hits, can be required.
+A histogram of the k-mer hits per record is shown at the end.
+
+With several threads, the input is split into chunks of whole records
+(as raw text) which are parsed and filtered by a pool of worker
+processes, sharing the k-mer filters with the main process (they are
+built before the workers are forked, and only read from after that).
+The main process writes out the kept records in the original order.
+
+The reference k-mers are found in the same way, encoding each sequence
+once and taking the codes for every window with whole array operations,
+only expanding (in Python) the few windows with ambiguous bases. Even
+so, building the filter from the references can take longer than
+filtering the reads (especially allowing for mismatches), so for
+parameter sweeps the k-mers can be saved to an index file (a small
+header, then the sorted array ready to be memory mapped), and loaded
+again later. The index records the k-mer settings and checksums of
+the references, and will not be used if the references have changed.
+An index can be updated with k-mers from extra references (only
+hashing the new ones), or combined with other indexes built with the
+same settings.
+
+For large reference panels the table can instead hold just the window
+minimizers of the references (--minimizers): of every run of W
+consecutive k-mers only the one with the smallest hash is stored, and
+the reads are sampled the same way, so any read sharing W+k-1 bases
+with a reference still has a k-mer hit, while the table and the number
+of lookups are several times smaller.
+
+Rather than a single kept/dropped split against all the references,
+the reads can be binned by reference file in one pass (--bins). Each
+k-mer in the table then carries a colour, an ID for the combination of
+reference files it occurs in, and each record is written to the output
+file of every reference it has k-mer hits to, with an optional report
+of the hit counts per reference.
+
+Progress is reported on stderr, ending with the time spent parsing the
+input, hashing the read k-mers, probing the table and writing the output
+(timed per batch rather than per read), the reads and bases per second,
+how many k-mers passed the Bloom filter but were not in the table, and
+the peak memory. The same figures can be saved as JSON lines (one per
+batch, then a summary) with --stats.
+
+Input read files can be gzip compressed (including BGZF), and output
+is compressed as BGZF if the filename ends .gz or .bgz, with the
+(de)compression done in background threads. Unaligned BAM files are read
+directly, decoding the packed sequences without building any SAM text,
+and the kept records are copied through as raw binary records after the
+original header.
+
+Paired reads can be given interlaced in one file (FASTA or FASTQ using
+the /1 and /2 suffix convention, or SAM), or split over two files (FASTA
+or FASTQ) which are read in step and filtered into two output files.
 
 TODO:
 
@@ -38,13 +115,25 @@ TODO:
   (where if either read matches, both are kept in the output)
 * Flexible FASTQ paired support to cope with paired or single
   (would negate need for another command line switch)
-* FASTA paired support
 
 """
 import sys
 import os
+import re
+import math
+import string
 import tempfile
 import time
+import itertools
+import multiprocessing
+import threading
+import Queue
+import zlib
+from multiprocessing.pool import ThreadPool
+import hashlib
+import json
+import struct
+from cStringIO import StringIO
 from optparse import OptionParser
 
 def sys_exit(msg, error_level=1):
@@ -60,10 +149,23 @@ except ImportError:
 try:
     import pydablooms
 except ImportError:
-    sys_exit("Missing 'dablooms' Python bindings, available from "
-             "https://github.com/bitly/dablooms")
+    #Only needed for the dablooms Bloom filter backend
+    pydablooms = None
+
+try:
+    import resource
+except ImportError:
+    #Only used to report peak memory, not available on Windows
+    resource = None
 
-VERSION = "0.0.4"
+try:
+    import numpy as np
+except ImportError:
+    sys_exit("Missing 'numpy' module, available from http://numpy.org")
+
+from block_tools import ordered_results
+
+VERSION = "0.0.21"
 
 def fasta_iterator(handle):
     """FASTA parser yielding (upper case sequence, raw record) string tuples."""
@@ -84,85 +186,339 @@ def fasta_iterator(handle):
         yield "".join(seq).upper(), "".join(raw)
     raise StopIteration
 
-def fastq_iterator(handle):
-    """FASTQ parser yielding (upper case sequence, raw record) string tuples.
+def _read_name(raw):
+    """Identifier of a raw FASTA or FASTQ record, without any /1 or /2 suffix."""
+    id = raw[1:raw.find("\n")].split(None, 1)[0]
+    if id.endswith("/1") or id.endswith("/2"):
+        return id[:-2]
+    return id
+
+def fasta_batched_iterator(handle):
+    """FASTA parser yielding (upper case sequence list, raw record(s) string) tuples.
 
-    Note: Any text on the '+' line is dropped, so it isn't the exact raw
-    record, it could be a slightly smaller file.
+    For use on interlaced paired FASTA reads following the /1 and /2 suffix convention.
     """
-    #TODO - Test this with nasty FASTQ files
-    #Profile against reusing Biopython's FastqGeneralIterator
+    records = fasta_iterator(handle)
+    for seq, raw in records:
+        title = raw[1:raw.find("\n")]
+        if not title.split(None, 1)[0].endswith("/1"):
+            raise ValueError("Expected FASTA record ending /1, got %r" % title)
+        try:
+            seq2, raw2 = next(records)
+        except StopIteration:
+            raise ValueError("Missing second half of %r" % title)
+        title2 = raw2[1:raw2.find("\n")]
+        if not title2.split(None, 1)[0].endswith("/2"):
+            raise ValueError("Expected FASTA record ending /2, got %r" % title2)
+        if _read_name(raw) != _read_name(raw2):
+            raise ValueError("Expected paired FASTA records, got %r and %r" % (title, title2))
+        yield [seq, seq2], raw + raw2
+
+def paired_files_iterator(handle1, handle2, format):
+    """Parser for pairs split over two files, yielding (upper case sequence list, raw record tuple) tuples.
+
+    The two FASTA or FASTQ files are read in step, checking the read names
+    match (ignoring any /1 and /2 suffixes), and each pair is returned as
+    a list of the two sequences and a tuple of the two raw records.
+    """
+    if format == "fasta":
+        iterator = fasta_iterator
+    elif format == "fastq":
+        iterator = fastq_iterator
+    else:
+        sys_exit("Reads split over two files must be FASTA or FASTQ, not %r" % format)
+    missing = (None, None)
+    for (seq, raw), (seq2, raw2) in itertools.izip_longest(iterator(handle1), iterator(handle2),
+                                                           fillvalue=missing):
+        if raw is None:
+            raise ValueError("More reads in the second file than the first, from %r" \
+                             % raw2[1:raw2.find("\n")])
+        if raw2 is None:
+            raise ValueError("More reads in the first file than the second, from %r" \
+                             % raw[1:raw.find("\n")])
+        if _read_name(raw) != _read_name(raw2):
+            raise ValueError("Expected paired reads in the two files, got %r and %r" \
+                             % (raw[1:raw.find("\n")], raw2[1:raw2.find("\n")]))
+        yield [seq, seq2], (raw, raw2)
+
+def _scan_fastq(data, pos, paired, limit):
+    """Find up to limit whole FASTQ records (or pairs) in a string from pos.
+
+    Returns a list of the upper case sequences for each record (as lists,
+    two entries for a pair), a list of (start, end) offsets of each raw
+    record (or pair) in the string, and the offset after the last one.
+    Stops early at an incomplete record.
+
+    The new lines are found with NumPy over a zero-copy view of the
+    string, and the FASTQ format checks done as array operations,
+    leaving just the slicing out of the sequences to Python.
+    """
+    lines = 8 if paired else 4
+    view = np.frombuffer(data, np.uint8)[pos:]
+    ends = np.flatnonzero(view == 10)
+    count = min(limit, len(ends) // lines)
+    if not count:
+        return [], [], pos
+    ends = ends[:count * lines]
+    starts = np.empty_like(ends)
+    starts[0] = 0
+    starts[1:] = ends[:-1] + 1
+    titles, seqs, pluses, quals = starts[0::4], starts[1::4], starts[2::4], starts[3::4]
+    seq_ends, qual_ends = ends[1::4], ends[3::4]
+    bad = np.flatnonzero(view[titles] != ord("@"))
+    if len(bad):
+        i = titles[bad[0]] + pos
+        raise ValueError("Expected FASTQ @ line, got %r" % data[i:data.find("\n", i)])
+    bad = np.flatnonzero(view[pluses] != ord("+"))
+    if len(bad):
+        i = pluses[bad[0]] + pos
+        raise ValueError("Expected FASTQ + line, got %r" % data[i:data.find("\n", i) + 1])
+    bad = np.flatnonzero(seq_ends - seqs != qual_ends - quals)
+    if len(bad):
+        i = titles[bad[0]] + pos
+        raise ValueError("Different FASTQ seq/qual lengths for %r" % data[i:data.find("\n", i)])
+    seqs = (seqs + pos).tolist()
+    seq_ends = (seq_ends + pos).tolist()
+    #Upper case them in one go, rather than a method call per read
+    reads = "\n".join([data[start:end] for start, end in zip(seqs, seq_ends)]).upper()
+    if "\r" in reads:
+        reads = reads.replace("\r", "")
+    reads = reads.split("\n")
+    if paired:
+        ids = [data[start:end].split(None, 1)[0] for start, end
+               in zip((titles + pos).tolist(), (ends[0::4] + pos).tolist())]
+        for id, id2 in zip(ids[0::2], ids[1::2]):
+            if not id.endswith("/1"):
+                raise ValueError("Expected FASTQ record ending /1, got %r" % id)
+            if not id2.endswith("/2"):
+                raise ValueError("Expected FASTQ record ending /2, got %r" % id2)
+            if id[:-2] != id2[:-2]:
+                raise ValueError("Expected paired FASTQ records, got %r and %r" % (id, id2))
+        reads = [list(pair) for pair in zip(reads[0::2], reads[1::2])]
+    else:
+        reads = [[read] for read in reads]
+    bounds = zip((titles[0::lines // 4] + pos).tolist(), (ends[lines - 1::lines] + pos + 1).tolist())
+    return reads, bounds, bounds[-1][1]
+
+def _scan_sam(data, pos, paired, limit):
+    """Find up to limit whole SAM records (or pairs) in a string from pos.
+
+    As _scan_fastq, with any header lines skipped. Checks reads are
+    unmapped, and if paired that the pairs are consecutive lines,
+    FLAG 77 (0x4d) then FLAG 141 (0x8d).
+    """
+    find = data.find
+    seqs = []
+    bounds = []
+    while len(bounds) < limit:
+        end = find("\n", pos)
+        if end == -1:
+            break
+        if data[pos] == "@":
+            pos = end + 1
+            continue
+        fields = data[pos:end].split("\t", 10)
+        flag = fields[1]
+        if flag == "0" or (not paired and flag in ("77", "141")):
+            #Unpaired unmapped read (or treating pairs as single reads)
+            seqs.append([fields[9].upper()])
+            bounds.append((pos, end + 1))
+            pos = end + 1
+        elif flag == "77" and paired:
+            end2 = find("\n", end + 1)
+            if end2 == -1:
+                break
+            fields2 = data[end + 1:end2].split("\t", 10)
+            if fields[0] != fields2[0]:
+                sys_exit("Missing second half of %s" % fields[0])
+            if fields2[1] != "141":
+                sys_exit("Expected FLAG 141 (0x8d) for second part of %s, got %r" % (fields[0], fields2[1]))
+            seqs.append([fields[9].upper(), fields2[9].upper()])
+            bounds.append((pos, end2 + 1))
+            pos = end2 + 1
+        elif flag == "141":
+            sys_exit("Missing first half of %s" % fields[0])
+        else:
+            sys_exit("Unexpected FLAG '%r' in SAM file, should be 0 (unmapped single read),\n"
+                     "77 (0x4d, first of unmapped pair) or 141 (0x8d, second of unmapped pair)." % flag)
+    return seqs, bounds, pos
+
+BAM_MAGIC = "BAM\1"
+#Letters for the 4-bit base codes in BAM
+BAM_BASES = "=ACMGRSVTWYHKDBN"
+#Fixed size fields at the start of each BAM record: block_size, refID,
+#pos, l_read_name, mapq, bin, n_cigar_op, flag and l_seq
+_bam_fields = struct.Struct("<iiiBBHHHi")
+_bam_pair_letters = None
+
+def read_bam_header(handle):
+    """Read the header from a BAM file (decompressed), returning it as a string.
+
+    This is the magic, the SAM header text and the reference list, as
+    raw binary ready to be written out again unchanged, leaving the
+    handle at the first record.
+    """
+    data = handle.read(8)
+    if len(data) < 8 or not data.startswith(BAM_MAGIC):
+        sys_exit("Expected a BAM file, got %r at start" % data[:4])
+    l_text, = struct.unpack("<i", data[4:])
+    data += handle.read(l_text)
+    n_ref = handle.read(4)
+    data += n_ref
+    for i in range(struct.unpack("<i", n_ref)[0]):
+        l_name = handle.read(4)
+        data += l_name + handle.read(struct.unpack("<i", l_name)[0] + 4)
+    return data
+
+def read_sam_header(handle):
+    """Read the header lines from a SAM file, returning them as a string and a handle.
+
+    As with read_bam_header, the header is ready to be written out again
+    unchanged. The first record line has to be read to find the end of
+    the header, so the handle returned gives that line then the rest of
+    the file (see PrefixedReader).
+    """
+    lines = []
+    line = handle.readline()
+    while line.startswith("@"):
+        lines.append(line)
+        line = handle.readline()
+    return "".join(lines), PrefixedReader(line, handle)
+
+def _scan_bam(data, pos, paired, limit):
+    """Find up to limit whole BAM records (or pairs) in a string from pos.
+
+    As _scan_sam, for the binary records of a decompressed BAM file (after
+    the header, see read_bam_header). Unmapped single reads can have FLAG
+    0 or 4 (0x4). The sequences (packed two bases to a byte) of all the
+    records found are decoded together with a single NumPy lookup, with
+    no SAM text built.
+    """
+    global _bam_pair_letters
+    if _bam_pair_letters is None:
+        #The two letters for each possible byte
+        codes = np.arange(256)
+        _bam_pair_letters = np.frombuffer(BAM_BASES, np.uint8)[
+            np.column_stack((codes >> 4, codes & 15))]
+    unpack = _bam_fields.unpack_from
+    size = len(data)
+    packed = []
+    lengths = []
+    counts = []
+    bounds = []
+    while len(bounds) < limit and pos + 36 <= size:
+        block_size, ref_id, ref_pos, l_name, mapq, bin, n_cigar, flag, l_seq = unpack(data, pos)
+        end = pos + 4 + block_size
+        if end > size:
+            break
+        start = pos + 36 + l_name + 4 * n_cigar
+        if flag in (0, 4) or (not paired and flag in (77, 141)):
+            #Unpaired unmapped read (or treating pairs as single reads)
+            packed.append(data[start:start + (l_seq + 1) // 2])
+            lengths.append(l_seq)
+            counts.append(1)
+            bounds.append((pos, end))
+            pos = end
+        elif flag == 77 and paired:
+            if end + 36 > size:
+                break
+            block_size2, ref_id, ref_pos, l_name2, mapq, bin, n_cigar2, flag2, l_seq2 = unpack(data, end)
+            end2 = end + 4 + block_size2
+            if end2 > size:
+                break
+            name = data[pos + 36:pos + 35 + l_name]
+            if name != data[end + 36:end + 35 + l_name2]:
+                sys_exit("Missing second half of %s" % name)
+            if flag2 != 141:
+                sys_exit("Expected FLAG 141 (0x8d) for second part of %s, got %i" % (name, flag2))
+            start2 = end + 36 + l_name2 + 4 * n_cigar2
+            packed.append(data[start:start + (l_seq + 1) // 2])
+            packed.append(data[start2:start2 + (l_seq2 + 1) // 2])
+            lengths.extend([l_seq, l_seq2])
+            counts.append(2)
+            bounds.append((pos, end2))
+            pos = end2
+        elif flag == 141:
+            sys_exit("Missing first half of %s" % data[pos + 36:pos + 35 + l_name])
+        else:
+            sys_exit("Unexpected FLAG %i in BAM file, should be 0 or 4 (unmapped single read),\n"
+                     "77 (0x4d, first of unmapped pair) or 141 (0x8d, second of unmapped pair)." % flag)
+    if not bounds:
+        return [], [], pos
+    letters = _bam_pair_letters[np.frombuffer("".join(packed), np.uint8)].tostring()
+    reads = []
+    offset = 0
+    for length in lengths:
+        reads.append(letters[offset:offset + length])
+        offset += length + (length & 1)
+    seqs = []
+    i = 0
+    for count in counts:
+        seqs.append(reads[i:i + count])
+        i += count
+    return seqs, bounds, pos
+
+_scanners = {"fastq": _scan_fastq, "sam": _scan_sam, "bam": _scan_bam}
+
+def record_blocks(handle, format, paired, size, chunk=1 << 22):
+    """Read FASTQ, SAM or BAM records in blocks, yielding (string, sequences, offsets).
+
+    Reads the file in multi-megabyte chunks, and finds the records in
+    them with str.find rather than reading line by line. Each block is
+    a string, a list of the upper case sequences of each record (as a
+    list, two for a pair), and a list of the (start, end) offsets of
+    each raw record (or pair) in the string, up to size records. Kept
+    records can then be written out as slices of the string, without
+    being pieced back together from their lines. For BAM the handle
+    should be at the first record (see read_bam_header).
+    """
+    scan = _scanners[format]
+    data = ""
+    pos = 0
+    at_end = False
     while True:
-        title = handle.readline()
-        if not title:
-            raise StopIteration
-        if not title[0] == "@":
-            raise ValueError("Expected FASTQ @ line, got %r" % title)
-        seq = handle.readline()
-        plus = handle.readline()
-        if not plus[0] == "+":
-            raise ValueError("Expected FASTQ + line, got %r" % plus)
-        qual = handle.readline()
-        if len(seq) != len(qual): #both include newline
-            raise ValueError("Different FASTQ seq/qual lengths for %r" % title)
-        yield seq.strip().upper(), title+seq+"+\n"+qual
+        seqs, bounds, pos = scan(data, pos, paired, size)
+        if bounds:
+            yield data, seqs, bounds
+            continue
+        new = handle.read(chunk)
+        if new:
+            data = data[pos:] + new
+            pos = 0
+        elif pos >= len(data):
+            break
+        elif at_end or format == "bam" or data.endswith("\n"):
+            raise ValueError("Incomplete %s record at end of file: %r" % (format, data[pos:pos + 100]))
+        else:
+            #Missing the final new line
+            data = data[pos:] + "\n"
+            pos = 0
+            at_end = True
+
+def fastq_iterator(handle):
+    """FASTQ parser yielding (upper case sequence, raw record) string tuples."""
+    #TODO - Test this with nasty FASTQ files
+    for data, seqs, bounds in record_blocks(handle, "fastq", False, 10000):
+        for (seq,), (start, end) in zip(seqs, bounds):
+            yield seq, data[start:end]
 
 def fastq_batched_iterator(handle):
     """FASTQ parser yielding (upper case sequence list, raw record(s) string) tuples.
 
     For use on interlaced paired FASTQ reads following the /1 and /2 suffix convention.
     """
-    while True:
-        #Read /1
-        title = handle.readline()
-        if not title:
-            raise StopIteration
-        if not title[0] == "@":
-            raise ValueError("Expected FASTQ @ line, got %r" % title)
-        id = title.split(None,1)[0]
-        if not id.endswith("/1"):
-            raise ValueError("Expected FASTQ record ending /1, got %r" % title)
-        seq = handle.readline()
-        plus = handle.readline()
-        if not plus[0] == "+":
-            raise ValueError("Expected FASTQ + line, got %r" % plus)
-        qual = handle.readline()
-        if len(seq) != len(qual): #both include newline
-            raise ValueError("Different FASTQ seq/qual lengths for %r" % title)
-        #Read /2
-        title2 = handle.readline()
-        if not title2[0] == "@":
-            raise ValueError("Expected FASTQ @ line, got %r" % title2)
-        id2 = title2.split(None,1)[0]
-        if not id2.endswith("/2"):
-            raise ValueError("Expected FASTQ record ending /2, got %r" % title2)
-        if id[:-2] != id2[:-2]:
-            raise ValueError("Expected paired FASTQ records, got %r and %r" % (title, title2))
-        seq2 = handle.readline()
-        plus = handle.readline()
-        if not plus[0] == "+":
-            raise ValueError("Expected FASTQ + line, got %r" % plus)
-        qual2 = handle.readline()
-        if len(seq) != len(qual): #both include newline
-            raise ValueError("Different FASTQ seq/qual lengths for %r" % title2)        
-        yield [seq.strip().upper(), seq2.strip().upper()], title+seq+"+\n"+qual+title2+seq2+"+\n"+qual2
-
+    for data, seqs, bounds in record_blocks(handle, "fastq", True, 10000):
+        for upper_seqs, (start, end) in zip(seqs, bounds):
+            yield upper_seqs, data[start:end]
 
 def sam_iterator(handle):
     """SAM parser yielding (upper case sequence, raw record) string tuples.
 
     Checks reads are unmapped. Any header is discarded.
     """
-    good_flags = set(["0", "77", "141"])
-    for line in handle:
-        if line[0]=="@":
-            continue
-        qname, flag, rname, pos, mapq, cigar, rnext, pnext, tlen, seq, rest = line.split("\t", 10)
-        if flag in good_flags:
-            yield seq.upper(), line
-        else:
-            sys_exit("Unexpected FLAG '%r' in SAM file, should be 0 (unmapped single read),\n"
-                     "77 (0x4d, first of unmapped pair) or 141 (0x8d, second of unmapped pair).")
+    for data, seqs, bounds in record_blocks(handle, "sam", False, 10000):
+        for (seq,), (start, end) in zip(seqs, bounds):
+            yield seq, data[start:end]
 
 def sam_batched_iterator(handle):
     """SAM parser yielding (upper case sequence list, raw record(s) string) tuples.
@@ -170,33 +526,282 @@ def sam_batched_iterator(handle):
     Checks reads are unmapped. Any header is discarded. Requires paired reads are
     consecutive in the file, FLAG 77 (0x4d) then FLAG 141 (0x8d).
     """
-    good_flags = set(["0", "77", "141"])
+    for data, seqs, bounds in record_blocks(handle, "sam", True, 10000):
+        for upper_seqs, (start, end) in zip(seqs, bounds):
+            yield upper_seqs, data[start:end]
 
-    line = handle.readline()
-    while line[0]=="@":
-        line = handle.readline()
+GZIP_MAGIC = "\x1f\x8b"
+BGZF_EOF = "\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC" + \
+           "\x02\x00\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00"
+#Uncompressed data per BGZF block, as used by samtools
+BGZF_BLOCK_SIZE = 65280
 
-    while line:
-        qname, flag, rname, pos, mapq, cigar, rnext, pnext, tlen, seq, rest = line.split("\t", 10)
-        if flag == "0":
-            #Unpaired unmapped read
-            yield [seq.upper()], line
-        elif flag == "77":
-            #Paired read one
-            line2 = handle.readline()
-            qname2, flag2, rname2, pos2, mapq2, cigar2, rnext2, pnext2, tlen2, seq2, rest2 = line2.split("\t", 10)
-            if qname != qname2:
-                sys_exit("Missing second half of %s" % qname)
-            if flag2 != "141":
-                sys_exit("Expected FLAG 141 (0x8d) for second part of %s, got %r" % (qname, flag2))
-            yield [seq.upper(), seq2.upper()], line+line2
-        elif flag == "141":
-            sys_exit("Missing first half of %s" % qname)
+class GzipReader(object):
+    """Read only file-like object for a gzip file, decompressed in a thread.
+
+    Handles multi-member gzip files including BGZF (as used in BAM).
+    The decompressed data is passed over via a bounded queue, so the
+    thread stays at most a few chunks ahead of the reader, and as zlib
+    releases the GIL the decompression overlaps with the filtering.
+    """
+
+    def __init__(self, filename, chunk=1 << 20, queued=8):
+        """Takes a filename, or an open binary handle (e.g. sys.stdin)."""
+        if isinstance(filename, basestring):
+            self.filename = filename
+            self._handle = open(filename, "rb")
         else:
-            sys_exit("Unexpected FLAG '%r' in SAM file, should be 0 (unmapped single read),\n"
-                     "77 (0x4d, first of unmapped pair) or 141 (0x8d, second of unmapped pair).")
-        line = handle.readline()
-    raise StopIteration
+            self.filename = getattr(filename, "name", "<handle>")
+            self._handle = filename
+        self._chunk = chunk
+        self._queue = Queue.Queue(queued)
+        self._buffer = ""
+        self._pos = 0
+        self._done = False
+        self._thread = threading.Thread(target=self._decompress)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _decompress(self):
+        try:
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            while True:
+                data = self._handle.read(self._chunk)
+                if not data:
+                    break
+                while data:
+                    self._queue.put(decompressor.decompress(data))
+                    #Any data after the end of a gzip member is the
+                    #start of the next member (e.g. the next BGZF block)
+                    data = decompressor.unused_data
+                    if data:
+                        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            self._queue.put(decompressor.flush())
+            self._queue.put(None)
+        except Exception as err:
+            self._queue.put(err)
+
+    def _next(self):
+        """The next piece of decompressed data, or None at the end."""
+        while not self._done:
+            data = self._queue.get()
+            if data is None:
+                self._done = True
+            elif isinstance(data, Exception):
+                self._done = True
+                raise ValueError("Problem decompressing %s: %s" % (self.filename, data))
+            elif data:
+                return data
+        return None
+
+    def _fill(self):
+        """Add the next decompressed data to the buffer, False at the end."""
+        data = self._next()
+        if data is None:
+            return False
+        self._buffer = self._buffer[self._pos:] + data
+        self._pos = 0
+        return True
+
+    def readline(self):
+        while True:
+            end = self._buffer.find("\n", self._pos)
+            if end != -1:
+                line = self._buffer[self._pos:end + 1]
+                self._pos = end + 1
+                return line
+            if not self._fill():
+                line = self._buffer[self._pos:]
+                self._pos = len(self._buffer)
+                return line
+
+    def read(self, size=-1):
+        #Collect the pieces (each BGZF block is only 64kb) and join them
+        #once, rather than growing the buffer a piece at a time
+        pieces = [self._buffer[self._pos:]]
+        available = len(pieces[0])
+        while size < 0 or available < size:
+            data = self._next()
+            if data is None:
+                break
+            pieces.append(data)
+            available += len(data)
+        data = "".join(pieces)
+        if 0 <= size < len(data):
+            self._buffer = data
+            self._pos = size
+            return data[:size]
+        self._buffer = ""
+        self._pos = 0
+        return data
+
+    def __iter__(self):
+        return iter(self.readline, "")
+
+    def close(self):
+        self._handle.close()
+
+class PrefixedReader(object):
+    """Read only file-like object giving some data already read, then the rest of a handle.
+
+    Used to put back data read to check what a file holds (e.g. the gzip
+    magic on stdin, which can't seek back), or read past the SAM header.
+    """
+
+    def __init__(self, data, handle):
+        self._data = data
+        self._handle = handle
+        self.name = getattr(handle, "name", "<handle>")
+
+    def read(self, size=-1):
+        data = self._data
+        if not data:
+            return self._handle.read(size)
+        if size < 0:
+            self._data = ""
+            return data + self._handle.read()
+        if size <= len(data):
+            self._data = data[size:]
+            return data[:size]
+        self._data = ""
+        return data + self._handle.read(size - len(data))
+
+    def readline(self):
+        data = self._data
+        if "\n" in data:
+            end = data.index("\n") + 1
+            self._data = data[end:]
+            return data[:end]
+        self._data = ""
+        return data + self._handle.readline()
+
+    def __iter__(self):
+        return iter(self.readline, "")
+
+    def close(self):
+        self._handle.close()
+
+def _bgzf_block(data, level=6):
+    """Compress a string (up to BGZF_BLOCK_SIZE) into one BGZF block.
+
+    Uses a zlib compression object as that releases the GIL, so blocks
+    can be compressed in parallel by a pool of threads.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    compressed = compressor.compress(data) + compressor.flush()
+    if len(compressed) > 65536 - 26:
+        #Incompressible data can grow, split it over two blocks
+        half = len(data) // 2
+        return _bgzf_block(data[:half], level) + _bgzf_block(data[half:], level)
+    return struct.pack("<4BI2BH2BHH", 31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2,
+                       len(compressed) + 25) + compressed + \
+        struct.pack("<II", zlib.crc32(data) & 0xffffffff, len(data))
+
+class BgzfWriter(object):
+    """Write only file-like object for a BGZF file, compressed in the background.
+
+    BGZF is a series of gzip members each holding up to 64kb, so it is
+    valid gzip, and can also be indexed for random access. The blocks
+    are written out in order by a background thread, with the queue of
+    blocks waiting bounded to limit memory use. With several threads,
+    blocks are compressed in parallel by a thread pool, otherwise the
+    writing thread compresses them itself.
+    """
+
+    def __init__(self, filename, threads=1, level=6):
+        """Takes a filename, or an open binary handle (e.g. sys.stdout)."""
+        if isinstance(filename, basestring):
+            self.filename = filename
+            self._handle = open(filename, "wb")
+        else:
+            self.filename = getattr(filename, "name", "<handle>")
+            self._handle = filename
+        self._level = level
+        self._buffer = []
+        self._size = 0
+        if threads > 1:
+            self._pool = ThreadPool(threads)
+        else:
+            self._pool = None
+        self._queue = Queue.Queue(2 * threads + 2)
+        self._error = None
+        self._thread = threading.Thread(target=self._write_blocks)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _write_blocks(self):
+        try:
+            while True:
+                block = self._queue.get()
+                if block is None:
+                    break
+                if self._pool is None:
+                    self._handle.write(_bgzf_block(block, self._level))
+                else:
+                    self._handle.write(block.get())
+        except Exception as err:
+            self._error = err
+            #Keep taking blocks so the main thread isn't blocked
+            while self._queue.get() is not None:
+                pass
+
+    def _queue_blocks(self, final=False):
+        data = "".join(self._buffer)
+        start = 0
+        while len(data) - start >= BGZF_BLOCK_SIZE or (final and start < len(data)):
+            block = data[start:start + BGZF_BLOCK_SIZE]
+            start += len(block)
+            if self._pool is not None:
+                block = self._pool.apply_async(_bgzf_block, (block, self._level))
+            self._queue.put(block)
+        self._buffer = [data[start:]]
+        self._size = len(data) - start
+        if self._error is not None:
+            raise IOError("Problem writing %s: %s" % (self.filename, self._error))
+
+    def write(self, data):
+        self._buffer.append(data)
+        self._size += len(data)
+        if self._size >= BGZF_BLOCK_SIZE:
+            self._queue_blocks()
+
+    def close(self):
+        self._queue_blocks(final=True)
+        self._queue.put(None)
+        self._thread.join()
+        if self._pool is not None:
+            self._pool.close()
+        if self._error is not None:
+            raise IOError("Problem writing %s: %s" % (self.filename, self._error))
+        self._handle.write(BGZF_EOF)
+        self._handle.close()
+
+def open_input(filename):
+    """Open a read file (or stdin if None), which may be gzip compressed (including BGZF)."""
+    if filename is None:
+        #Can't seek back on stdin, so put the magic back
+        magic = sys.stdin.read(2)
+        if magic == GZIP_MAGIC:
+            return GzipReader(PrefixedReader(magic, sys.stdin))
+        return PrefixedReader(magic, sys.stdin)
+    handle = open(filename, "rb")
+    magic = handle.read(2)
+    handle.close()
+    if magic == GZIP_MAGIC:
+        return GzipReader(filename)
+    return open(filename)
+
+def open_output(filename, threads=1, bgzf=False):
+    """Open an output file, compressed as BGZF if named *.gz or *.bgz.
+
+    Use bgzf to always compress as BGZF (e.g. for BAM), in which case
+    the filename can be None for stdout.
+    """
+    if bgzf:
+        return BgzfWriter(filename or sys.stdout, threads)
+    if filename.endswith(".gz") or filename.endswith(".bgz"):
+        return BgzfWriter(filename, threads)
+    return open(filename, "w")
 
 def make_variants(seq, changes):
     #TODO - pass len(seq) == kmer as argument for speed?
@@ -208,16 +813,1060 @@ def make_variants(seq, changes):
             yield seq[:i] + letter + seq[i+1:]
 
 def make_inserts(seq):
-    """Given a k-mer, returns possible k-mers with single inserts."""
-    for i in range(1,len(seq)):
+    """Given a (k-1)-mer, returns possible k-mers with single inserts."""
+    for i in range(len(seq) + 1):
         for letter in "ACGT":
-            yield seq[:i] + letter + seq[i+1:-1]
+            yield seq[:i] + letter + seq[i:]
 
 def make_deletions(seq):
     """Given a (k+1)-mer, returns possible k-mers with single deletions."""
     for i in range(len(seq)):
         yield seq[:i] + seq[i+1:]
 
+def make_seeds(kmer, count):
+    """Spaced seed masks, for tolerating mismatches when checking reads.
+
+    Each mask is for a 2-bit k-mer code, and ignores (zeros) one of
+    count groups of positions, where position i from either end of the
+    k-mer is in group i % count. A k-mer with a single mismatch to a
+    reference k-mer will therefore match it exactly under the mask
+    ignoring that group, but more mismatches only match if they all fall
+    in the same group. As each mask is symmetric, masking the forward
+    and reverse complement codes of a k-mer ignores the same bases, so
+    the canonical (smaller) masked code can still be used.
+
+    >>> [decode_kmer(seed, 7) for seed in make_seeds(7, 2)]
+    ['ATATATA', 'TATATAT']
+    >>> seeds = make_seeds(7, 3)
+    >>> [encode_kmer("AAAAAAA", seed) == encode_kmer("CAAAAAA", seed) for seed in seeds]
+    [True, False, False]
+    >>> [encode_kmer("AAAAAAA", seed) == encode_kmer("CCAAAAA", seed) for seed in seeds]
+    [False, False, False]
+    """
+    seeds = []
+    for group in range(count):
+        seed = 0
+        for i in range(kmer):
+            seed <<= 2
+            if min(i, kmer - 1 - i) % count != group:
+                seed |= 3
+        seeds.append(seed)
+    return seeds
+
+#2-bit packing, A=0, C=1, G=2, T=3 with the first base most significant.
+#The reverse complement is packed from the reversed sequence using the
+#complementary digits, so base four int() parsing does the work in C.
+_fwd_digits = string.maketrans("ACGT", "0123")
+_rev_digits = string.maketrans("ACGT", "3210")
+_acgt_runs = re.compile("[ACGT]+")
+
+def encode_kmer(fragment, seed=None):
+    """Canonical 2-bit code for an unambiguous upper case k-mer string.
+
+    This is the smaller of the forward and reverse complement codes:
+
+    >>> encode_kmer("ACGT") == int("0123", 4) # its own reverse complement
+    True
+    >>> encode_kmer("AAAC") == encode_kmer("GTTT")
+    True
+    >>> encode_kmer("AAAC")
+    1
+
+    Optionally give a spaced seed mask (see make_seeds) to apply to
+    both codes first.
+    """
+    fwd = int(fragment.translate(_fwd_digits), 4)
+    rev = int(fragment[::-1].translate(_rev_digits), 4)
+    if seed is not None:
+        fwd &= seed
+        rev &= seed
+    if fwd < rev:
+        return fwd
+    return rev
+
+def decode_kmer(code, kmer):
+    """Turn a 2-bit k-mer code back into an upper case string.
+
+    >>> decode_kmer(1, 4)
+    'AAAC'
+    """
+    return "".join("ACGT"[(code >> (2 * i)) & 3] for i in range(kmer - 1, -1, -1))
+
+def kmer_codes(upper_seq, kmer, seed=None, chunk=1024):
+    """List of canonical 2-bit codes for the k-mer windows in a sequence.
+
+    Any window containing a character other than A, C, G or T is skipped
+    (the window restarts after the ambiguous base). Each run of good bases
+    is packed into a single integer (forward and reverse complement), and
+    the code for each window is then just a shift and a mask of those,
+    so there is no per-window string slicing.
+
+    >>> [decode_kmer(c, 3) for c in kmer_codes("ACGTNGGG", 3)]
+    ['ACG', 'ACG', 'CCC']
+
+    Long sequences are packed in chunks of (about) the given number of
+    windows, so the shifts stay cheap. This returns a list rather than
+    being a generator as building it with list comprehensions is much
+    faster, and the caller can then use set methods like isdisjoint.
+
+    Optionally give a spaced seed mask (see make_seeds) to apply to the
+    forward and reverse complement codes before taking the smaller.
+    """
+    if upper_seq.translate(None, "ACGT"):
+        runs = [m.group() for m in _acgt_runs.finditer(upper_seq)]
+    else:
+        runs = [upper_seq]
+    mask = (1 << (2 * kmer)) - 1
+    if seed is not None:
+        mask &= seed
+    answer = []
+    for run in runs:
+        for start in range(0, len(run) - kmer + 1, chunk):
+            piece = run[start:start + chunk + kmer - 1]
+            fwd = int(piece.translate(_fwd_digits), 4)
+            rev = int(piece[::-1].translate(_rev_digits), 4)
+            #Window i in fwd is (fwd >> 2*(len - k - i)) & mask,
+            #and its reverse complement is (rev >> 2*i) & mask
+            shifts = range(0, 2 * (len(piece) - kmer) + 2, 2)
+            answer.extend(map(min, [(fwd >> s) & mask for s in reversed(shifts)],
+                                   [(rev >> s) & mask for s in shifts]))
+    return answer
+
+def kmer_key(code):
+    """String used as the Bloom filter key for a k-mer code."""
+    return "%x" % code
+
+def kmer_word_count(kmer):
+    """Number of 64 bit words needed for a 2-bit encoded k-mer."""
+    return (kmer + 31) // 32
+
+def kmer_key_dtype(kmer):
+    """NumPy dtype used for k-mer keys in the batch mode.
+
+    Up to 32-mers this is just the canonical code as an unsigned 64 bit
+    integer. Longer k-mers are split into 64 bit words (the first 32
+    bases, the next 32 bases, and so on), stored big-endian as a fixed
+    width byte string, which sorts the same way as the integer codes.
+    """
+    if kmer <= 32:
+        return np.uint64
+    return "S%i" % (8 * kmer_word_count(kmer))
+
+def _word_spans(kmer):
+    """List of (offset, length) for each 64 bit word of a k-mer."""
+    return [(offset, min(32, kmer - offset)) for offset in range(0, kmer, 32)]
+
+class KmerTable(object):
+    """Sorted NumPy array of canonical k-mer keys, for exact lookups.
+
+    Binary searches with numpy.searchsorted are slow compared to the rest
+    of the batch mode, and most queries will be misses, so the table also
+    has a bitmap of which prefixes (the top bits of each key) are in use,
+    with sixteen to thirty-two times as many bits as there are k-mers.
+    Only queries whose prefix is present get a binary search.
+
+    For k-mers longer than 32 the keys are byte strings (see kmer_key_dtype),
+    in which case the first word of each key is also held as an integer
+    (and the prefix taken from that).
+
+    If the table holds reference k-mers masked with spaced seeds (see
+    make_seeds), these are listed in the seeds attribute, and reads need
+    checking with each of them. Otherwise this is just [None].
+
+    For binning reads, the table can also hold a colour for each k-mer
+    (see colour_keys), an index into the colour_sets list of which of
+    the named reference sets the k-mer came from. Otherwise the colours
+    attribute is None.
+
+    If the table holds only the window minimizers of the references (see
+    window_minimizers), the minimizers attribute is the window size, and
+    reads need sampling the same way. Otherwise this is None.
+
+    For checking reads one at a time, the table can also hold its k-mers
+    as strings in both orientations (see build_strings), as slicing
+    windows out of a read and looking them up in a dict is quicker from
+    Python than packing them into codes. Otherwise the strings attribute
+    is None.
+    """
+
+    def __init__(self, keys, kmer, first=None, bitmap=None, seeds=None,
+                 colours=None, colour_sets=None, names=None, minimizers=None):
+        """Takes a sorted array of unique keys, and the k-mer size.
+
+        The first word array and prefix bitmap are calculated from the
+        keys unless given (e.g. when loading a saved index).
+        """
+        self.keys = keys
+        self.kmer = kmer
+        self.seeds = list(seeds) if seeds else [None]
+        self.minimizers = minimizers or None
+        self.colours = colours
+        self.strings = None
+        self.colour_sets = [tuple(c) for c in colour_sets or []]
+        self.names = list(names or [])
+        #Reference sets of each colour, flattened, for colour_members
+        self._colour_sizes = np.array([len(c) for c in self.colour_sets], np.int64)
+        self._colour_starts = np.cumsum(self._colour_sizes) - self._colour_sizes
+        self._colour_flat = np.array([i for c in self.colour_sets for i in c], np.int64)
+        self.words = kmer_word_count(kmer)
+        if self.words == 1:
+            self.first = keys
+        elif first is not None:
+            self.first = first
+        else:
+            self.first = keys.view(">u8")[::self.words].astype(np.uint64)
+        bits = 2 * min(kmer, 32)
+        prefix_bits = min(bits, len(keys).bit_length() + 4)
+        self.shift = np.uint64(bits - prefix_bits)
+        #Shift taking an integer code to its prefix
+        self._code_shift = bits - prefix_bits + 2 * max(0, kmer - 32)
+        #For packing an integer code into a key, (shift, mask) per word
+        self._packing = [(2 * (kmer - offset - length), (1 << (2 * length)) - 1)
+                         for offset, length in _word_spans(kmer)]
+        #Hold the bitmap in a bytearray (shared with the NumPy array),
+        #as indexing that from Python is far quicker than indexing
+        #the array, which matters when checking single k-mers
+        if bitmap is None:
+            self._bitmap_bytes = bytearray(((1 << prefix_bits) + 7) // 8)
+            bitmap = np.frombuffer(self._bitmap_bytes, np.uint8)
+            if len(keys):
+                #Sorted keys means sorted prefixes, so can combine the bits
+                #for each byte of the bitmap with reduceat
+                prefix = self.first >> self.shift
+                index = prefix >> np.uint64(3)
+                starts = np.flatnonzero(np.concatenate(([True], index[1:] != index[:-1])))
+                values = np.left_shift(1, prefix & np.uint64(7)).astype(np.uint8)
+                bitmap[index[starts]] = np.bitwise_or.reduceat(values, starts)
+        else:
+            self._bitmap_bytes = bytearray(bitmap)
+            bitmap = np.frombuffer(self._bitmap_bytes, np.uint8)
+        self.bitmap = bitmap
+
+    @classmethod
+    def from_codes(cls, codes, kmer, seeds=None):
+        """Build the table from an iterable of integer k-mer codes."""
+        return cls(np.unique(code_keys(codes, kmer)), kmer, seeds=seeds)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, code):
+        """Is this integer k-mer code present? For checking single k-mers."""
+        prefix = code >> self._code_shift
+        if not (self._bitmap_bytes[prefix >> 3] >> (prefix & 7)) & 1:
+            return False
+        if self.words == 1:
+            key = np.uint64(code)
+        else:
+            key = "".join(struct.pack(">Q", (code >> shift) & mask)
+                          for shift, mask in self._packing)
+        index = self.keys.searchsorted(key)
+        return index < len(self.keys) and self.keys[index] == key
+
+    def build_strings(self, chunk=1 << 16):
+        """Fill in the strings attribute, a dict keyed on the k-mers as strings.
+
+        Each canonical key is decoded into its forward and its reverse
+        complement string, so this takes several times the memory of the
+        table itself. Only meaningful for a table without spaced seeds or
+        minimizers, where every key is a whole k-mer.
+        """
+        kmer = self.kmer
+        fwd_letters = np.frombuffer("ACGT", np.uint8)
+        rev_letters = np.frombuffer("TGCA", np.uint8)
+        #A dict rather than a set, as the garbage collector stops tracking
+        #a dict holding only strings, but would walk every entry of a set
+        #on each full collection while the reads are parsed
+        strings = {}
+        for start in range(0, len(self.keys), chunk):
+            keys = self.keys[start:start + chunk]
+            if self.words == 1:
+                words = keys.reshape(len(keys), 1)
+            else:
+                words = keys.view(">u8").reshape(len(keys), self.words)
+            bases = np.empty((len(keys), kmer), np.uint8)
+            for w, (offset, length) in enumerate(_word_spans(kmer)):
+                for i in range(length):
+                    bases[:, offset + i] = (words[:, w] >> np.uint64(2 * (length - 1 - i))) & np.uint64(3)
+            for letters in (fwd_letters[bases], rev_letters[bases[:, ::-1]]):
+                strings.update(dict.fromkeys(letters.view("S%i" % kmer).ravel().tolist()))
+        self.strings = strings
+
+    def candidates(self, codes):
+        """List of those integer k-mer codes whose prefix is present.
+
+        A quick way to discard most k-mers from a read, leaving just
+        a few for a full check with the in operator.
+        """
+        shift = self._code_shift
+        byte_shift = shift + 3
+        bitmap = self._bitmap_bytes
+        return [code for code in codes
+                if (bitmap[code >> byte_shift] >> ((code >> shift) & 7)) & 1]
+
+    @property
+    def nbytes(self):
+        """Memory used by the arrays (in bytes)."""
+        answer = self.keys.nbytes + self.bitmap.nbytes
+        if self.words > 1:
+            answer += self.first.nbytes
+        if self.colours is not None:
+            answer += self.colours.nbytes
+        return answer
+
+    def colour_members(self, colours):
+        """Expand an array of colours into their reference sets.
+
+        Returns two arrays, giving for each member of each colour its
+        position in the input array, and its reference set index.
+        """
+        sizes = self._colour_sizes[colours]
+        position = np.repeat(np.arange(len(colours)), sizes)
+        #Offset of each member within its colour's set
+        within = np.arange(len(position)) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+        return position, self._colour_flat[self._colour_starts[colours][position] + within]
+
+    def iter_codes(self, chunk=100000):
+        """Iterate over the k-mers as integer codes (in sorted order)."""
+        for start in range(0, len(self.keys), chunk):
+            for code in key_codes(self.keys[start:start + chunk], self.kmer):
+                yield code
+
+    def _candidates(self, keys, prefilter=None, stats=None):
+        """Flattened keys, and the indexes of those which pass the prefilters.
+
+        If given a stats dictionary (see new_stats), the number of keys
+        passing the prefix bitmap and the Bloom filter are added to it.
+        """
+        keys = np.ascontiguousarray(keys).ravel()
+        if self.words == 1:
+            first = keys
+        else:
+            first = keys.view(">u8")[::self.words].astype(np.uint64)
+        prefix = first >> self.shift
+        candidates = np.flatnonzero((self.bitmap[prefix >> np.uint64(3)]
+                                     >> (prefix & np.uint64(7))) & 1)
+        if stats is not None:
+            stats["bitmap_passed"] += len(candidates)
+        if prefilter is not None:
+            candidates = candidates[prefilter.contains(keys[candidates])]
+            if stats is not None:
+                stats["bloom_passed"] += len(candidates)
+        if self.words > 1:
+            #Byte string comparisons are slow, so check the first word
+            candidates = candidates[_in_sorted(self.first, first[candidates])]
+        return keys, candidates
+
+    def contains(self, keys, prefilter=None, stats=None):
+        """Boolean array, are the keys (any shape array) present?
+
+        Optionally give a Bloom filter (anything with a contains method
+        taking an array of keys) to check those keys which pass the
+        prefix bitmap before doing the binary search, and a stats
+        dictionary to count the keys passing each step (see new_stats).
+        """
+        answer = np.zeros(np.shape(keys), bool)
+        if not len(self.keys):
+            return answer
+        keys, candidates = self._candidates(keys, prefilter, stats)
+        found = _in_sorted(self.keys, keys[candidates])
+        answer.ravel()[candidates] = found
+        if stats is not None:
+            stats["table_hits"] += int(found.sum())
+        return answer
+
+    def find(self, keys, prefilter=None, stats=None):
+        """Integer array, index of each key (any shape array) in the table or -1.
+
+        Optionally give a Bloom filter and stats, as for the contains method.
+        """
+        answer = np.empty(np.shape(keys), np.int64)
+        answer.fill(-1)
+        if not len(self.keys):
+            return answer
+        keys, candidates = self._candidates(keys, prefilter, stats)
+        index = np.searchsorted(self.keys, keys[candidates])
+        index[index == len(self.keys)] = 0
+        found = self.keys[index] == keys[candidates]
+        answer.ravel()[candidates[found]] = index[found]
+        if stats is not None:
+            stats["table_hits"] += int(found.sum())
+        return answer
+
+def _in_sorted(table, values):
+    """Boolean array, are the values present in the sorted array?"""
+    index = np.searchsorted(table, values)
+    index[index == len(table)] = 0
+    return table[index] == values
+
+def colour_keys(keys, sets, set_count):
+    """Sorted unique keys with their colours, from (key, reference set) pairs.
+
+    Takes an array of keys and a matching array of reference set indexes
+    (either may have repeats). Each combination of reference sets found
+    sharing a k-mer is a colour, with the first colours being the single
+    sets in order. Returns the unique keys, an array of their colours
+    (uint16, or uint32 if there are too many), and the list of colours
+    as tuples of reference set indexes.
+    """
+    order = np.lexsort((sets, keys))
+    keys = keys[order]
+    sets = sets[order]
+    distinct = np.ones(len(keys), bool)
+    distinct[1:] = (keys[1:] != keys[:-1]) | (sets[1:] != sets[:-1])
+    keys = keys[distinct]
+    sets = sets[distinct]
+    starts = np.flatnonzero(np.concatenate(([True], keys[1:] != keys[:-1])))
+    sizes = np.diff(np.append(starts, len(keys)))
+    colours = sets[starts].astype(np.int64)
+    colour_sets = [(i,) for i in range(set_count)]
+    shared = np.flatnonzero(sizes > 1)
+    if not len(shared):
+        pass
+    elif set_count <= 64:
+        #Can use a bit mask for each combination of sets
+        masks = np.bitwise_or.reduceat(np.left_shift(np.uint64(1), sets.astype(np.uint64)),
+                                       starts)[shared]
+        masks, inverse = np.unique(masks, return_inverse=True)
+        for mask in masks.tolist():
+            colour_sets.append(tuple(i for i in range(set_count) if (mask >> i) & 1))
+        colours[shared] = set_count + inverse
+    else:
+        lookup = dict()
+        for g, start, size in zip(shared.tolist(), starts[shared].tolist(), sizes[shared].tolist()):
+            colours[g] = set_count + lookup.setdefault(tuple(sets[start:start + size].tolist()),
+                                                       len(lookup))
+        colour_sets.extend(sorted(lookup, key=lookup.get))
+    if len(colour_sets) <= 1 << 16:
+        colours = colours.astype(np.uint16)
+    else:
+        colours = colours.astype(np.uint32)
+    return keys[starts], colours, colour_sets
+
+def reference_set_names(filenames, existing=None):
+    """Short unique names for reference files, for binning reads.
+
+    >>> reference_set_names(["refs/mito.fasta", "chloro.fa", "other/mito.fa"])
+    ['mito', 'chloro', 'mito_3']
+
+    Optionally give a list of existing names, which the new names should
+    follow on from (only the new names are returned).
+    """
+    names = list(existing or [])
+    for i, filename in enumerate(filenames, len(names)):
+        name = os.path.basename(filename)
+        for suffix in [".gz", ".fasta", ".fas", ".fna", ".fa"]:
+            if name.endswith(suffix):
+                name = name[:-len(suffix)]
+        if name in names:
+            name = "%s_%i" % (name, i + 1)
+        names.append(name)
+    return names[len(existing or []):]
+
+def code_keys(codes, kmer):
+    """1D array of keys (see kmer_key_dtype) from integer k-mer codes."""
+    if kmer <= 32:
+        return np.fromiter(codes, np.uint64)
+    codes = list(codes)
+    words = np.empty((len(codes), kmer_word_count(kmer)), ">u8")
+    for w, (offset, length) in enumerate(_word_spans(kmer)):
+        shift = 2 * (kmer - offset - length)
+        mask = (1 << (2 * length)) - 1
+        words[:, w] = [(code >> shift) & mask for code in codes]
+    return words.view(kmer_key_dtype(kmer)).ravel()
+
+def key_codes(keys, kmer):
+    """List of integer k-mer codes from a 1D array of keys."""
+    if kmer <= 32:
+        return keys.tolist()
+    words = keys.view(">u8").reshape(len(keys), kmer_word_count(kmer))
+    codes = [0] * len(keys)
+    for w, (offset, length) in enumerate(_word_spans(kmer)):
+        codes = [(code << (2 * length)) | word for code, word
+                 in zip(codes, words[:, w].tolist())]
+    return codes
+
+_MASK64 = (1 << 64) - 1
+_HASH_SEED = 0x9e3779b97f4a7c15
+
+def _mix(x):
+    """Scramble the bits of a 64 bit integer (the splitmix64 finaliser)."""
+    x ^= x >> 30
+    x = (x * 0xbf58476d1ce4e5b9) & _MASK64
+    x ^= x >> 27
+    x = (x * 0x94d049bb133111eb) & _MASK64
+    return x ^ (x >> 31)
+
+def _mix_array(x):
+    """As _mix, for a NumPy uint64 array (altered in place and returned)."""
+    x ^= x >> np.uint64(30)
+    x *= np.uint64(0xbf58476d1ce4e5b9)
+    x ^= x >> np.uint64(27)
+    x *= np.uint64(0x94d049bb133111eb)
+    x ^= x >> np.uint64(31)
+    return x
+
+class BloomFilter(object):
+    """Blocked Bloom filter of k-mer keys, in a NumPy array of 64 bit words.
+
+    Each k-mer is hashed to a single block of eight 64 bit words (512
+    bits, one cache line), and all its bits are set within that block,
+    spread evenly over its words (as in a split block Bloom filter). A
+    query is then one memory access and a mask comparison per word,
+    rather than one access per hash function, which also suits NumPy as
+    it needs just one gather (of whole blocks) over the array of keys.
+    Confining the bits to one block raises the false positive rate
+    compared to a standard Bloom filter of the same size, so the size
+    and number of hashes are chosen using the expected rate of the
+    blocked filter (see blocked_error_rate). Unlike dablooms there is
+    no counting or scaling, as we only ever add k-mers, and the capacity
+    is known.
+
+    Keys are added and checked in batches as NumPy arrays (the same keys
+    as used in a KmerTable), or single integer codes can be checked
+    with the in operator.
+    """
+
+    block_words = 8
+    max_hashes = 16
+
+    def __init__(self, capacity, error_rate, kmer):
+        self.kmer = kmer
+        self.capacity = capacity
+        self.error_rate = error_rate
+        #Start from the size of a standard Bloom filter, and grow it
+        #until the blocked filter reaches the requested rate
+        bits_per_key = -math.log(error_rate) / math.log(2) ** 2
+        while True:
+            blocks = max(1, int(math.ceil(bits_per_key * max(1, capacity) / 512)))
+            rate, hashes = min((self.blocked_error_rate(float(capacity) / blocks, h), h)
+                               for h in range(1, self.max_hashes + 1))
+            if rate <= error_rate or bits_per_key > 256:
+                break
+            bits_per_key *= 1.05
+        self.hashes = hashes
+        self.size = blocks
+        #Explicitly little endian so that bit i of word w is bit i % 8
+        #of byte 8 * w + i // 8, and as in KmerTable the words are in a
+        #bytearray for quick single lookups from Python
+        self._bytes = bytearray(8 * self.block_words * self.size)
+        self.bits = np.frombuffer(self._bytes, "<u8")
+        self._blocks = self.bits.reshape(self.size, self.block_words)
+        self._packing = [(2 * (kmer - offset - length), (1 << (2 * length)) - 1)
+                         for offset, length in _word_spans(kmer)]
+
+    @classmethod
+    def blocked_error_rate(cls, load, hashes):
+        """Expected false positive rate given the mean keys per block and hashes per key.
+
+        The number of keys in a block is (roughly) Poisson distributed,
+        and within a block each word gets its share of the bits of every
+        key, so this is the false positive rate of each possible block
+        weighted by how likely it is.
+        """
+        #Number of bits each key sets in each of the words
+        shares = [hashes // cls.block_words + (w < hashes % cls.block_words)
+                  for w in range(cls.block_words)]
+        rate = 0.0
+        #Poisson probability of a block with n keys, updated as n goes up
+        chance = math.exp(-load)
+        n = 0
+        while n < load + 20 * math.sqrt(load) + 20:
+            block_rate = 1.0
+            for share in shares:
+                if share:
+                    block_rate *= (1.0 - (1.0 - 1.0 / 64) ** (n * share)) ** share
+            rate += chance * block_rate
+            n += 1
+            chance *= load / n
+        return rate
+
+    @property
+    def nbytes(self):
+        return self.bits.nbytes
+
+    def _hash(self, keys):
+        """Arrays of word index and bit mask for each key (a 1D array)."""
+        if self.kmer <= 32:
+            words = keys.reshape(len(keys), 1)
+        else:
+            words = keys.view(">u8").reshape(len(keys), kmer_word_count(self.kmer))
+        h = np.empty(len(keys), np.uint64)
+        h.fill(_HASH_SEED)
+        for w in range(words.shape[1]):
+            h ^= words[:, w]
+            _mix_array(h)
+        index = h % np.uint64(self.size)
+        #Six bits per hash, up to ten from each further 64 bit hash, with
+        #hash i setting a bit in word i % 8 of the block
+        mask = np.zeros((len(keys), self.block_words), np.uint64)
+        one = np.uint64(1)
+        for i in range(self.hashes):
+            if i % 10 == 0:
+                g = _mix_array(h ^ np.uint64(_HASH_SEED + i))
+            mask[:, i % self.block_words] |= one << ((g >> np.uint64(6 * (i % 10))) & np.uint64(63))
+        return index, mask
+
+    def add(self, keys, chunk=1 << 16):
+        """Add the keys (a 1D array) to the filter."""
+        #Work in chunks so the (keys, 8) arrays of masks stay in cache
+        for i in range(0, len(keys), chunk):
+            index, mask = self._hash(keys[i:i + chunk])
+            #Combine masks for the same block, so a plain assignment works
+            order = np.argsort(index, kind="mergesort")
+            index = index[order]
+            mask = mask[order]
+            starts = np.flatnonzero(np.concatenate(([True], index[1:] != index[:-1])))
+            index = index[starts]
+            self._blocks[index] |= np.bitwise_or.reduceat(mask, starts, axis=0)
+
+    def contains(self, keys, chunk=1 << 14):
+        """Boolean array, are the keys (a 1D array) possibly present?"""
+        found = np.empty(len(keys), bool)
+        for i in range(0, len(keys), chunk):
+            index, mask = self._hash(keys[i:i + chunk])
+            found[i:i + chunk] = ((self._blocks[index] & mask) == mask).all(axis=1)
+        return found
+
+    def __contains__(self, code):
+        """Is this integer k-mer code possibly present?"""
+        h = _HASH_SEED
+        for shift, mask in self._packing:
+            h = _mix(h ^ ((code >> shift) & mask))
+        start = 8 * self.block_words * (h % self.size)
+        data = self._bytes
+        for i in range(self.hashes):
+            if i % 10 == 0:
+                g = _mix(h ^ (_HASH_SEED + i))
+            bit = (g >> (6 * (i % 10))) & 63
+            byte = start + 8 * (i % self.block_words) + (bit >> 3)
+            if not (data[byte] >> (bit & 7)) & 1:
+                return False
+        return True
+
+    def close(self):
+        pass
+
+class DabloomsFilter(object):
+    """Wrapper for a dablooms Bloom filter, with the same interface as BloomFilter.
+
+    This is a counting, scaling Bloom filter held in a temporary file,
+    using the hex string of each k-mer code as the key.
+    """
+
+    def __init__(self, capacity, error_rate, kmer):
+        if pydablooms is None:
+            sys_exit("Missing 'dablooms' Python bindings, available from "
+                     "https://github.com/bitly/dablooms")
+        self.kmer = kmer
+        self.capacity = capacity
+        self.error_rate = error_rate
+        handle, self.filename = tempfile.mkstemp(prefix="bloom-", suffix=".bin")
+        os.close(handle)
+        self.bloom = pydablooms.Dablooms(max(1, capacity), error_rate, self.filename)
+
+    @property
+    def nbytes(self):
+        return os.path.getsize(self.filename)
+
+    def add(self, keys):
+        for code in key_codes(keys, self.kmer):
+            self.bloom.add(kmer_key(code))
+        self.bloom.flush()
+
+    def contains(self, keys):
+        bloom = self.bloom
+        return np.array([kmer_key(code) in bloom for code in key_codes(keys, self.kmer)],
+                        bool)
+
+    def __contains__(self, code):
+        return kmer_key(code) in self.bloom
+
+    def close(self):
+        """Remove the temporary file."""
+        del self.bloom
+        os.remove(self.filename)
+
+BLOOM_BACKENDS = {"builtin": BloomFilter, "dablooms": DabloomsFilter}
+
+#Lookup table from ASCII to 2-bit codes, with 4 meaning not A, C, G or T
+_base_codes = None
+
+def encode_reads(upper_seqs):
+    """Matrix of 2-bit base codes (uint8) for a list of upper case reads.
+
+    Each read is a row, padded with 4 (which is also used for any
+    ambiguous base) up to the length of the longest read.
+    """
+    global _base_codes
+    if _base_codes is None:
+        _base_codes = np.empty(256, np.uint8)
+        _base_codes.fill(4)
+        for i, letter in enumerate("ACGT"):
+            _base_codes[ord(letter)] = i
+    width = max(len(upper_seq) for upper_seq in upper_seqs)
+    data = "".join(upper_seq.ljust(width, "N") for upper_seq in upper_seqs)
+    return _base_codes[np.frombuffer(data, np.uint8)].reshape(len(upper_seqs), width)
+
+def batch_kmer_keys(bases, kmer, seed=None):
+    """Canonical k-mer keys for every window of every read in a matrix.
+
+    Takes a matrix of base codes as from encode_reads, returns a matrix
+    of keys (see kmer_key_dtype) with a column for each window, and a
+    boolean matrix of the same shape which is False for any window
+    including an ambiguous base (or padding).
+
+    Optionally give a spaced seed mask (see make_seeds) to apply to the
+    forward and reverse complement codes before taking the smaller.
+    """
+    fwd, rev, valid = _batch_kmer_words(bases, kmer)
+    return _canonical_keys(fwd, rev, kmer, seed), valid
+
+def _batch_kmer_words(bases, kmer):
+    """Forward and reverse complement words for each window, and validity.
+
+    The forward and reverse arrays have dimensions word, window, read
+    (see batch_kmer_keys for the validity matrix, which is window by read).
+
+    The codes are rolled along the reads one window at a time (shift in
+    the new base, mask off the old one), with each step being a single
+    vector operation over all the reads in the batch.
+    """
+    rows, width = bases.shape
+    windows = width - kmer + 1
+    spans = _word_spans(kmer)
+    if windows < 1:
+        return np.zeros((len(spans), 0, rows), np.uint64), \
+            np.zeros((len(spans), 0, rows), np.uint64), np.zeros((rows, 0), bool)
+    #Work with a row per base position, so each step is contiguous
+    fwd_bases = np.ascontiguousarray((bases & 3).T, np.uint64)
+    rev_bases = np.uint64(3) - fwd_bases
+    bad = np.zeros((width + 1, rows), np.int32)
+    np.cumsum(bases.T > 3, axis=0, out=bad[1:])
+    valid = bad[kmer:] == bad[:windows]
+    del bad
+    two = np.uint64(2)
+    fwd = np.empty((len(spans), windows, rows), np.uint64)
+    rev = np.empty((len(spans), windows, rows), np.uint64)
+    for w, (offset, length) in enumerate(spans):
+        mask = np.uint64((1 << (2 * length)) - 1)
+        top = np.uint64(2 * (length - 1))
+        #First window, forward strand word has its first base most
+        #significant, the matching reverse complement word comes from
+        #the other end of the k-mer with its last base most significant
+        code = np.zeros(rows, np.uint64)
+        for i in range(offset, offset + length):
+            code <<= two
+            code |= fwd_bases[i]
+        fwd[w, 0] = code
+        code = np.zeros(rows, np.uint64)
+        for i in range(kmer - offset - 1, kmer - offset - length - 1, -1):
+            code <<= two
+            code |= rev_bases[i]
+        rev[w, 0] = code
+        #Now roll along the remaining windows
+        for i in range(1, windows):
+            code = fwd[w, i]
+            np.left_shift(fwd[w, i - 1], two, code)
+            code &= mask
+            code |= fwd_bases[i + offset + length - 1]
+            code = rev[w, i]
+            np.right_shift(rev[w, i - 1], two, code)
+            code |= rev_bases[i + kmer - offset - 1] << top
+    return fwd, rev, valid.T
+
+def _canonical_keys(fwd, rev, kmer, seed=None):
+    """Matrix of canonical keys (read by window) from _batch_kmer_words output."""
+    spans = _word_spans(kmer)
+    if seed is not None:
+        masks = [np.uint64((seed >> (2 * (kmer - offset - length))) & ((1 << (2 * length)) - 1))
+                 for offset, length in spans]
+        fwd = fwd & np.array(masks, np.uint64)[:, None, None]
+        rev = rev & np.array(masks, np.uint64)[:, None, None]
+    if len(spans) == 1:
+        return np.minimum(fwd[0], rev[0]).T
+    #Lexicographic comparison, deciding from the last word backwards
+    use_rev = rev[-1] < fwd[-1]
+    for w in range(len(spans) - 2, -1, -1):
+        use_rev = (rev[w] < fwd[w]) | ((rev[w] == fwd[w]) & use_rev)
+    rows, windows = fwd.shape[2], fwd.shape[1]
+    keys = np.empty((rows, windows, len(spans)), ">u8")
+    for w in range(len(spans)):
+        keys[:, :, w] = np.where(use_rev, rev[w], fwd[w]).T
+    return keys.view(kmer_key_dtype(kmer))[:, :, 0]
+
+def minimizer_hashes(keys, kmer):
+    """Array of 64 bit hashes of canonical k-mer keys (any shape array).
+
+    Used to order the k-mers when picking window minimizers, so that
+    the choice is not biased towards low complexity k-mers like poly-A
+    (as it would be using the keys themselves).
+    """
+    words = kmer_word_count(kmer)
+    if words == 1:
+        return _mix_array(keys ^ np.uint64(_HASH_SEED))
+    parts = np.ascontiguousarray(keys).view(">u8").reshape(np.shape(keys) + (words,))
+    hashes = _mix_array(parts[..., 0].astype(np.uint64) ^ np.uint64(_HASH_SEED))
+    for w in range(1, words):
+        hashes = _mix_array(hashes ^ parts[..., w].astype(np.uint64))
+    return hashes
+
+def window_minimizers(hashes, valid, window):
+    """Boolean array marking the window minimizers in each row of k-mers.
+
+    Takes arrays of the k-mer hashes (see minimizer_hashes) and validity
+    by row and window, and for every run of the given number of
+    consecutive k-mers in a row marks the one with the smallest hash (the
+    first if tied). Invalid k-mers are never marked, and rows with fewer
+    k-mers than the window just have their smallest marked.
+
+    Two sequences sharing a run of window k-mers therefore share its
+    minimizer, so storing only the minimizers of the references and
+    looking up only those of the reads still finds any read with a
+    long enough exact match, while storing and probing several fold
+    fewer k-mers (about two in every window plus one).
+
+    >>> valid = np.ones((1, 6), bool)
+    >>> hashes = np.array([[5, 3, 4, 9, 1, 8]], np.uint64)
+    >>> np.flatnonzero(window_minimizers(hashes, valid, 3)).tolist()
+    [1, 4]
+    """
+    rows, count = hashes.shape
+    chosen = np.zeros(hashes.shape, bool)
+    if not count:
+        return chosen
+    hashes = np.where(valid, hashes, np.uint64(_MASK64))
+    span = min(window, count)
+    starts = count - span + 1
+    #Minimum over each window one offset at a time, then the first offset
+    #holding it, which is quicker and uses less memory than argmin over
+    #a strided view
+    smallest = hashes[:, :starts].copy()
+    for i in range(1, span):
+        np.minimum(smallest, hashes[:, i:i + starts], out=smallest)
+    offset = np.zeros(smallest.shape, np.int64)
+    for i in range(span - 1, 0, -1):
+        offset = np.where(hashes[:, i:i + starts] == smallest, i, offset)
+    offset[hashes[:, :starts] == smallest] = 0
+    offset += np.arange(starts) + (np.arange(rows) * count)[:, None]
+    chosen.ravel()[offset.ravel()] = True
+    return chosen & valid
+
+def batch_filter(upper_seqs_list, kmer, table, bloom=None, min_hits=1, min_fraction=0.0):
+    """Boolean array, does each record have enough k-mers in the table?
+
+    Takes a list of records, each given as a list of upper case reads
+    (e.g. two for a read pair), and checks them all in one go against
+    a KmerTable (optionally using a Bloom filter before the binary
+    search, see KmerTable.contains). If the table uses spaced seeds,
+    the reads are checked with each of them.
+
+    By default a single k-mer hit is enough, see records_wanted for the
+    other thresholds.
+    """
+    hits, windows = batch_hits(upper_seqs_list, kmer, table, bloom)
+    return records_wanted(hits, windows, min_hits, min_fraction)
+
+def batch_hits(upper_seqs_list, kmer, table, bloom=None, stats=None):
+    """Arrays of the number of k-mer hits and of windows for each record.
+
+    Takes a list of records as for batch_filter. A window is a hit if
+    its k-mer is in the table (under any of its spaced seeds), and only
+    windows without ambiguous bases are counted. If the table holds
+    window minimizers, only the reads' minimizers are looked up, and
+    counted as windows. If given a stats dictionary (see new_stats), the
+    time spent working out the keys (hash) and looking them up (probe)
+    is added to it, along with the lookup counts (see KmerTable.contains).
+    """
+    upper_seqs = []
+    owners = []
+    for i, seqs in enumerate(upper_seqs_list):
+        upper_seqs.extend(seqs)
+        owners.extend([i] * len(seqs))
+    if not upper_seqs:
+        return np.zeros(len(upper_seqs_list), np.int64), np.zeros(len(upper_seqs_list), np.int64)
+    t0 = time.time()
+    fwd, rev, valid = _batch_kmer_words(encode_reads(upper_seqs), kmer)
+    hashing = time.time() - t0
+    probing = 0.0
+    hit = np.zeros(valid.shape, bool)
+    for seed in table.seeds:
+        t0 = time.time()
+        keys = _canonical_keys(fwd, rev, kmer, seed)
+        if table.minimizers:
+            valid = window_minimizers(minimizer_hashes(keys, kmer), valid, table.minimizers)
+            t1 = time.time()
+            hit[valid] = table.contains(keys[valid], bloom, stats)
+        else:
+            t1 = time.time()
+            hit |= table.contains(keys, bloom, stats)
+        hashing += t1 - t0
+        probing += time.time() - t1
+    if stats is not None:
+        stats["hash"] += hashing
+        stats["probe"] += probing
+    hit &= valid
+    hits = np.bincount(owners, hit.sum(axis=1), len(upper_seqs_list)).astype(np.int64)
+    windows = np.bincount(owners, valid.sum(axis=1), len(upper_seqs_list)).astype(np.int64)
+    return hits, windows
+
+def records_wanted(hits, windows, min_hits=1, min_fraction=0.0):
+    """Boolean array, does each record have enough k-mer hits?
+
+    That is at least min_hits, and at least min_fraction of its windows.
+    """
+    return (hits >= min_hits) & (hits >= min_fraction * windows)
+
+#Lower bounds of the buckets for the histograms of k-mer hits per record
+HIT_BUCKETS = [0, 1, 2, 3, 5, 10, 20, 50, 100, 200]
+
+def hit_histogram(hits):
+    """Array counting the records in each of the HIT_BUCKETS."""
+    if not len(hits):
+        return np.zeros(len(HIT_BUCKETS), np.int64)
+    return np.bincount(np.searchsorted(HIT_BUCKETS, hits, side="right") - 1,
+                       minlength=len(HIT_BUCKETS))
+
+def hit_histogram_lines(histogram):
+    """Lines of text showing a histogram from hit_histogram."""
+    total = max(1, histogram.sum())
+    lines = []
+    for i, (low, count) in enumerate(zip(HIT_BUCKETS, histogram.tolist())):
+        if i + 1 == len(HIT_BUCKETS):
+            label = "%i+" % low
+        elif HIT_BUCKETS[i + 1] == low + 1:
+            label = "%i" % low
+        else:
+            label = "%i-%i" % (low, HIT_BUCKETS[i + 1] - 1)
+        lines.append("%9s %10i %5.1f%%\n" % (label, count, 100.0 * count / total))
+    return "".join(lines)
+
+#Stages of filtering the reads, timed for each batch (in seconds), and the
+#counts kept for each batch, see new_stats. The bitmap_passed, bloom_passed
+#and table_hits counts are of the k-mers looked up which pass the table's
+#prefix bitmap, then the Bloom filter (if used), and are in the table.
+#With the k-mer strings (see KmerTable.build_strings) there is no bitmap
+#or Bloom filter, and the string_lookups and string_hits are counted instead.
+RUN_STAGES = ["parse", "hash", "probe", "write"]
+RUN_COUNTERS = ["records", "reads", "bases", "kept_reads",
+                "bitmap_passed", "bloom_passed", "table_hits",
+                "string_lookups", "string_hits"]
+
+def new_stats():
+    """Dictionary of zeroed RUN_STAGES times and RUN_COUNTERS."""
+    stats = dict.fromkeys(RUN_STAGES, 0.0)
+    stats.update(dict.fromkeys(RUN_COUNTERS, 0))
+    return stats
+
+def add_stats(total, stats):
+    """Add the times and counts from one stats dictionary to another."""
+    for key in RUN_STAGES + RUN_COUNTERS:
+        total[key] += stats[key]
+
+def count_records(stats, seqs, wanted):
+    """Add the numbers of records, reads, bases and reads kept to the stats.
+
+    Takes the list of sequences for each record, and a list or array of
+    booleans for which records were wanted.
+    """
+    stats["records"] += len(seqs)
+    stats["reads"] += sum(len(upper_seqs) for upper_seqs in seqs)
+    stats["bases"] += sum(len(upper_seq) for upper_seqs in seqs for upper_seq in upper_seqs)
+    stats["kept_reads"] += sum(len(upper_seqs) for upper_seqs, keep in zip(seqs, wanted) if keep)
+
+def peak_memory():
+    """Peak resident memory in MB of this process, and of any finished child processes.
+
+    Returns None for each if this is not available (e.g. on Windows).
+    For the children this is the peak of the largest, not their total.
+    """
+    if resource is None:
+        return None, None
+    #Linux reports this in kilobytes, Mac OS X in bytes
+    scale = 1024.0 * 1024.0 if sys.platform == "darwin" else 1024.0
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale, \
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale
+
+def batch_bin_counts(upper_seqs_list, kmer, table, bloom=None, stats=None):
+    """Matrix of k-mer hits from each record to each reference set.
+
+    Takes a list of records as for batch_filter, and a KmerTable with
+    colours. Each read window found in the table counts as a hit to every
+    reference set with that k-mer (with spaced seeds, only the first seed
+    finding the window is used). Returns an integer array with a row for
+    each record and a column for each reference set, plus the arrays of
+    hits (to any set) and windows for each record as from batch_hits.
+    Window minimizers and any stats dictionary are handled as in batch_hits.
+    """
+    upper_seqs = []
+    owners = []
+    for i, seqs in enumerate(upper_seqs_list):
+        upper_seqs.extend(seqs)
+        owners.extend([i] * len(seqs))
+    set_count = len(table.names)
+    if not upper_seqs:
+        return np.zeros((len(upper_seqs_list), set_count), np.int64), \
+            np.zeros(len(upper_seqs_list), np.int64), np.zeros(len(upper_seqs_list), np.int64)
+    t0 = time.time()
+    fwd, rev, valid = _batch_kmer_words(encode_reads(upper_seqs), kmer)
+    hashing = time.time() - t0
+    probing = 0.0
+    found = None
+    for seed in table.seeds:
+        t0 = time.time()
+        keys = _canonical_keys(fwd, rev, kmer, seed)
+        if table.minimizers:
+            valid = window_minimizers(minimizer_hashes(keys, kmer), valid, table.minimizers)
+            t1 = time.time()
+            index = np.empty(valid.shape, np.int64)
+            index.fill(-1)
+            index[valid] = table.find(keys[valid], bloom, stats)
+        else:
+            t1 = time.time()
+            index = table.find(keys, bloom, stats)
+        if found is None:
+            found = index
+        else:
+            found = np.where(found < 0, index, found)
+        hashing += t1 - t0
+        probing += time.time() - t1
+    if stats is not None:
+        stats["hash"] += hashing
+        stats["probe"] += probing
+    found[~valid] = -1
+    reads, windows = np.nonzero(found >= 0)
+    position, sets = table.colour_members(table.colours[found[reads, windows]])
+    owners = np.asarray(owners)
+    records = owners[reads][position]
+    return np.bincount(records * set_count + sets, minlength=len(upper_seqs_list) * set_count) \
+        .reshape(len(upper_seqs_list), set_count), \
+        np.bincount(owners[reads], minlength=len(upper_seqs_list)), \
+        np.bincount(owners, valid.sum(axis=1), len(upper_seqs_list)).astype(np.int64)
+
+def batched(iterator, size):
+    """Yield lists of up to the given number of entries from an iterator."""
+    batch = []
+    for entry in iterator:
+        batch.append(entry)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def timed(iterator, stats, stage):
+    """Yield the entries from an iterator, adding the time taken to stats[stage]."""
+    iterator = iter(iterator)
+    while True:
+        t0 = time.time()
+        try:
+            entry = next(iterator)
+        except StopIteration:
+            stats[stage] += time.time() - t0
+            return
+        stats[stage] += time.time() - t0
+        yield entry
+
 ambiguous_dna_values = {
     "A": "A",
     "C": "C",
@@ -254,106 +1903,899 @@ def disambiguate(seq):
                         yield new
                 break
 
-def build_filter(bloom_filename, linear_refs, circular_refs, kmer,
-                 mismatches, inserts, deletions, error_rate=0.01, rc=True):
-    #Using 5e-06 is close to a set for my example, both in run time
-    #(a fraction more) and the number of reads kept (9528 vs 8058
-    #with sets).
-    simple = set()
-    del_hashes = set()
-    count = 0
+#Stages of building the table, as timed and reported by build_filter
+BUILD_STAGES = ["parse", "encode", "exact", "ambiguous", "variants", "sort"]
+
+#Reference windows with ambiguous bases are only expanded if this gives
+#at most this many k-mers (e.g. up to five N), see reference_keys
+MAX_EXPANSIONS = 1024
+
+def _column_words(columns, kmer, count):
+    """Forward and reverse complement words for k-mers given base by base.
+
+    Takes a list of k columns, each an array of 2-bit base codes with an
+    entry for each of the count k-mers (or a single code, used for an
+    inserted base), and returns arrays with dimensions word, 1, k-mer
+    (so that _canonical_keys can be used, as with _batch_kmer_words).
+    """
+    spans = _word_spans(kmer)
+    two = np.uint64(2)
+    fwd = np.zeros((len(spans), 1, count), np.uint64)
+    rev = np.zeros((len(spans), 1, count), np.uint64)
+    for w, (offset, length) in enumerate(spans):
+        code = fwd[w, 0]
+        for i in range(offset, offset + length):
+            code <<= two
+            code |= columns[i]
+        code = rev[w, 0]
+        for i in range(kmer - offset - 1, kmer - offset - length - 1, -1):
+            code <<= two
+            code |= 3 - columns[i]
+    return fwd, rev
+
+def _segment_words(bases, start, count, kmer, row=1024):
+    """Forward and reverse complement words, and validity, for a stretch of windows.
+
+    Takes a 1D array of base codes (e.g. a whole reference) and returns
+    the words for count windows from the given start, with dimensions
+    word, 1, window (as for _column_words), plus a boolean validity array.
+    The stretch is cut into overlapping rows so that _batch_kmer_words
+    can roll along all of them at once.
+    """
+    rows = -(-count // row)
+    needed = rows * row + kmer - 1
+    piece = bases[start:start + needed]
+    if len(piece) < needed:
+        #Padding only affects windows past the count, which are dropped
+        piece = np.concatenate((piece, np.zeros(needed - len(piece), np.uint8)))
+    matrix = np.lib.stride_tricks.as_strided(piece, (rows, row + kmer - 1), (row, 1))
+    fwd, rev, valid = _batch_kmer_words(matrix, kmer)
+    words = fwd.shape[0]
+    fwd = fwd.transpose(0, 2, 1).reshape(words, 1, rows * row)[:, :, :count]
+    rev = rev.transpose(0, 2, 1).reshape(words, 1, rows * row)[:, :, :count]
+    return fwd, rev, valid.ravel()[:count]
+
+def _substituted(fwd, rev, kmer, position, base):
+    """Copy of k-mer words (see _column_words) with one base replaced."""
+    spans = _word_spans(kmer)
+    fwd = fwd.copy()
+    rev = rev.copy()
+    #Position i of the reverse complement is position k-1-i of the k-mer
+    for words, i, code in [(fwd, position, base), (rev, kmer - 1 - position, 3 - base)]:
+        w = i // 32
+        offset, length = spans[w]
+        shift = np.uint64(2 * (offset + length - 1 - i))
+        words[w] &= ~(np.uint64(3) << shift)
+        words[w] |= np.uint64(code) << shift
+    return fwd, rev
+
+def reference_keys(upper_seq, kmer, circular=False, mismatches=0, inserts=False,
+                   deletions=False, seeds=None, timings=None, minimizers=None, chunk=1 << 22):
+    """Canonical k-mer keys for a reference sequence, plus any variants.
+
+    The sequence is encoded once, and the keys for all its k-mers are
+    then found with vector operations, in stretches of (about) chunk
+    windows. For a circular reference this includes the windows wrapping
+    round the origin. Only the (usually rare) windows which contain an
+    ambiguous base are expanded in Python (see disambiguate), and any
+    with more than MAX_EXPANSIONS possible k-mers (e.g. overlapping a run
+    of N) or an unexpected character are skipped.
+
+    To allow for a mismatch, each k-mer is also added with each base
+    replaced by A, C, G and T. To allow for an insertion, every (k-1)-mer
+    is added with each base inserted at each position, and to allow for
+    a deletion every (k+1)-mer is added with each internal base removed.
+
+    If given a window size for minimizers, only the window minimizers of
+    the exact k-mers are kept (see window_minimizers), plus all those from
+    windows with ambiguous bases. Variants are not supported with this.
+
+    Returns a list of arrays of unique keys (see kmer_key_dtype), the
+    number of reference k-mers considered, and the number of windows
+    skipped. If given, a dictionary of BUILD_STAGES times is updated.
+    """
+    if mismatches > 1:
+        raise ValueError("Reference k-mer variants only allow for one mismatch, not %i" % mismatches)
+    if minimizers and (mismatches or inserts or deletions or seeds):
+        raise ValueError("Window minimizers can't be used with k-mer variants or spaced seeds")
+    if timings is None:
+        timings = dict.fromkeys(BUILD_STAGES, 0.0)
+    seeds = seeds or [None]
     t0 = time.time()
-    if linear_refs:
-        for fasta in linear_refs:
-            sys.stderr.write("Hashing linear references in %s\n" % fasta)
-            handle = open(fasta)
-            for upper_seq, raw_read in fasta_iterator(handle):
-                #assert set(upper_seq).issubset("ACGT"), "%s contains %s" \
-                #    % (raw_read.split("\n",1)[0], set(upper_seq).difference("ACGT"))
-                #Note we do the disambiguate call on the fragments rather than
-                #the whole reference to avoid too many levels of recursion.
-                for i in range(0, len(upper_seq) - kmer):
-                    for fragment in disambiguate(upper_seq[i:i+kmer]):
-                        assert set(fragment).issubset("ACGT"), fragment
-                        simple.add(fragment)
-                        #bloom.add(fragment, kmer)
-                        count += 1 #TODO - Can do this in one go from len(upper_seq)
-                if deletions:
-                    for i in range(0, len(upper_seq) - kmer+1):
-                        for fragment in make_deletions(upper_seq[i:i+kmer+1]):
-                            del_hashes.add(fragment)                    
-            handle.close()
+    length = len(upper_seq)
+    if circular:
+        #Want to consider wrapping round the origin, add a (k+1)-mer
+        #(plus enough for the last window of minimizers)
+        upper_seq += upper_seq[:kmer + 1 + (minimizers or 0)]
+    bases = encode_reads([upper_seq])[0]
+    #Cumulative count of ambiguous bases, for finding the windows with any
+    bad = np.zeros(len(bases) + 1, np.int32)
+    np.cumsum(bases > 3, out=bad[1:])
+    timings["encode"] += time.time() - t0
+
+    keys = []
+    codes = set()
+    count = skipped = 0
+    widths = [kmer]
+    if inserts:
+        widths.append(kmer - 1)
+    if deletions:
+        widths.append(kmer + 1)
+    for width in widths:
+        if circular:
+            windows = min(length, len(bases) - width + 1)
+        else:
+            windows = length - width + 1
+        if windows < 1:
+            continue
+        if width == kmer and not mismatches:
+            step = chunk
+        else:
+            #Each window gives about 4k variants
+            step = max(1024, chunk // (4 * kmer))
+        for start in range(0, windows, step):
+            t0 = time.time()
+            n = min(step, windows - start)
+            found = []
+            if width == kmer and minimizers:
+                #Include the k-mers in the windows of minimizers starting
+                #in this stretch, which overlap the next
+                extended = min(n + minimizers - 1, len(bases) - kmer + 1 - start)
+                fwd, rev, valid = _segment_words(bases, start, extended, kmer)
+                count += int(valid[:n].sum())
+                if extended >= minimizers or not start:
+                    #Otherwise all these windows run off the end (and
+                    #the last whole window was in the previous stretch)
+                    keys_found = _canonical_keys(fwd, rev, kmer)[:, 0]
+                    chosen = window_minimizers(minimizer_hashes(keys_found, kmer)[None, :],
+                                               valid[None, :], minimizers)[0]
+                    found.append(keys_found[chosen])
+            elif width == kmer:
+                fwd, rev, valid = _segment_words(bases, start, n, kmer)
+                for seed in seeds:
+                    found.append(_canonical_keys(fwd, rev, kmer, seed)[valid, 0])
+                count += int(valid.sum())
+                t1 = time.time()
+                timings["exact"] += t1 - t0
+                t0 = t1
+                if mismatches:
+                    for position in range(kmer):
+                        for base in range(4):
+                            found.append(_canonical_keys(*_substituted(fwd, rev, kmer, position, base),
+                                                         kmer=kmer)[valid, 0])
+            else:
+                valid = bad[start + width:start + width + n] == bad[start:start + n]
+                columns = [bases[start + i:start + i + n] for i in range(width)]
+                if width < kmer:
+                    variants = [columns[:i] + [np.uint8(base)] + columns[i:]
+                                for i in range(kmer) for base in range(4)]
+                else:
+                    #Removing the first or last base just gives a reference k-mer
+                    variants = [columns[:i] + columns[i + 1:] for i in range(1, kmer)]
+                for variant in variants:
+                    found.append(_canonical_keys(*_column_words(variant, kmer, n),
+                                                 kmer=kmer)[valid, 0])
+            t1 = time.time()
+            timings["variants"] += t1 - t0
+            if found:
+                keys.append(np.unique(np.concatenate(found)))
+            timings["sort"] += time.time() - t1
 
-    if circular_refs:
-        for fasta in circular_refs:
-            sys.stderr.write("Hashing circular references in %s\n" % fasta)
+        t0 = time.time()
+        ambiguous = np.flatnonzero(bad[width:width + windows] != bad[:windows])
+        ambiguous_counts = (bad[width:width + windows] - bad[:windows])[ambiguous]
+        for start, ambiguous_count in zip(ambiguous.tolist(), ambiguous_counts.tolist()):
+            fragment = upper_seq[start:start + width]
+            expansions = 1 << ambiguous_count
+            if expansions <= MAX_EXPANSIONS:
+                #At least two choices per ambiguous base, so worth counting
+                expansions = 1
+                for letter in fragment.translate(None, "ACGT"):
+                    expansions *= len(ambiguous_dna_values.get(letter, ""))
+            if not 0 < expansions <= MAX_EXPANSIONS:
+                if width == kmer:
+                    skipped += 1
+                continue
+            for fragment in disambiguate(fragment):
+                if width == kmer:
+                    count += 1
+                    if mismatches:
+                        variants = make_variants(fragment, mismatches)
+                    else:
+                        variants = [fragment]
+                elif width < kmer:
+                    variants = make_inserts(fragment)
+                else:
+                    variants = make_deletions(fragment)
+                for variant in variants:
+                    for seed in seeds:
+                        codes.add(encode_kmer(variant, seed))
+        timings["ambiguous"] += time.time() - t0
+    if codes:
+        t0 = time.time()
+        keys.append(np.unique(code_keys(codes, kmer)))
+        timings["sort"] += time.time() - t0
+    return keys, count, skipped
+
+def build_filter(linear_refs, circular_refs, kmer,
+                 mismatches, inserts, deletions, spaced_seeds=False, colours=False,
+                 minimizers=None):
+    """Build a KmerTable of the reference k-mers.
+
+    Mismatches, inserts and deletions are allowed for by adding all the
+    possible variants of each reference k-mer (see reference_keys), unless
+    using spaced seeds where just the reference k-mers are added under
+    each of three seed masks (see make_seeds), and the reads are checked
+    under each mask. This only allows for a single mismatch, and raises
+    a ValueError for more.
+
+    With colours, each reference file is treated as a reference set, and
+    the table records which sets each k-mer came from (see colour_keys),
+    for binning the reads.
+
+    If given a window size for minimizers, only the reference k-mers which
+    are window minimizers are added (see window_minimizers), and the reads
+    are sampled the same way. This only allows for exact matches.
+
+    The time taken by each of the BUILD_STAGES is reported on stderr.
+    """
+    if spaced_seeds:
+        if mismatches > 1:
+            raise ValueError("Spaced seeds only allow for one mismatch, not %i" % mismatches)
+        #Two masks would do for one mismatch, but using three means each
+        #ignores fewer bases, so there are fewer false positives
+        seeds = make_seeds(kmer, 3)
+        inserts = deletions = False
+        mismatches = 0
+    else:
+        seeds = None
+    timings = dict.fromkeys(BUILD_STAGES, 0.0)
+    keys = []
+    #For colours, the unique keys of each reference set
+    set_keys = []
+    count = skipped = total = 0
+    t0 = time.time()
+    for refs, circular in [(linear_refs, False), (circular_refs, True)]:
+        for fasta in refs or []:
+            sys.stderr.write("Hashing %s references in %s\n"
+                             % ("circular" if circular else "linear", fasta))
             handle = open(fasta)
+            t1 = time.time()
             for upper_seq, raw_read in fasta_iterator(handle):
-                #assert set(upper_seq).issubset("ACGT"), "%s contains %s" \
-                #    % (raw_read.split("\n",1)[0], set(upper_seq).difference("ACGT"))
-                #Want to consider wrapping round the origin, add k-mer length:
-                upper_seq += upper_seq[:kmer]
-                for i in range(0, len(upper_seq) - kmer):
-                    for fragment in disambiguate(upper_seq[i:i+kmer]):
-                        assert set(fragment).issubset("ACGT"), fragment
-                        simple.add(fragment)
-                        #bloom.add(fragment, kmer)
-                        count += 1 #TODO - Can do this in one go from len(upper_seq)
-                if deletions:
-                    for i in range(0, len(upper_seq) - kmer+1):
-                        for fragment in make_deletions(upper_seq[i:i+kmer+1]):
-                            del_hashes.add(fragment)
+                timings["parse"] += time.time() - t1
+                found, considered, missed = reference_keys(upper_seq, kmer, circular,
+                                                           mismatches, inserts, deletions,
+                                                           seeds, timings, minimizers)
+                keys.extend(found)
+                count += considered
+                skipped += missed
+                total += len(upper_seq)
+                t1 = time.time()
+            timings["parse"] += time.time() - t1
             handle.close()
-    if rc:
-        #Would popping be slow? Should mean less memory at once
-        temp = simple.copy()
-        for fragment in temp:
-            simple.add(reverse_complement(fragment))
-        del temp
-    if mismatches or inserts or deletions:
-        sys.stderr.write("Have %i unique k-mers before consider fuzzy matches\n" \
-                         % (len(simple)))
-        if deletions:
-            #Do this first to avoid 3 large sets in memory!
-            new = del_hashes
-            del del_hashes
-            new.update(simple)
-            sys.stderr.write("Adding deletions brings this to %i unique k-mers\n" \
-                             % len(new))
+            if colours:
+                t1 = time.time()
+                if keys:
+                    set_keys.append(np.unique(np.concatenate(keys)))
+                else:
+                    set_keys.append(np.zeros(0, kmer_key_dtype(kmer)))
+                keys = []
+                timings["sort"] += time.time() - t1
+    if skipped:
+        sys.stderr.write("Skipped %i reference windows with over %i possible k-mers "
+                         "from ambiguous bases (or unexpected characters)\n"
+                         % (skipped, MAX_EXPANSIONS))
+    t1 = time.time()
+    if colours:
+        sets = np.repeat(np.arange(len(set_keys)), [len(k) for k in set_keys])
+        keys, colour_ids, colour_sets = colour_keys(np.concatenate(set_keys), sets, len(set_keys))
+        del set_keys, sets
+        table = KmerTable(keys, kmer, seeds=seeds, colours=colour_ids, colour_sets=colour_sets,
+                          names=reference_set_names((linear_refs or []) + (circular_refs or [])),
+                          minimizers=minimizers)
+    else:
+        if len(keys) == 1:
+            keys = keys[0]
+        elif keys:
+            keys = np.unique(np.concatenate(keys))
         else:
-            new = simple.copy()
-        if mismatches:
-            for fragment in simple:
-                for var in make_variants(fragment, mismatches):
-                    new.add(var)
-            sys.stderr.write("Adding %i mis-matches per k-mer, have %i unique k-mers\n" \
-                             % (mismatches, len(new)))
-        if inserts:
-            for fragment in simple:
-                for var in make_inserts(fragment):
-                    new.add(var)
-            sys.stderr.write("Adding inserts brings this to %i unique k-mers\n" \
-                             % len(new))
-        simple = new
-    capacity = len(simple)
-    bloom = pydablooms.Dablooms(capacity, error_rate, bloom_filename)
-    for fragment in simple:
-        bloom.add(fragment)
-    bloom.flush()
-    sys.stderr.write("Set and bloom filter of %i-mers created (%i k-mers considered, %i unique)\n" % (kmer, count, len(simple)))
-    sys.stderr.write("Using Bloom filter with capacity %i and error rate %r\n" % (capacity, error_rate))
-    sys.stderr.write("Building filters took %0.1fs\n" % (time.time() - t0))
-    return simple, bloom
-
-def go(input, output, format, paired, linear_refs, circular_refs, kmer, mismatches, inserts, deletions):
-    if paired:
+            keys = np.zeros(0, kmer_key_dtype(kmer))
+        table = KmerTable(keys, kmer, seeds=seeds, minimizers=minimizers)
+    del keys
+    timings["sort"] += time.time() - t1
+    if seeds:
+        sys.stderr.write("Table of canonical %i-mers under %i spaced seeds created (%i k-mers considered, %i unique keys)\n" \
+                         % (kmer, len(seeds), count, len(table)))
+    elif minimizers:
+        sys.stderr.write("Table of canonical %i-mer minimizers of windows of %i created (%i k-mers considered, %i unique minimizers)\n" \
+                         % (kmer, minimizers, count, len(table)))
+    else:
+        sys.stderr.write("Table of canonical %i-mers created (%i k-mers considered, %i unique)\n" % (kmer, count, len(table)))
+    if colours:
+        sys.stderr.write("Table has %i reference sets, with %i colours (combinations of sets)\n" \
+                         % (len(table.names), len(table.colour_sets)))
+    sys.stderr.write("Sorted table uses %0.1f bytes per k-mer\n" \
+                     % (float(table.nbytes) / max(1, len(table))))
+    taken = time.time() - t0
+    sys.stderr.write("Building table took %0.1fs for %i reference bases (%s)\n"
+                     % (taken, total, ", ".join("%s %0.1fs" % (stage, timings[stage])
+                                                for stage in BUILD_STAGES)))
+    return table
+
+def make_bloom(table, backend="builtin", error_rate=0.01, chunk=1000000):
+    """Create a Bloom filter holding the k-mers from a KmerTable.
+
+    The backend is one of the BLOOM_BACKENDS names.
+    """
+    #Using 5e-06 with dablooms was close to a set for my example, both
+    #in run time (a fraction more) and the number of reads kept (9528
+    #vs 8058 with sets).
+    t0 = time.time()
+    bloom = BLOOM_BACKENDS[backend](len(table), error_rate, table.kmer)
+    for start in range(0, len(table), chunk):
+        bloom.add(table.keys[start:start + chunk])
+    sys.stderr.write("Using %s Bloom filter with capacity %i and error rate %r, "
+                     "%0.1f bytes per k-mer, took %0.1fs\n"
+                     % (backend, len(table), error_rate,
+                        float(bloom.nbytes) / max(1, len(table)), time.time() - t0))
+    return bloom
+
+INDEX_MAGIC = "blooming_reads k-mer index"
+INDEX_FORMAT = 1
+#Settings recorded in an index header, which must match to combine indexes
+INDEX_SETTINGS = ["kmer", "mismatches", "inserts", "deletions", "spaced_seeds", "minimizers"]
+
+def reference_details(filenames):
+    """List of dicts describing the reference files, with MD5 checksums."""
+    answer = []
+    for filename in filenames or []:
+        md5 = hashlib.md5()
+        handle = open(filename, "rb")
+        while True:
+            data = handle.read(1 << 20)
+            if not data:
+                break
+            md5.update(data)
+        handle.close()
+        answer.append({"filename": os.path.abspath(filename),
+                       "size": os.path.getsize(filename),
+                       "mtime": os.path.getmtime(filename),
+                       "md5": md5.hexdigest()})
+    return answer
+
+def save_index(index_filename, table, settings, linear, circular):
+    """Write the k-mer table (and settings) to a memory mappable index file.
+
+    This is a magic line including the format version, a line of JSON
+    describing the settings, references and arrays, then the raw arrays
+    (each starting at a 64 byte boundary). The references are given as
+    lists of dicts from reference_details.
+
+    The file is written under a temporary name and then renamed, so an
+    existing index can be replaced while it is memory mapped.
+    """
+    arrays = [("keys", table.keys), ("bitmap", table.bitmap)]
+    if table.words > 1:
+        arrays.append(("first", table.first))
+    header = dict(settings)
+    if table.colours is not None:
+        arrays.append(("colours", table.colours))
+        header["reference_sets"] = table.names
+        header["colour_sets"] = table.colour_sets
+    header["version"] = VERSION
+    #Number of spaced seed masks (see make_seeds), or zero
+    header["seeds"] = len(table.seeds) if table.seeds != [None] else 0
+    header["linear"] = linear
+    header["circular"] = circular
+    header["arrays"] = []
+    offset = 0
+    for name, array in arrays:
+        header["arrays"].append({"name": name, "dtype": array.dtype.str,
+                                 "shape": array.shape, "offset": offset})
+        offset += (array.nbytes + 63) // 64 * 64
+    handle = open(index_filename + ".tmp", "wb")
+    handle.write("%s\t%i\n" % (INDEX_MAGIC, INDEX_FORMAT))
+    handle.write(json.dumps(header, sort_keys=True) + "\n")
+    handle.write("\0" * (-handle.tell() % 64))
+    for name, array in arrays:
+        handle.write(np.ascontiguousarray(array).tostring())
+        handle.write("\0" * (-handle.tell() % 64))
+    handle.close()
+    os.rename(index_filename + ".tmp", index_filename)
+    sys.stderr.write("Saved %i k-mers to index %s\n" % (len(table), index_filename))
+
+def load_index_header(index_filename):
+    """Read the settings and reference details from an index file.
+
+    Returns a dictionary (from the JSON header line), with the offset of
+    the start of the arrays added as "start".
+    """
+    handle = open(index_filename, "rb")
+    magic = handle.readline()
+    if not magic.startswith(INDEX_MAGIC + "\t"):
+        sys_exit("File %s is not a blooming_reads index" % index_filename)
+    if int(magic.rstrip("\n").split("\t")[1]) != INDEX_FORMAT:
+        sys_exit("Index %s is in format %s, this version uses format %i, please rebuild it" \
+                 % (index_filename, magic.rstrip("\n").split("\t")[1], INDEX_FORMAT))
+    header = json.loads(handle.readline())
+    header["start"] = handle.tell() + (-handle.tell() % 64)
+    handle.close()
+    return header
+
+def load_index(index_filename):
+    """Load the k-mer table (memory mapped) and settings from an index file.
+
+    Returns a KmerTable and a dictionary of the settings and reference
+    details recorded in the index.
+    """
+    header = load_index_header(index_filename)
+    start = header["start"]
+    arrays = dict()
+    for details in header["arrays"]:
+        shape = tuple(details["shape"])
+        if not np.prod(shape):
+            #Can't memory map an empty array
+            arrays[details["name"]] = np.zeros(shape, details["dtype"])
+        else:
+            arrays[details["name"]] = np.memmap(index_filename, details["dtype"], "r",
+                                                start + details["offset"], shape)
+    seeds = None
+    if header.get("seeds"):
+        seeds = make_seeds(header["kmer"], header["seeds"])
+    table = KmerTable(arrays["keys"], header["kmer"], arrays.get("first"), arrays["bitmap"], seeds,
+                      arrays.get("colours"), header.get("colour_sets"), header.get("reference_sets"),
+                      header.get("minimizers"))
+    sys.stderr.write("Loaded %i canonical %i-mers from index %s\n" \
+                     % (len(table), header["kmer"], index_filename))
+    return table, header
+
+def extend_index(table, header, linear_refs, circular_refs, other_indexes=None):
+    """Add the k-mers from more references and/or other indexes to a table.
+
+    Takes a KmerTable and header as from load_index. Only references not
+    already recorded in the header (by MD5 checksum) are hashed, using
+    the k-mer settings from the header. Any other index files must have
+    been built with the same settings. Returns the combined KmerTable,
+    and a copy of the header listing all the references.
+    """
+    header = dict(header)
+    settings = dict((key, header.get(key)) for key in INDEX_SETTINGS)
+    new_refs = dict()
+    for kind, filenames in [("linear", linear_refs), ("circular", circular_refs)]:
+        header[kind] = list(header[kind])
+        known = set(d["md5"] for d in header[kind])
+        new_refs[kind] = []
+        for details in reference_details(filenames):
+            if details["md5"] in known:
+                sys.stderr.write("Reference %s is already in the index, skipping it\n" \
+                                 % details["filename"])
+                continue
+            known.add(details["md5"])
+            header[kind].append(details)
+            new_refs[kind].append(details["filename"])
+    tables = [table]
+    if new_refs["linear"] or new_refs["circular"]:
+        tables.append(build_filter(new_refs["linear"], new_refs["circular"],
+                                   settings["kmer"], settings["mismatches"],
+                                   settings["inserts"], settings["deletions"],
+                                   spaced_seeds=bool(settings["spaced_seeds"]),
+                                   colours=table.colours is not None,
+                                   minimizers=settings["minimizers"]))
+    for other_index in other_indexes or []:
+        other_table, other_header = load_index(other_index)
+        for key in INDEX_SETTINGS:
+            if other_header.get(key) != settings[key]:
+                sys_exit("Index %s has %s %r, not %r, so can't be combined" \
+                         % (other_index, key, other_header.get(key), settings[key]))
+        if (other_table.colours is None) != (table.colours is None):
+            sys_exit("Index %s can't be combined with this one, as only one "
+                     "has reference sets (from --bins)" % other_index)
+        for kind in ["linear", "circular"]:
+            known = set(d["md5"] for d in header[kind])
+            header[kind].extend(d for d in other_header[kind] if d["md5"] not in known)
+        tables.append(other_table)
+    if len(tables) == 1:
+        return table, header
+    t0 = time.time()
+    if table.colours is None:
+        keys = np.unique(np.concatenate([t.keys for t in tables]))
+        combined = KmerTable(keys, table.kmer, seeds=table.seeds, minimizers=table.minimizers)
+    else:
+        #Expand each table to (key, reference set) pairs, and recolour
+        keys = []
+        sets = []
+        names = []
+        for t in tables:
+            position, members = t.colour_members(t.colours)
+            keys.append(t.keys[position])
+            sets.append(members + len(names))
+            names.extend(reference_set_names(t.names, names))
+        keys, colours, colour_sets = colour_keys(np.concatenate(keys), np.concatenate(sets), len(names))
+        combined = KmerTable(keys, table.kmer, seeds=table.seeds, colours=colours,
+                             colour_sets=colour_sets, names=names, minimizers=table.minimizers)
+    sys.stderr.write("Combined %s k-mers into %i unique, took %0.1fs\n" \
+                     % (" + ".join(str(len(t)) for t in tables), len(combined),
+                        time.time() - t0))
+    return combined, header
+
+def check_index_references(index_filename, header, linear_refs, circular_refs):
+    """Exit with an error if the references differ from those used for the index.
+
+    If no references are given, checks those recorded in the index (where
+    they are still present), only computing checksums if the file size or
+    modification time has changed.
+    """
+    for kind, given in [("linear", linear_refs), ("circular", circular_refs)]:
+        stored = header[kind]
+        known = dict(((d["filename"], d["size"], d["mtime"]), d["md5"]) for d in stored)
+        if linear_refs or circular_refs:
+            filenames = given or []
+        else:
+            filenames = [d["filename"] for d in stored]
+            for filename in filenames:
+                if not os.path.isfile(filename):
+                    sys.stderr.write("Warning: Can't check index %s against missing reference %s\n" \
+                                     % (index_filename, filename))
+            filenames = [f for f in filenames if os.path.isfile(f)]
+            stored = [d for d in stored if d["filename"] in filenames]
+        checksums = []
+        for filename in filenames:
+            key = (os.path.abspath(filename), os.path.getsize(filename), os.path.getmtime(filename))
+            if key in known:
+                checksums.append(known[key])
+            else:
+                checksums.append(reference_details([filename])[0]["md5"])
+        if sorted(checksums) != sorted(d["md5"] for d in stored):
+            sys_exit("Index %s was built from different %s references, please rebuild it" \
+                     % (index_filename, kind))
+
+def record_wanted(upper_seqs, kmer, table, bloom=None, min_hits=1, min_fraction=0.0):
+    """Do the reads in this record (e.g. a pair) have enough k-mers in the filter?
+
+    See record_hits, by default a single k-mer hit is enough.
+    """
+    return record_hits(upper_seqs, kmer, table, bloom, min_hits, min_fraction)[0]
+
+def record_hits(upper_seqs, kmer, table, bloom=None, min_hits=1, min_fraction=0.0, stats=None):
+    """Count the k-mer hits for a record (e.g. a pair), stopping once decided.
+
+    A window is a hit if its k-mer is in the table (under any of its
+    spaced seeds). The record is wanted with at least min_hits hits, which
+    must also be at least min_fraction of its windows (those without
+    ambiguous bases). Counting stops as soon as the record is wanted, or
+    there are too few windows left for it to be. Returns a boolean and
+    the number of hits counted. If given a stats dictionary, the lookup
+    counts are added to it (as in KmerTable.contains), along with the
+    time spent working out the k-mer codes (hash).
+
+    If the table holds window minimizers, the record is checked using
+    batch_hits instead (sampling its k-mers the same way). If the table
+    holds its k-mer strings (see KmerTable.build_strings), a single hit
+    must be enough, and the windows are sliced out of the reads and
+    looked up in those instead, without the Bloom filter (counted as
+    string_lookups and string_hits in the stats).
+    """
+    if table.minimizers:
+        hits, windows = batch_hits([upper_seqs], kmer, table, bloom, stats)
+        return bool(records_wanted(hits, windows, min_hits, min_fraction)[0]), int(hits[0])
+    if table.strings is not None:
+        if min_hits != 1 or min_fraction:
+            raise ValueError("K-mer strings can only be used when a single hit is enough")
+        strings = table.strings
+        hits = checked = 0
+        for upper_seq in upper_seqs:
+            for i in range(len(upper_seq) - kmer + 1):
+                if upper_seq[i:i + kmer] in strings:
+                    hits = 1
+                    checked += i + 1
+                    break
+            else:
+                checked += max(0, len(upper_seq) - kmer + 1)
+            if hits:
+                break
+        if stats is not None:
+            stats["string_lookups"] += checked
+            stats["string_hits"] += hits
+        return bool(hits), hits
+    def candidates(upper_seq):
+        #The table's prefix bitmap rejects most k-mers cheaply, leaving
+        #a list of windows each given as a tuple of codes (one per seed)
+        t0 = time.time()
+        if len(table.seeds) == 1:
+            codes = kmer_codes(upper_seq, kmer)
+        else:
+            codes = [kmer_codes(upper_seq, kmer, seed) for seed in table.seeds]
+        if stats is not None:
+            stats["hash"] += time.time() - t0
+        if len(table.seeds) == 1:
+            return len(codes), [(code,) for code in table.candidates(codes)]
+        return len(codes[0]), [c for c in (table.candidates(window) for window in zip(*codes)) if c]
+    if min_hits > 1 or min_fraction:
+        #Look at all the windows first, to know how many hits are needed
+        #and when that is no longer possible
+        reads = [candidates(upper_seq) for upper_seq in upper_seqs]
+        needed = max(min_hits, int(math.ceil(min_fraction * sum(w for w, c in reads))))
+        remaining = sum(len(c) for w, c in reads)
+    else:
+        reads = (candidates(upper_seq) for upper_seq in upper_seqs)
+        needed = 1
+        remaining = None
+    hits = checked = passed = 0
+    decided = False
+    for windows, window_codes in reads:
+        for codes in window_codes:
+            if remaining is not None:
+                if hits + remaining < needed:
+                    decided = True
+                    break
+                remaining -= 1
+            #Check the Bloom filter (if used) before the table's binary search
+            for code in codes:
+                checked += 1
+                if bloom is None or code in bloom:
+                    passed += 1
+                    if code in table:
+                        hits += 1
+                        break
+            if hits >= needed:
+                decided = True
+                break
+        if decided:
+            break
+    if stats is not None:
+        stats["bitmap_passed"] += checked
+        if bloom is not None:
+            stats["bloom_passed"] += passed
+        stats["table_hits"] += hits
+    return hits >= needed, hits
+
+def filter_records(seqs, kmer, table, bloom, batch, min_hits=1, min_fraction=0.0, stats=None):
+    """Is each record (list of sequences) wanted, and its number of k-mer hits.
+
+    Returns a list or array of booleans, and one of hit counts. In the
+    batch mode all the windows are counted, otherwise counting stops once
+    each record is decided (see record_hits). Any stats dictionary is
+    updated as in batch_hits. Without the batch mode the hash time is
+    just working out the k-mer codes of each read, with the rest timed as
+    probe, and with k-mer strings there are no codes so it is all probe.
+    Tables of window minimizers always use the batch mode.
+    """
+    if batch or table.minimizers:
+        hits, windows = batch_hits(seqs, kmer, table, bloom, stats)
+        return records_wanted(hits, windows, min_hits, min_fraction), hits
+    t0 = time.time()
+    hashing = stats["hash"] if stats is not None else 0.0
+    results = [record_hits(upper_seqs, kmer, table, bloom, min_hits, min_fraction, stats)
+               for upper_seqs in seqs]
+    if stats is not None:
+        #Hashing was timed within record_hits
+        stats["probe"] += time.time() - t0 - (stats["hash"] - hashing)
+    return [wanted for wanted, hits in results], [hits for wanted, hits in results]
+
+def filter_block(data, seqs, bounds, kmer, table, bloom, batch, min_hits=1, min_fraction=0.0):
+    """Filter a block of records (as from record_blocks).
+
+    Returns the kept records as a string, a stats dictionary (see
+    new_stats) and a histogram of the hits per record (see hit_histogram).
+    If either of a pair of reads matched, both are kept.
+    """
+    stats = new_stats()
+    wanted, hits = filter_records(seqs, kmer, table, bloom, batch, min_hits, min_fraction, stats)
+    count_records(stats, seqs, wanted)
+    return kept_records(data, bounds, wanted), stats, hit_histogram(hits)
+
+def filter_pairs(records, kmer, table, bloom, batch, min_hits=1, min_fraction=0.0):
+    """Filter a list of pairs split over two files (as from paired_files_iterator).
+
+    Returns a tuple of two strings holding the kept first and second
+    reads, plus the stats and histogram as for filter_block.
+    """
+    stats = new_stats()
+    seqs = [upper_seqs for upper_seqs, raws in records]
+    wanted, hits = filter_records(seqs, kmer, table, bloom, batch, min_hits, min_fraction, stats)
+    count_records(stats, seqs, wanted)
+    kept = [raws for (upper_seqs, raws), keep in zip(records, wanted) if keep]
+    return ("".join(raws[0] for raws in kept), "".join(raws[1] for raws in kept)), \
+        stats, hit_histogram(hits)
+
+def kept_records(data, bounds, wanted):
+    """String of the wanted records, given their offsets in the raw data.
+
+    Runs of consecutive wanted records are taken as a single slice.
+    """
+    pieces = []
+    run_start = run_end = None
+    for (start, end), keep in zip(bounds, wanted):
+        if not keep:
+            continue
+        if start == run_end:
+            run_end = end
+        else:
+            if run_end is not None:
+                pieces.append(data[run_start:run_end])
+            run_start, run_end = start, end
+    if run_end is not None:
+        pieces.append(data[run_start:run_end])
+    return "".join(pieces)
+
+def records_block(records):
+    """Join a list of (upper_seqs, raw_reads) records into a block.
+
+    Returns the raw records as one string, the list of sequences for
+    each record, and the offsets of each record in the string (as from
+    record_blocks).
+    """
+    seqs = [upper_seqs for upper_seqs, raw_reads in records]
+    data = "".join(raw_reads for upper_seqs, raw_reads in records)
+    bounds = []
+    end = 0
+    for upper_seqs, raw_reads in records:
+        bounds.append((end, end + len(raw_reads)))
+        end += len(raw_reads)
+    return data, seqs, bounds
+
+def bin_records(data, seqs, bounds, format, kmer, table, bloom=None, report=False,
+                min_hits=1, min_fraction=0.0):
+    """Sort a block of records into bins by reference set (see batch_bin_counts).
+
+    Records are put in the bin of every reference set they have enough
+    k-mer hits to (see records_wanted). Returns a tuple of a dict of
+    reference set index to a string of the records in that bin, a string
+    of report lines (if wanted) giving each binned record's name and hit
+    counts to each set, and arrays of the number of records and hits for
+    each reference set, plus the stats and histogram as for filter_block.
+    """
+    stats = new_stats()
+    counts, hits, windows = batch_bin_counts(seqs, kmer, table, bloom, stats)
+    hit = records_wanted(counts, windows[:, None], min_hits, min_fraction)
+    binned = dict()
+    for s in np.flatnonzero(hit.any(axis=0)).tolist():
+        binned[s] = "".join(data[bounds[i][0]:bounds[i][1]]
+                            for i in np.flatnonzero(hit[:, s]).tolist())
+    lines = []
+    kept = np.flatnonzero(hit.any(axis=1)).tolist()
+    if report:
+        for i in kept:
+            raw = data[bounds[i][0]:bounds[i][1]]
+            if format == "sam":
+                name = raw[:raw.find("\t")]
+            elif format == "bam":
+                name = raw[36:raw.find("\0", 36)]
+            else:
+                name = _read_name(raw)
+            lines.append("%s\t%s\n" % (name, "\t".join(str(c) for c in counts[i].tolist())))
+    count_records(stats, seqs, hit.any(axis=1))
+    return (binned, "".join(lines), hit.sum(axis=0), counts.sum(axis=0)), \
+        stats, hit_histogram(hits)
+
+def raw_chunks(handle, format, paired, size, handle2=None):
+    """Split the input into strings holding up to the given number of whole records.
+
+    Used to hand out work to the worker processes. Any SAM header is
+    discarded (as in the SAM parsers). If given a second handle (pairs
+    split over two files), yields tuples of two strings holding the same
+    reads.
+    """
+    if handle2 is not None:
+        for chunk in batched(paired_files_iterator(handle, handle2, format), size):
+            yield "".join(raws[0] for upper_seqs, raws in chunk), \
+                "".join(raws[1] for upper_seqs, raws in chunk)
+    elif format in _scanners:
+        for data, seqs, bounds in record_blocks(handle, format, paired, size):
+            if format == "sam":
+                #Might be header lines between the records
+                yield "".join(data[start:end] for start, end in bounds)
+            else:
+                yield data[bounds[0][0]:bounds[-1][1]]
+    else:
+        if paired:
+            #Keep the pairs together
+            size *= 2
+        chunk = []
+        count = 0
+        for line in handle:
+            if line[0] == ">":
+                if count == size:
+                    yield "".join(chunk)
+                    chunk = []
+                    count = 0
+                count += 1
+            chunk.append(line)
+        if chunk:
+            yield "".join(chunk)
+
+#Filter settings for the worker processes, set in go() before the pool
+#is created so that the (forked) workers share them with the parent.
+_worker_state = dict()
+
+def filter_raw_chunk(raw):
+    """Parse and filter a string of whole records (called in a worker process).
+
+    Returns the filter_block tuple, or for pairs split over two files
+    (given as a tuple of two strings) the filter_pairs tuple, or when
+    binning the bin_records tuple. The parsing time is included in the
+    stats.
+    """
+    state = _worker_state
+    thresholds = state["min_hits"], state["min_fraction"]
+    t0 = time.time()
+    if isinstance(raw, tuple):
+        records = list(paired_files_iterator(StringIO(raw[0]), StringIO(raw[1]), state["format"]))
+        parse_time = time.time() - t0
+        result = filter_pairs(records, state["kmer"], state["table"], state["bloom"],
+                              state["batch"], *thresholds)
+        result[1]["parse"] += parse_time
+        return result
+    if state["format"] in _scanners:
+        #Whole records, so can scan it in one go
+        seqs, bounds, end = _scanners[state["format"]](raw, 0, state["paired"], len(raw))
+    else:
+        records = state["read_iterator"](StringIO(raw))
+        if not state["paired"]:
+            records = (([upper_seq], raw_read) for upper_seq, raw_read in records)
+        raw, seqs, bounds = records_block(list(records))
+    parse_time = time.time() - t0
+    if state["bins"]:
+        result = bin_records(raw, seqs, bounds, state["format"], state["kmer"],
+                             state["table"], state["bloom"], state["bin_report"], *thresholds)
+    else:
+        result = filter_block(raw, seqs, bounds, state["kmer"], state["table"], state["bloom"],
+                              state["batch"], *thresholds)
+    result[1]["parse"] += parse_time
+    return result
+
+def go(input, output, format, paired, linear_refs, circular_refs, kmer, mismatches, inserts, deletions, batch=0, threads=1,
+       index_to_save=None, index_to_load=None, bloom_backend="builtin", spaced_seeds=False,
+       input2=None, output2=None, index_to_update=None, indexes_to_merge=None,
+       bins=None, bin_report=None, min_hits=1, min_fraction=0.0, stats_file=None,
+       minimizers=None, kmer_strings=False):
+    """Filter the reads.
+
+    For pairs split over two files, input and output are for the first
+    reads, and input2 and output2 for the second reads.
+
+    If given a bins prefix, each reference file is a reference set, and
+    instead of a single output file the records are written to a file
+    for each reference set they have k-mer hits to (named using the
+    prefix, see reference_set_names), optionally with a report file of
+    the hit counts (see bin_records).
+
+    Records are kept (or binned) if they have at least min_hits k-mer
+    hits, which must also be at least min_fraction of their k-mers (see
+    record_hits). A histogram of the hits per record is shown at the end.
+
+    The time spent in each of the RUN_STAGES, the reads and bases per
+    second, Bloom filter false positives and peak memory are also shown
+    at the end. If given a stats filename, these are written to it as
+    JSON, one line per batch of records (see new_stats) then a summary.
+
+    If given a window size for minimizers, only the window minimizers of
+    the references and reads are used (see window_minimizers).
+
+    With kmer_strings, the records are checked one at a time by looking
+    up their k-mers as strings (see KmerTable.build_strings) rather than
+    as codes, without a Bloom filter. This needs batch zero, exact k-mers
+    (no spaced seeds or minimizers) and a single hit to keep a record.
+
+    If updating an index, the k-mers from the given references and any
+    indexes to merge are added to it (see extend_index), and it is saved
+    again (under index_to_save if given, otherwise replacing it).
+    """
+    if (index_to_save or index_to_update) and not input:
+        #Just building the index
+        read_iterator = None
+    elif input2:
+        read_iterator = None
+    elif paired:
         if format=="fasta":
-            #read_iterator = fasta_batched_iterator
-            raise NotImplementedError
+            read_iterator = fasta_batched_iterator
         elif format=="fastq":
             read_iterator = fastq_batched_iterator
         elif format=="sam":
             read_iterator = sam_batched_iterator
+        elif format=="bam":
+            #Only read in blocks (see record_blocks)
+            read_iterator = None
         else:
             sys_exit("Paired read format %r not recognised" % format)
     else:
@@ -363,90 +2805,240 @@ def go(input, output, format, paired, linear_refs, circular_refs, kmer, mismatch
             read_iterator = fastq_iterator
         elif format=="sam":
             read_iterator = sam_iterator
+        elif format=="bam":
+            read_iterator = None
         else:
             sys_exit("Read format %r not recognised" % format)
 
-    #Create new bloom file,
-    handle, bloom_filename = tempfile.mkstemp(prefix="bloom-", suffix=".bin")
-    #sys.stderr.write("Using %s\n" %  bloom_filename)
-    simple, bloom = build_filter(bloom_filename, linear_refs, circular_refs,
-                                 kmer, mismatches, inserts, deletions)
+    if index_to_load:
+        table, header = load_index(index_to_load)
+        check_index_references(index_to_load, header, linear_refs, circular_refs)
+        kmer = header["kmer"]
+    elif index_to_update:
+        table, header = load_index(index_to_update)
+        table, header = extend_index(table, header, linear_refs, circular_refs, indexes_to_merge)
+        kmer = header["kmer"]
+        save_index(index_to_save or index_to_update, table,
+                   dict((key, header.get(key)) for key in INDEX_SETTINGS),
+                   header["linear"], header["circular"])
+    else:
+        table = build_filter(linear_refs, circular_refs,
+                             kmer, mismatches, inserts, deletions,
+                             spaced_seeds=spaced_seeds, colours=bool(bins),
+                             minimizers=minimizers)
+        if index_to_save:
+            save_index(index_to_save, table,
+                       dict(kmer=kmer, mismatches=mismatches, inserts=inserts, deletions=deletions,
+                            spaced_seeds=spaced_seeds, minimizers=minimizers),
+                       reference_details(linear_refs), reference_details(circular_refs))
+    if bins and table.colours is None:
+        sys_exit("Index %s has no reference sets, rebuild it with --bins"
+                 % (index_to_load or index_to_update))
+    if index_to_save or index_to_update:
+        if not input:
+            #Just building the index
+            return
+    if kmer_strings:
+        if batch or bins or table.seeds != [None] or table.minimizers \
+                or min_hits != 1 or min_fraction:
+            sys_exit("K-mer strings are only used checking one record at a time, "
+                     "for exact k-mers with a single hit needed")
+        #Built before any worker processes are forked
+        t0 = time.time()
+        table.build_strings()
+        bloom = None
+        sys.stderr.write("Checking reads one at a time against %i k-mer strings, took %0.1fs\n"
+                         % (len(table.strings), time.time() - t0))
+    elif bloom_backend and bloom_backend != "none":
+        bloom = make_bloom(table, bloom_backend)
+    else:
+        bloom = None
+        sys.stderr.write("Not using a Bloom filter, just the sorted table\n")
+    if batch:
+        sys.stderr.write("Checking reads in batches of %i records\n" % batch)
 
     #Now loop over the input, write the output
-    if output:
-        out_handle = open(output, "w")
+    in_handle = open_input(input)
+    if input2:
+        in_handle2 = open_input(input2)
+        out_handle2 = open_output(output2, threads)
     else:
-        out_handle = sys.stdout
+        in_handle2 = None
 
-    if input:
-        in_handle = open(input)
+    if format == "bam":
+        #Copied unchanged to the output, which is always BGZF compressed
+        header = read_bam_header(in_handle)
+    elif format == "sam":
+        #Copied unchanged to the output, or if there was none a minimal one
+        header, in_handle = read_sam_header(in_handle)
+        header = header or "@HD\tVN:1.4\tSO:unknown\n"
+    else:
+        header = ""
+    if bins:
+        out_handle = None
+        bin_handles = [open_output("%s%s.%s" % (bins, name, format), threads, format == "bam")
+                       for name in table.names]
+        for handle in bin_handles:
+            handle.write(header)
+        if bin_report:
+            report_handle = open(bin_report, "w")
+            report_handle.write("#name\t%s\n" % "\t".join(table.names))
+    elif output or format == "bam":
+        out_handle = open_output(output, threads, format == "bam")
+        out_handle.write(header)
     else:
-        in_handle = sys.stdin
+        out_handle = sys.stdout
+        out_handle.write(header)
 
-    if format=="sam":
-        out_handle.write("@HD\t1.4\tSO:unknown\n")
+    if stats_file:
+        stats_handle = open(stats_file, "w")
+    else:
+        stats_handle = None
 
-    in_count = 0
-    out_count = 0
+    histogram = np.zeros(len(HIT_BUCKETS), np.int64)
+    totals = new_stats()
+    #Time spent reading the input in this process, added to the next batch
+    reading = new_stats()
+    batches = 0
     t0 = time.time()
-    filter_time = 0
-    if paired:
-        #If find a possible match in either of a pair of reads
-        #keep them both (likewise for any multi-framgent set).
-        for upper_seqs, raw_reads in read_iterator(in_handle):
-            in_count += len(upper_seqs)
-            wanted = False
-            filter_t0 = time.time()
-            for upper_seq in upper_seqs:
-                for i in range(0, len(upper_seq) - kmer):
-                    fragment = upper_seq[i:i+kmer]
-                    if fragment in bloom and fragment in simple:
-                        wanted = True
-                        #Don't need to check rest of this read
-                        break
-                if wanted:
-                    #Don't need to check the other reads
-                    break
-            filter_time += time.time() - filter_t0
-            if wanted:
-                out_handle.write(raw_reads)
-                out_count += len(upper_seqs)
-            if in_count % 100000 == 0:
-                sys.stderr.write("Processed %i reads, kept %i (%0.1f%%), taken %0.1fs (of which %0.1fs in filter)\n" \
-                                 % (in_count, out_count, (100.0*out_count)/in_count, time.time()-t0, filter_time))
+    if threads > 1:
+        #Fork the workers now the filters are built
+        _worker_state.update(read_iterator=read_iterator, format=format, paired=paired,
+                             batch=batch, kmer=kmer,
+                             table=table, bloom=bloom,
+                             bins=bool(bins), bin_report=bool(bin_report),
+                             min_hits=min_hits, min_fraction=min_fraction)
+        pool = multiprocessing.Pool(threads)
+        #Limit how many chunks are queued up, to bound the memory used,
+        #and write the results out in the order the chunks were queued
+        chunks = timed(raw_chunks(in_handle, format, paired, batch or 10000, in_handle2),
+                       reading, "parse")
+        results = ordered_results(pool, filter_raw_chunk, chunks, 2 * threads)
+    elif in_handle2 is not None:
+        #Pairs split over two files, read in step (keeping both reads if
+        #either matched), written to the matching output files
+        chunks = timed(batched(paired_files_iterator(in_handle, in_handle2, format), batch or 10000),
+                       reading, "parse")
+        results = (filter_pairs(chunk, kmer, table, bloom, batch, min_hits, min_fraction)
+                   for chunk in chunks)
     else:
-        for upper_seq, raw_read in read_iterator(in_handle):
-            in_count += 1
-            wanted = False
-            filter_t0 = time.time()
-            for i in range(0, len(upper_seq) - kmer):
-                fragment = upper_seq[i:i+kmer]
-                #Can modify code to allow this syntax, see:
-                #https://github.com/bitly/dablooms/pull/50
-                #if bloom.check(fragment) and fragment in simple:
-                if fragment in bloom and fragment in simple:
-                    wanted = True
-                    #Don't need to check rest of read
-                    break
-            filter_time += time.time() - filter_t0
-            if wanted:
-                out_handle.write(raw_read)
-                out_count += 1
-            if in_count% 100000 == 0:
-                sys.stderr.write("Processed %i reads, kept %i (%0.1f%%), taken %0.1fs (of which %0.1fs in filter)\n" \
-                                 % (in_count, out_count, (100.0*out_count)/in_count, time.time()-t0, filter_time))
+        if format in _scanners:
+            #Work on blocks of records straight from the input buffer, and
+            #write out the kept ones as slices of it
+            blocks = record_blocks(in_handle, format, paired, batch or 10000)
+        else:
+            if paired:
+                records = read_iterator(in_handle)
+            else:
+                records = (([upper_seq], raw_read) for upper_seq, raw_read in read_iterator(in_handle))
+            blocks = (records_block(chunk) for chunk in batched(records, batch or 10000))
+        blocks = timed(blocks, reading, "parse")
+        if bins:
+            results = (bin_records(data, seqs, bounds, format, kmer, table, bloom, bool(bin_report),
+                                   min_hits, min_fraction)
+                       for data, seqs, bounds in blocks)
+        else:
+            #If either of a pair of reads matched, keep them both
+            results = (filter_block(data, seqs, bounds, kmer, table, bloom, batch,
+                                    min_hits, min_fraction)
+                       for data, seqs, bounds in blocks)
+    if bins:
+        #Each record goes to the bin of every reference set it has hits to
+        set_records = np.zeros(len(table.names), np.int64)
+        set_hits = np.zeros(len(table.names), np.int64)
+    for kept, chunk_stats, chunk_histogram in results:
+        write_t0 = time.time()
+        if bins:
+            binned, lines, chunk_records, chunk_hits = kept
+            for s, text in binned.items():
+                bin_handles[s].write(text)
+            if bin_report:
+                report_handle.write(lines)
+            set_records += chunk_records
+            set_hits += chunk_hits
+        elif in_handle2 is not None:
+            out_handle.write(kept[0])
+            out_handle2.write(kept[1])
+        else:
+            out_handle.write(kept)
+        chunk_stats["write"] += time.time() - write_t0
+        chunk_stats["parse"] += reading["parse"]
+        reading["parse"] = 0.0
+        histogram += chunk_histogram
+        old_count = totals["reads"]
+        add_stats(totals, chunk_stats)
+        batches += 1
+        if stats_handle is not None:
+            chunk_stats.update(type="batch", batch=batches, elapsed=time.time() - t0)
+            stats_handle.write(json.dumps(chunk_stats, sort_keys=True) + "\n")
+        if totals["reads"] // 100000 != old_count // 100000:
+            in_count = totals["reads"]
+            out_count = totals["kept_reads"]
+            sys.stderr.write("Processed %i reads, %s %i (%0.1f%%), taken %0.1fs (%0.0f reads/s)\n" \
+                             % (in_count, "binned" if bins else "kept", out_count,
+                                (100.0*out_count)/in_count, time.time()-t0,
+                                in_count / (time.time()-t0)))
+    if threads > 1:
+        pool.close()
+        pool.join()
+    if bins:
+        for handle in bin_handles:
+            handle.close()
+        if bin_report:
+            report_handle.close()
+        for name, records, hits in zip(table.names, set_records.tolist(), set_hits.tolist()):
+            sys.stderr.write("Reference set %s: %i records binned, %i k-mer hits\n" % (name, records, hits))
     if input:
         in_handle.close()
-    if output:
+    if not bins and (output or format == "bam"):
         out_handle.close()
+    if input2:
+        in_handle2.close()
+        out_handle2.close()
     total_time = time.time() - t0
-    sys.stderr.write("Running filter took %0.1fs, overhead %0.1fs, total %0.1fs\n" \
-                         % (filter_time, total_time - filter_time, total_time))
-
-    #Remove the bloom file
-    del bloom
-    os.remove(bloom_filename)
-    sys.stderr.write("Kept %i out of %i reads (%0.1f%%)\n" % (out_count, in_count, out_count*100.0/in_count))
+    in_count = totals["reads"]
+    out_count = totals["kept_reads"]
+    #The k-mer strings are looked up directly, so there is no hash stage
+    stages = [stage for stage in RUN_STAGES if not (kmer_strings and stage == "hash")]
+    sys.stderr.write("Time spent %s%s, total %0.1fs\n"
+                     % (", ".join("%s %0.1fs" % (stage, totals[stage]) for stage in stages),
+                        " (summed over %i workers)" % threads if threads > 1 else "",
+                        total_time))
+    sys.stderr.write("Processed %0.0f reads/s, %0.0f bases/s\n"
+                     % (in_count / max(total_time, 1e-6), totals["bases"] / max(total_time, 1e-6)))
+    #Bloom filter false positives are k-mers passing it which the table rejects
+    false_positives = totals["bloom_passed"] - totals["table_hits"]
+    if bloom is not None:
+        negatives = totals["bitmap_passed"] - totals["table_hits"]
+        sys.stderr.write("Bloom filter passed %i of %i k-mers not in the table (%0.2f%% false positives)\n"
+                         % (false_positives, negatives, 100.0 * false_positives / max(1, negatives)))
+        #Removes the dablooms file
+        bloom.close()
+    memory, worker_memory = peak_memory()
+    if memory is not None:
+        if threads > 1:
+            sys.stderr.write("Peak memory %0.1f MB, largest worker %0.1f MB\n" % (memory, worker_memory))
+        else:
+            sys.stderr.write("Peak memory %0.1f MB\n" % memory)
+    if batch or table.minimizers:
+        sys.stderr.write("K-mer hits per record:\n")
+    else:
+        sys.stderr.write("K-mer hits per record (counted until each record was decided):\n")
+    sys.stderr.write(hit_histogram_lines(histogram))
+    sys.stderr.write("%s %i out of %i reads (%0.1f%%)\n" \
+                     % ("Binned" if bins else "Kept", out_count, in_count, out_count*100.0/max(1, in_count)))
+    if stats_handle is not None:
+        summary = dict(totals)
+        summary.update(type="summary", version=VERSION, batches=batches, elapsed=total_time,
+                       reads_per_s=in_count / max(total_time, 1e-6),
+                       bases_per_s=totals["bases"] / max(total_time, 1e-6),
+                       bloom_false_positives=false_positives if bloom is not None else None,
+                       peak_rss_mb=memory, worker_peak_rss_mb=worker_memory,
+                       threads=threads, batch_size=batch, kmer=kmer,
+                       min_hits=min_hits, min_fraction=min_fraction,
+                       hit_buckets=HIT_BUCKETS, hit_histogram=histogram.tolist())
+        stats_handle.write(json.dumps(summary, sort_keys=True) + "\n")
+        stats_handle.close()
 
 def main():
     parser = OptionParser(usage="usage: %prog [options]",
@@ -462,24 +3054,136 @@ def main():
                            Several files can be given if required.""")
     #Matching
     parser.add_option("-k", "--kmer", dest="kmer",
-                      type="int", metavar="KMER", default=35,
+                      type="int", metavar="KMER",
                       help="k-mer size for filtering (def. 35)")
     parser.add_option("-m", "--mismatches", dest="mismatches",
-                      type="int", metavar="MM", default=0,
+                      type="int", metavar="MM",
                       help="Number of mismatches per kmer (def. 0, max 1)")
+    parser.add_option("--min-hits", dest="min_hits",
+                      type="int", metavar="N", default=1,
+                      help="Minimum number of k-mer hits needed to keep a read "
+                           "(or pair), to ignore spurious hits e.g. from repeats "
+                           "(def. 1)")
+    parser.add_option("--min-fraction", dest="min_fraction",
+                      type="float", metavar="F", default=0.0,
+                      help="Minimum fraction of a read's (or pair's) k-mers "
+                           "which must be hits to keep it (def. 0)")
+    parser.add_option("--spaced-seeds", dest="spaced_seeds",
+                      action="store_true",
+                      help="Allow for mismatches when checking the reads, using "
+                           "spaced seeds (masks ignoring some bases of each "
+                           "k-mer), rather than adding all the variants of the "
+                           "reference k-mers to the filter. Much quicker to build "
+                           "and smaller, but does not allow for inserts or "
+                           "deletions, and with short k-mers (under about 30) "
+                           "lets through more unrelated reads.")
+    parser.add_option("--minimizers", dest="minimizers",
+                      type="int", metavar="W",
+                      help="Only store the reference k-mers which are the "
+                           "minimizer (smallest by hash) of a window of W "
+                           "consecutive k-mers, and only look up the reads' "
+                           "minimizers. Shrinks the index and the number of "
+                           "lookups several fold, but needs an exact match of "
+                           "at least W+k-1 bases. Exact matches only (no -m).")
+    #Index
+    parser.add_option("--save-index", dest="save_index",
+                      type="string", metavar="FILE",
+                      help="Save the reference k-mers to this index file for "
+                           "reuse with --load-index. If no input reads are "
+                           "given, just builds the index.")
+    parser.add_option("--load-index", dest="load_index",
+                      type="string", metavar="FILE",
+                      help="Use the reference k-mers from this index file "
+                           "(the k-mer settings are taken from the index). Any "
+                           "references given are checked against those used "
+                           "to build it, or if none are given those recorded "
+                           "in the index are checked (if still present).")
+    parser.add_option("--update-index", dest="update_index",
+                      type="string", metavar="FILE",
+                      help="Add the k-mers from the references given (only "
+                           "those not already in the index are hashed) and "
+                           "from any --merge-index files to this index file, "
+                           "which is rewritten (or give --save-index for the "
+                           "combined index). The k-mer settings are taken from "
+                           "the index. If no input reads are given, just "
+                           "updates the index.")
+    parser.add_option("--merge-index", dest="merge_indexes",
+                      type="string", metavar="FILE", action="append",
+                      help="Another index file to combine with --update-index, "
+                           "built with the same k-mer settings. Several files "
+                           "can be given if required.")
     
     #Reads
     parser.add_option("-f", "--format", dest="format",
                       type="string", metavar="FORMAT", default="fasta",
                       help="Input (and output) read file format, one of 'fasta',"
-                           " 'fastq' or 'sam' (unmapped reads only please).")
+                           " 'fastq', 'sam' or 'bam' (unmapped reads only please)."
+                           " SAM and BAM output keep the input header.")
     #TODO - Make paired mode or single mode the default?
     parser.add_option("-i", "--input", dest="input_reads",
                       type="string", metavar="FILE",
-                      help="Input file of unmapped reads to be filtered (def. stdin)")
+                      help="Input file of unmapped reads to be filtered (def. "
+                           "stdin), which may be gzip compressed (including BGZF)")
     parser.add_option("-o","--output", dest="output_reads",
                       type="string", metavar="FILE",
-                      help="Output file to write filtered reads to (def. stdout)")
+                      help="Output file to write filtered reads to (def. stdout), "
+                           "compressed as BGZF if the name ends .gz or .bgz")
+    parser.add_option("-1", "--input1", dest="input1",
+                      type="string", metavar="FILE",
+                      help="Input file of first reads, for pairs split over "
+                           "two files (FASTA or FASTQ), use with -2")
+    parser.add_option("-2", "--input2", dest="input2",
+                      type="string", metavar="FILE",
+                      help="Input file of second reads, for pairs split over "
+                           "two files (FASTA or FASTQ), use with -1")
+    parser.add_option("--output1", dest="output1",
+                      type="string", metavar="FILE",
+                      help="Output file for the filtered first reads (with -1)")
+    parser.add_option("--output2", dest="output2",
+                      type="string", metavar="FILE",
+                      help="Output file for the filtered second reads (with -2)")
+    parser.add_option("--bins", dest="bins",
+                      type="string", metavar="PREFIX",
+                      help="Bin the reads by reference file in one pass, "
+                           "writing each record to PREFIX<name>.<format> for "
+                           "every reference file it has a k-mer hit to, where "
+                           "the name is the reference filename without its "
+                           "extension. Use instead of -o. With --save-index "
+                           "the index records which files each k-mer is from.")
+    parser.add_option("--bin-report", dest="bin_report",
+                      type="string", metavar="FILE",
+                      help="With --bins, write a tab separated file giving "
+                           "the name of each binned record and its number "
+                           "of k-mer hits to each reference file")
+    parser.add_option("-b", "--batch", dest="batch",
+                      type="int", metavar="N",
+                      help="Number of records (reads or pairs) to check at once "
+                           "using NumPy (def. 10000, or 0 to check one at a time)")
+    parser.add_option("--kmer-strings", dest="kmer_strings",
+                      action="store_true",
+                      help="With -b 0, look up the k-mers as Python strings "
+                           "sliced out of each read rather than as 2-bit codes. "
+                           "Quicker, but the strings are decoded from the table "
+                           "at the start (even with --load-index) and take over "
+                           "twice the memory. No Bloom filter is used, and only "
+                           "for exact k-mers with a single hit needed.")
+    
+    parser.add_option("--bloom", dest="bloom",
+                      type="choice", choices=["builtin", "dablooms", "none"],
+                      metavar="BACKEND",
+                      help="Bloom filter used before the exact k-mer lookups, "
+                           "'builtin' (def.), 'dablooms' (needs the dablooms "
+                           "Python bindings), or 'none'")
+    parser.add_option("-t", "--threads", dest="threads",
+                      type="int", metavar="N", default=1,
+                      help="Number of worker processes for parsing and "
+                           "filtering the reads (def. 1, no workers)")
+    parser.add_option("--stats", dest="stats_file",
+                      type="string", metavar="FILE",
+                      help="Write timings and counts to this file as JSON "
+                           "lines, one per batch of reads then a summary "
+                           "(reads and bases per second, Bloom filter false "
+                           "positives, peak memory)")
     
     (options, args) = parser.parse_args()
 
@@ -487,6 +3191,42 @@ def main():
         parser.print_help()
         sys.exit(1)
 
+    if options.load_index and options.update_index:
+        parser.error("Options --load-index and --update-index are mutually exclusive")
+    if options.merge_indexes and not options.update_index:
+        parser.error("Option --merge-index is only used with --update-index")
+    if options.update_index and not (options.linear_references or options.circular_references
+                                     or options.merge_indexes):
+        parser.error("Option --update-index needs references (-l/-c) or --merge-index to add")
+    for index in (options.merge_indexes or []):
+        if not os.path.isfile(index):
+            parser.error("Index file %s not found" % index)
+    index = options.load_index or options.update_index
+    if index:
+        if options.load_index and options.save_index:
+            parser.error("Options --load-index and --save-index are mutually exclusive")
+        if not os.path.isfile(index):
+            parser.error("Index file %s not found" % index)
+        header = load_index_header(index)
+        if options.kmer is not None and options.kmer != header["kmer"]:
+            parser.error("Index %s is for %i-mers, not %i-mers" \
+                         % (index, header["kmer"], options.kmer))
+        if options.mismatches is not None and options.mismatches != header["mismatches"]:
+            parser.error("Index %s is for %i mismatches, not %i" \
+                         % (index, header["mismatches"], options.mismatches))
+        if options.spaced_seeds and not header.get("seeds"):
+            parser.error("Index %s was not built with --spaced-seeds" % index)
+        if options.minimizers is not None and options.minimizers != header.get("minimizers"):
+            parser.error("Index %s was not built with --minimizers %i" % (index, options.minimizers))
+        options.kmer = header["kmer"]
+        options.mismatches = header["mismatches"]
+        options.spaced_seeds = bool(header.get("seeds"))
+        options.minimizers = header.get("minimizers")
+    if options.kmer is None:
+        options.kmer = 35
+    if options.mismatches is None:
+        options.mismatches = 0
+
     if not (10 <= options.kmer <= 100):
         parser.error("Using a k-mer value of %i is not sensible" % options.kmer)
 
@@ -495,24 +3235,88 @@ def main():
     if options.mismatches > 1:
         parser.error("Number of mismatches per k-mer (here %i) currently limited to one" \
                      % options.mismatches)
+    if options.spaced_seeds and not options.mismatches:
+        parser.error("Option --spaced-seeds is only used with mismatches (-m)")
+    if options.minimizers is not None:
+        if options.minimizers < 1:
+            parser.error("Minimizer window (here %i) must be at least one k-mer" % options.minimizers)
+        if options.mismatches:
+            parser.error("Option --minimizers only allows for exact matches, not -m")
     #TODO - Make substitions/inserts/deletions separate command line options?
-    if options.mismatches:
+    if options.mismatches and not options.spaced_seeds:
         inserts = True
         deletions = True
     else:
         inserts = False
         deletions = False
 
-    if (not options.linear_references) and (not options.circular_references):
-        parser.error("You must supply some linear and/or circular references")
+    if options.min_hits < 1:
+        parser.error("Minimum k-mer hits (here %i) must be at least one" % options.min_hits)
+    if not (0.0 <= options.min_fraction <= 1.0):
+        parser.error("Minimum fraction of k-mer hits (here %r) must be between 0 and 1" \
+                     % options.min_fraction)
+
+    if options.batch is None:
+        options.batch = 10000
+    elif options.batch < 0:
+        parser.error("Batch size (here %i) cannot be negative" % options.batch)
+
+    if options.kmer_strings:
+        if options.batch:
+            parser.error("Option --kmer-strings needs one record at a time (-b 0)")
+        if options.bloom not in (None, "none"):
+            parser.error("Option --kmer-strings does not use a Bloom filter (--bloom)")
+        if options.spaced_seeds or options.minimizers is not None:
+            parser.error("Option --kmer-strings needs exact k-mers, not --spaced-seeds or --minimizers")
+        if options.min_hits != 1 or options.min_fraction:
+            parser.error("Option --kmer-strings only allows for a single hit, not "
+                         "--min-hits or --min-fraction")
+    if options.bloom is None:
+        options.bloom = "builtin"
+
+    if options.bloom == "dablooms" and pydablooms is None:
+        sys_exit("Missing 'dablooms' Python bindings, available from "
+                 "https://github.com/bitly/dablooms")
+
+    if options.threads < 1:
+        parser.error("Number of threads (here %i) must be at least one" % options.threads)
+
+    if (not options.linear_references) and (not options.circular_references) \
+    and not options.load_index and not options.update_index:
+        parser.error("You must supply some linear and/or circular references (or an index)")
 
     if args:
         parser.error("No arguments expected")
 
+    if options.input1 or options.input2 or options.output1 or options.output2:
+        if not (options.input1 and options.input2 and options.output1 and options.output2):
+            parser.error("Pairs split over two files need all of -1, -2, --output1 and --output2")
+        if options.input_reads or options.output_reads:
+            parser.error("Options -i and -o cannot be used with -1 and -2")
+        if options.format not in ["fasta", "fastq"]:
+            parser.error("Pairs split over two files must be FASTA or FASTQ")
+        options.input_reads = options.input1
+        options.output_reads = options.output1
+
+    if options.bin_report and not options.bins:
+        parser.error("Option --bin-report is only used with --bins")
+    if options.bins:
+        if options.input1:
+            parser.error("Option --bins cannot be used with -1 and -2")
+        if options.output_reads:
+            parser.error("Options -o and --bins are mutually exclusive")
+        if not options.batch:
+            parser.error("Option --bins needs the batch mode (-b)")
+
     paired = True
     go(options.input_reads, options.output_reads, options.format, paired,
        options.linear_references, options.circular_references,
-       options.kmer, options.mismatches, inserts, deletions)
+       options.kmer, options.mismatches, inserts, deletions, options.batch,
+       options.threads, options.save_index, options.load_index, options.bloom,
+       bool(options.spaced_seeds), options.input2, options.output2,
+       options.update_index, options.merge_indexes,
+       options.bins, options.bin_report, options.min_hits, options.min_fraction,
+       options.stats_file, options.minimizers, options.kmer_strings)
 
 if __name__ == "__main__":
     main()
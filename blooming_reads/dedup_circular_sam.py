@@ -6,22 +6,46 @@ and use a traditional mapper on that (in single end mode!).
 e.g. I'm using mrfast at the moment for this,
 
 What this script does first is remove duplicates due to mapping
-in the second half (or should shift them to the first half if
-just getting one position per read).
+in the second half. By default (--circular drop) any alignment
+starting in the second half is simply dropped. With --circular shift
+these are instead moved to the first half (as are any PNEXT in the
+second half of the same reference), and so become exact duplicates of
+any alignment already in the first half, which are then removed as
+usual. With --circular split, any alignment running over the origin
+is then also split into two lines (to comply with the SAM/BAM
+specification), one ending at the origin and a supplementary
+alignment (FLAG 0x800) starting at POS 1, each soft clipping the
+bases of the other. This is done as the lines are read, so there is
+no need for a second pass. Optional tags (such as NM and MD) are not
+updated.
 
 Currently this assumes that SAM file is grouped by read name
 (e.g. use 'samtools sort -n ...' to sort by read name), or at
 least grouped/sorted by reference then grouped/sorted by read
-name (e.g. output from mrfast).
+name (e.g. output from mrfast). Alternatively with --unsorted the
+reads are first split into partitions by a hash of the read name,
+written to temporary files (see partition_lines), and each of
+these is sorted by read name in memory and processed in turn (or
+in parallel with --threads). The output is then grouped by read
+name, but only sorted within each partition.
+
+The SAM lines are processed in large blocks with NumPy. Only the
+first four columns (QNAME, FLAG, RNAME and POS) are located, from
+the positions of the tabs, and only POS on circular references is
+parsed. Lines with the same QNAME as the line before are grouped
+together, and the lines kept are written out as unchanged slices
+of the input. Groups of more than one line are sorted by RNAME,
+POS, FLAG and the rest of the line (compared eight bytes at a time,
+rather than split into fields), so that any exact duplicate lines
+are next to each other and can be dropped.
 
 TODO:
 
-Step two would be to split reads mapped over the origin into
-two parts (to comply with the SAM/BAM specification). Without
-doing this it seems Tablet v1.12.09.03 will show spill over in
-SAM, but crops the view for BAM.
+Without splitting reads mapped over the origin into two parts, it
+seems Tablet v1.12.09.03 will show spill over in SAM, but crops
+the view for BAM (so consider making --circular split the default).
 
-Step three would be to review paired end information, and take
+The next step would be to review paired end information, and take
 into consideration the circular nature when deciding if a given
 pair mapping is sensible, and if you have multiple mappings
 which is the best,
@@ -36,6 +60,10 @@ end data, you might get two, three or even four lines in SAM
 
 import sys
 import os
+import shutil
+import tempfile
+import multiprocessing
+from cStringIO import StringIO
 from optparse import OptionParser
 
 def sys_exit(msg, error_level=1):
@@ -43,10 +71,29 @@ def sys_exit(msg, error_level=1):
     sys.stderr.write("%s\n" % msg)
     sys.exit(error_level)
 
-VERSION = "0.0.0"
+try:
+    import numpy as np
+except ImportError:
+    sys_exit("Missing 'numpy' module, available from http://numpy.org")
+
+from block_tools import byte_words, field_words, field_hashes, partition_count, partition_lines
+
+VERSION = "0.0.3"
+
 
+def go(input, output, paired, linear_refs, circular_refs,
+       unsorted=False, threads=1, memory=1000, temp_dir=None, circular="drop"):
+    """Remove duplicate mappings from the SAM file (see module docstring).
 
-def go(input, output, paired, linear_refs, circular_refs):
+    The circular mode is drop, shift or split, for alignments starting
+    in the second half of the doubled circular references (and for
+    split, those running over the origin).
+
+    With unsorted, the input need not be grouped by read name, and is
+    split into partitions held in temporary files (in temp_dir, or the
+    system default) aiming to keep the memory used under the given
+    number of megabytes, processed with the given number of processes.
+    """
     ref_len_linear = dict()
     if linear_refs:
         for f in linear_refs:
@@ -72,7 +119,7 @@ def go(input, output, paired, linear_refs, circular_refs):
         output_handle = output
 
     line = input_handle.readline()
-    while line[0] == "@":
+    while line[:1] == "@":
         #SAM header
         if line[0:4] == "@SQ\t":
             parts = line[4:].strip().split("\t")
@@ -98,35 +145,33 @@ def go(input, output, paired, linear_refs, circular_refs):
         output_handle.write(line)
         line = input_handle.readline()
 
-    cur_read_name = None
-    reads = set()
-    while line:
-        #SAM read
-        qname, flag, rname, pos, rest = line.split("\t", 4)
-        if rname in ref_len_circles and pos != "0":
-            length = ref_len_circles[rname]
-            int_pos = int(pos) - 1
-            if length <= int_pos:
-                assert int_pos < length*2, "Have POS %i yet length is %i or %i when doubled!\n%r" % (pos, length, length*2, line)
-                #While wait for mrfast 2.5.0.1 to fix this bug,
-                #https://sourceforge.net/tracker/?func=detail&aid=3574131&group_id=260735&atid=1127386
-                #we'll just ignore reads mapped in the second half.
-                #With mrfast they should all be duplicates anyway.
-                line = input_handle.readline()
-                continue
-                #pos = str(int_pos-length+1) #Modulo circle length 
-        if qname == cur_read_name:
-            #Cache this, as a tuple - ordered to allow sorting on position:
-            #Using a set will eliminate duplicates after adjusting POS
-            reads.add((qname, rname, pos, flag, rest))
+    if unsorted:
+        if isinstance(input, basestring):
+            size = os.path.getsize(input)
         else:
-            flush_cache(output_handle, reads)
-            reads = set([(qname, rname, pos, flag, rest)])
-            cur_read_name = qname
-        #Next line...
-        line = input_handle.readline()
-    if reads:
-        flush_cache(output_handle, reads)
+            size = None
+        directory = tempfile.mkdtemp(prefix="dedup-", dir=temp_dir)
+        try:
+            count = partition_count(size, threads, memory)
+            filenames = partition_lines(input_handle, line, directory, count, memory, qname_spans)
+            jobs = [(filename, ref_len_circles, circular) for filename in filenames]
+            if threads > 1:
+                pool = multiprocessing.Pool(threads)
+                results = pool.imap(dedup_partition, jobs)
+            else:
+                results = (dedup_partition(job) for job in jobs)
+            for filename in results:
+                handle = open(filename)
+                shutil.copyfileobj(handle, output_handle)
+                handle.close()
+                os.remove(filename)
+            if threads > 1:
+                pool.close()
+                pool.join()
+        finally:
+            shutil.rmtree(directory)
+    else:
+        dedup_lines(input_handle, output_handle, line, ref_len_circles, circular)
 
     if isinstance(input, basestring):
         input_handle.close()
@@ -134,15 +179,485 @@ def go(input, output, paired, linear_refs, circular_refs):
         output_handle.close()
 
 
-def flush_cache(handle, set_of_read_tuples):
-    #if len(set_of_read_tuples) > 1:
-    #    sys.stderr.write("Interesting...\n")
-    #    for qname, rname, pos, flag, rest in sorted(set_of_read_tuples):
-    #        sys.stderr.write("\t".join([qname, flag, rname, pos, rest]))
-    #Note for sorting we don't use the SAM column order
-    for qname, rname, pos, flag, rest in sorted(set_of_read_tuples):
-        #Assume that 'rest' has the trailing \n
-        handle.write("\t".join([qname, flag, rname, pos, rest]))
+def line_columns(data, fields=4):
+    """Start and end of each line, and the offset of the first few tabs.
+
+    Returns three integer arrays (the third with a column for the tab
+    at the end of each of the first fields, by default QNAME, FLAG,
+    RNAME and POS). Expects the data to end with a new line.
+
+    >>> starts, ends, columns = line_columns("r1\\t0\\tc\\t5\\t*\\nread2\\t16\\tc\\t3\\t*\\n")
+    >>> starts.tolist(), ends.tolist()
+    ([0, 11], [11, 26])
+    >>> columns.tolist()
+    [[2, 4, 6, 8], [16, 19, 21, 23]]
+    """
+    buf = np.frombuffer(data, np.uint8)
+    #Find the tabs and new lines in one pass
+    marks = np.flatnonzero(buf <= 10)
+    new_lines = np.flatnonzero(buf[marks] == 10)
+    ends = marks[new_lines] + 1
+    starts = np.zeros(len(ends), np.int64)
+    starts[1:] = ends[:-1]
+    #Index of the first tab or new line (in marks) on each line
+    first = np.zeros(len(ends), np.int64)
+    first[1:] = new_lines[:-1] + 1
+    bad = np.flatnonzero(first + fields > new_lines)
+    if len(bad):
+        sys_exit("Expected at least %i tab separated fields in SAM line:\n%r"
+                 % (fields + 1, data[starts[bad[0]]:ends[bad[0]]]))
+    columns = marks[first[:, None] + np.arange(fields)]
+    return starts, ends, columns
+
+
+def matching_fields(buf, starts, ends, text):
+    """Indices of the fields (start to end offsets in buf) which equal text."""
+    found = np.flatnonzero(ends - starts == len(text))
+    for i, letter in enumerate(bytearray(text)):
+        found = found[buf[starts[found] + i] == letter]
+    return found
+
+
+def same_as_previous(words, starts, ends):
+    """Boolean array, True where a field (start to end offsets) equals the one before."""
+    same = np.zeros(len(starts), bool)
+    if len(starts) > 1:
+        lengths = ends - starts
+        same[1:] = lengths[1:] == lengths[:-1]
+        for word in field_words(words, starts, ends):
+            same[1:] &= word[1:] == word[:-1]
+    return same
+
+
+def parse_ints(buf, starts, ends, name="POS"):
+    """Array of the non-negative integers in each field (start to end offsets in buf)."""
+    values = np.zeros(len(starts), np.int64)
+    lengths = ends - starts
+    for i in range(lengths.max() if len(lengths) else 0):
+        more = np.flatnonzero(lengths > i)
+        digits = buf[starts[more] + i].astype(np.int64) - 48
+        if len(digits) and (digits.min() < 0 or digits.max() > 9):
+            bad = more[(digits < 0) | (digits > 9)][0]
+            sys_exit("Bad %s %r in SAM file" % (name, buf[starts[bad]:ends[bad]].tostring()))
+        values[more] = values[more] * 10 + digits
+    return values
+
+
+#CIGAR operators (the codes used by cigar_arrays are indices into this)
+_cigar_operators = "MIDNSHP=X"
+#Which operators consume reference bases, query bases, or are aligned bases
+_cigar_ref = np.array([op in "MDN=X" for op in _cigar_operators])
+_cigar_query = np.array([op in "MIS=X" for op in _cigar_operators])
+_cigar_aligned = np.array([op in "M=X" for op in _cigar_operators])
+_cigar_parsed = dict()
+
+
+def cigar_arrays(cigar_str):
+    """CIGAR string parsed into integer arrays of operator codes and counts.
+
+    e.g. cigar string of 36M2I3M becomes [0, 1, 0] and [36, 2, 3], with
+    the codes being indices into _cigar_operators. An empty CIGAR string
+    (represented as * in SAM) gives empty arrays. Results are cached, as
+    most reads share a handful of CIGAR strings.
+    """
+    try:
+        return _cigar_parsed[cigar_str]
+    except KeyError:
+        pass
+    ops = []
+    counts = []
+    if cigar_str != "*":
+        count = ""
+        for letter in cigar_str:
+            if letter.isdigit():
+                count += letter
+            else:
+                if letter not in _cigar_operators or not count:
+                    sys_exit("Invalid CIGAR %s in SAM file" % cigar_str)
+                ops.append(_cigar_operators.index(letter))
+                counts.append(int(count))
+                count = ""
+        if count:
+            sys_exit("Invalid CIGAR %s in SAM file" % cigar_str)
+    answer = np.array(ops, np.intp), np.array(counts, np.int64)
+    if len(_cigar_parsed) > 100000:
+        _cigar_parsed.clear()
+    _cigar_parsed[cigar_str] = answer
+    return answer
+
+
+def cigar_string(ops, counts):
+    """CIGAR string from operator codes and counts (see cigar_arrays)."""
+    return "".join("%i%s" % (count, _cigar_operators[op]) for op, count in zip(ops, counts))
+
+
+def cigar_alens(data, words, starts, ends):
+    """Array of the reference length of each alignment, from the CIGAR fields.
+
+    Takes the block of SAM lines, its byte_words, and the start and end
+    offsets of each CIGAR field. Only the distinct CIGAR strings are
+    parsed (see cigar_arrays).
+    """
+    if not len(starts):
+        return np.zeros(0, np.int64)
+    keys = np.ascontiguousarray(np.column_stack(field_words(words, starts, ends)))
+    keys = keys.view(np.dtype((np.void, keys.dtype.itemsize * keys.shape[1]))).ravel()
+    unique, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+    alens = np.zeros(len(unique), np.int64)
+    for i, (start, end) in enumerate(zip(starts[first].tolist(), ends[first].tolist())):
+        ops, counts = cigar_arrays(data[start:end])
+        alens[i] = counts[_cigar_ref[ops]].sum()
+    return alens[inverse]
+
+
+def split_cigar(ops, counts, cut):
+    """Split an alignment (as CIGAR arrays) after its first cut reference bases.
+
+    Returns the CIGAR arrays of the part before the cut and the part
+    after it, with the query bases of the other part soft clipped (any
+    hard clipping is kept at the outer ends), plus the number of
+    reference bases skipped at the start of the second part (from a
+    deletion or skip at the cut). A part is None if it has no aligned
+    (M, = or X) bases.
+
+    >>> before, after, skipped = split_cigar(*cigar_arrays("10S40M"), cut=6)
+    >>> cigar_string(*before), cigar_string(*after), skipped
+    ('10S6M34S', '16S34M', 0)
+    >>> before, after, skipped = split_cigar(*cigar_arrays("5H5M2D5M"), cut=5)
+    >>> cigar_string(*before), cigar_string(*after), skipped
+    ('5H5M5S', '5H5S5M', 2)
+    >>> split_cigar(*cigar_arrays("4S6M"), cut=6)[1:]
+    (None, 0)
+    """
+    first = []
+    second = []
+    ref = 0
+    for op, count in zip(ops.tolist(), counts.tolist()):
+        if _cigar_ref[op] and ref < cut < ref + count:
+            first.append((op, cut - ref))
+            second.append((op, ref + count - cut))
+        elif ref < cut or (ref == cut and not _cigar_ref[op]):
+            #An insertion at the cut goes with the first part
+            first.append((op, count))
+        else:
+            second.append((op, count))
+        if _cigar_ref[op]:
+            ref += count
+    answer = []
+    skipped = 0
+    hard = _cigar_operators.index("H")
+    soft = _cigar_operators.index("S")
+    #Reverse the second part, so for both the cut is at the end
+    for part, other in [(first, second), (second[::-1], first[::-1])]:
+        if not any(_cigar_aligned[op] for op, count in part):
+            answer.append(None)
+            continue
+        clip = sum(count for op, count in other if _cigar_query[op])
+        while not _cigar_aligned[part[-1][0]]:
+            op, count = part.pop()
+            if _cigar_query[op]:
+                clip += count
+            elif _cigar_ref[op] and part is not first:
+                skipped += count
+        if clip:
+            part.append((soft, clip))
+        if other and other[-1][0] == hard:
+            part.append(other[-1])
+        if part is not first:
+            part.reverse()
+        answer.append((np.array([op for op, count in part], np.intp),
+                       np.array([count for op, count in part], np.int64)))
+    return answer[0], answer[1], skipped
+
+
+def split_lines(data, starts, ends, lines, pos, pnext, length):
+    """Replacement text for alignments running over the origin, as two lines.
+
+    Takes the block of SAM lines, the start and end of each line, the
+    indices of the lines to split, and their new POS and PNEXT (or -1
+    to leave PNEXT as is), all on a circular reference of the given
+    length (see split_cigar). Returns a list of strings, one per line.
+    """
+    answer = []
+    for line, p, n in zip(lines.tolist(), pos.tolist(), pnext.tolist()):
+        fields = data[starts[line]:ends[line]].split("\t", 9)
+        fields[3] = str(p)
+        if n >= 0:
+            fields[7] = str(n)
+        ops, counts = cigar_arrays(fields[5])
+        before, after, skipped = split_cigar(ops, counts, length - p + 1)
+        text = []
+        if before is not None:
+            fields[5] = cigar_string(*before)
+            text.append("\t".join(fields))
+        if after is not None:
+            fields[3] = str(1 + skipped)
+            fields[5] = cigar_string(*after)
+            if before is not None:
+                #Supplementary alignment
+                fields[1] = str(int(fields[1]) | 0x800)
+            text.append("\t".join(fields))
+        answer.append("".join(text))
+    return answer
+
+
+def replace_slices(data, starts, ends, texts):
+    """Copy of data with each start to end slice replaced by the matching text.
+
+    The slices must not overlap, but can be in any order.
+
+    >>> replace_slices("abcdef", np.array([4, 0]), np.array([5, 2]), ["E", "AB"])
+    'ABcdEf'
+    """
+    order = np.argsort(starts, kind="mergesort").tolist()
+    starts = starts[order].tolist()
+    ends = ends[order].tolist()
+    #Pieces alternate between the data kept and the texts
+    pieces = [None] * (2 * len(order) + 1)
+    pieces[0::2] = [data[start:end] for start, end in zip([0] + ends, starts + [len(data)])]
+    pieces[1::2] = [texts[i] for i in order]
+    return "".join(pieces)
+
+
+def dedup_block(data, ref_len_circles, final=False, circular="drop"):
+    """Deduplicated lines from a block of SAM read lines (ending with a new line).
+
+    Drops reads mapped to the second half of a doubled circular
+    reference (or with circular mode shift or split, moves them to the
+    first half, and for split also splits those over the origin, see
+    split_lines), and removes duplicates from each group of
+    consecutive lines with the same QNAME, sorting them by RNAME, POS
+    and FLAG (as strings), and then the rest of the line.
+
+    Returns a list of strings to write out, and (unless this is the
+    final block) the unprocessed end of the data, starting with the
+    last group of lines as it may continue into the next block.
+
+    For example, with a circular reference c of length 10 (doubled to 20
+    for mapping), here read r1 has an exact duplicate and an alignment
+    in the second half, both dropped:
+
+    >>> sam = ["r1 0 c 5 30 4M * 0 0 ACGT IIII",
+    ...        "r1 0 c 5 30 4M * 0 0 ACGT IIII",
+    ...        "r1 0 c 15 30 4M * 0 0 ACGT IIII",
+    ...        "r2 16 c 3 30 4M * 0 0 ACGT IIII"]
+    >>> data = "".join(line.replace(" ", "\\t") + "\\n" for line in sam)
+    >>> pieces, tail = dedup_block(data, {"c": 10}, final=True)
+    >>> for line in "".join(pieces).splitlines():
+    ...     print(line.replace("\\t", " "))
+    r1 0 c 5 30 4M * 0 0 ACGT IIII
+    r2 16 c 3 30 4M * 0 0 ACGT IIII
+
+    Unless final, the last read's lines are held back:
+
+    >>> pieces, tail = dedup_block(data, {"c": 10})
+    >>> len(pieces), tail.split("\\t", 1)[0]
+    (1, 'r2')
+
+    With shift, an alignment in the second half (and a PNEXT there) is
+    moved to the first half, here making a duplicate of the line after:
+
+    >>> sam = ["r1 0 c 995 30 10S40M * 0 0 * *",
+    ...        "r2 0 c 1003 30 4M = 1995 0 * *",
+    ...        "r2 0 c 3 30 4M = 995 0 * *"]
+    >>> data = "".join(line.replace(" ", "\\t") + "\\n" for line in sam)
+    >>> pieces, tail = dedup_block(data, {"c": 1000}, True, "shift")
+    >>> for line in "".join(pieces).splitlines():
+    ...     print(line.replace("\\t", " "))
+    r1 0 c 995 30 10S40M * 0 0 * *
+    r2 0 c 3 30 4M = 995 0 * *
+
+    With split, the alignment running over the origin also becomes two
+    lines, the part after the origin a supplementary alignment at POS 1:
+
+    >>> pieces, tail = dedup_block(data, {"c": 1000}, True, "split")
+    >>> for line in "".join(pieces).splitlines():
+    ...     print(line.replace("\\t", " "))
+    r1 2048 c 1 30 16S34M * 0 0 * *
+    r1 0 c 995 30 10S6M34S * 0 0 * *
+    r2 0 c 3 30 4M = 995 0 * *
+    """
+    buf = np.frombuffer(data, np.uint8)
+    words = byte_words(data)
+    if circular == "drop":
+        starts, ends, columns = line_columns(data)
+    else:
+        #Also want the CIGAR, RNEXT and PNEXT
+        starts, ends, columns = line_columns(data, 8)
+    keep = np.ones(len(starts), bool)
+    edits = []
+    for rname, length in ref_len_circles.iteritems():
+        lines = matching_fields(buf, columns[:, 1] + 1, columns[:, 2], rname)
+        pos = parse_ints(buf, columns[lines, 2] + 1, columns[lines, 3])
+        second = pos > length
+        if len(pos) and pos.max() > 2 * length:
+            bad = lines[np.argmax(pos)]
+            sys_exit("Have POS %i yet length is %i or %i when doubled!\n%r"
+                     % (pos.max(), length, length * 2, data[starts[bad]:ends[bad]]))
+        if circular == "drop":
+            #While wait for mrfast 2.5.0.1 to fix this bug,
+            #https://sourceforge.net/tracker/?func=detail&aid=3574131&group_id=260735&atid=1127386
+            #we'll just ignore reads mapped in the second half.
+            #With mrfast they should all be duplicates anyway.
+            keep[lines[second]] = False
+            continue
+        pos[second] -= length
+        #Mates on the same reference, with RNEXT as = or the name
+        mates = np.union1d(matching_fields(buf, columns[lines, 5] + 1, columns[lines, 6], "="),
+                           matching_fields(buf, columns[lines, 5] + 1, columns[lines, 6], rname))
+        pnext = np.zeros(len(lines), np.int64) - 1
+        pnext[mates] = parse_ints(buf, columns[lines[mates], 6] + 1, columns[lines[mates], 7], "PNEXT")
+        if len(pnext) and pnext.max() > 2 * length:
+            bad = lines[np.argmax(pnext)]
+            sys_exit("Have PNEXT %i yet length is %i or %i when doubled!\n%r"
+                     % (pnext.max(), length, length * 2, data[starts[bad]:ends[bad]]))
+        shifted = pnext > length
+        pnext[shifted] -= length
+        if circular == "split":
+            alens = cigar_alens(data, words, columns[lines, 4] + 1, columns[lines, 5])
+            spanning = (pos > 0) & (pos + alens - 1 > length)
+        else:
+            spanning = np.zeros(len(lines), bool)
+        #Replace just the POS or PNEXT of lines moved to the first half,
+        #but the whole line for those split in two
+        for changed, column in [(second & ~spanning, 3), (shifted & ~spanning, 7)]:
+            values = (pos if column == 3 else pnext)[changed]
+            changed = lines[changed]
+            edits.append((columns[changed, column - 1] + 1, columns[changed, column],
+                          map(str, values.tolist())))
+        changed = np.flatnonzero(spanning)
+        edits.append((starts[lines[changed]], ends[lines[changed]],
+                      split_lines(data, starts, ends, lines[changed], pos[changed],
+                                  pnext[changed], length)))
+    if any(len(texts) for field_starts, field_ends, texts in edits):
+        #Rebuild the block with the edits, and carry on with that
+        data = replace_slices(data, np.concatenate([e[0] for e in edits]),
+                              np.concatenate([e[1] for e in edits]),
+                              [text for e in edits for text in e[2]])
+        buf = np.frombuffer(data, np.uint8)
+        words = byte_words(data)
+        starts, ends, columns = line_columns(data)
+        keep = np.ones(len(starts), bool)
+    kept = np.flatnonzero(keep)
+    if not len(kept):
+        return [], ""
+    #Group consecutive kept lines by QNAME
+    new_group = ~same_as_previous(words, starts[kept], columns[kept, 0])
+    new_group[0] = True
+    if final:
+        tail = ""
+    else:
+        last = np.flatnonzero(new_group)[-1]
+        tail = data[starts[kept[last]]:]
+        kept = kept[:last]
+        new_group = new_group[:last]
+        if not len(kept):
+            return [], tail
+    group = np.cumsum(new_group) - 1
+    sizes = np.bincount(group)
+    #Sort the lines within each group of more than one line
+    multiple = np.flatnonzero(sizes[group] > 1)
+    lines = kept[multiple]
+    if len(multiple):
+        #Sort keys, least significant first, as wanted by lexsort
+        keys = (field_words(words, columns[lines, 0] + 1, columns[lines, 1])[::-1]
+                + field_words(words, columns[lines, 2] + 1, columns[lines, 3])[::-1]
+                + field_words(words, columns[lines, 1] + 1, columns[lines, 2])[::-1]
+                + [group[multiple]])
+        order = np.lexsort(keys)
+        lines = lines[order]
+        #Lines with the same RNAME, POS and FLAG may be duplicates
+        tied = np.ones(len(lines) - 1, bool)
+        for key in keys:
+            key = key[order]
+            tied &= key[1:] == key[:-1]
+        if tied.any():
+            #Sort each run of tied lines by the rest of the line, and drop
+            #any exact duplicates (now next to each other)
+            runs = np.cumsum(np.concatenate(([True], ~tied)))
+            ties = np.flatnonzero(np.concatenate(([False], tied)) | np.concatenate((tied, [False])))
+            rest_starts = columns[lines[ties], 3] + 1
+            rest_ends = ends[lines[ties]]
+            keys = field_words(words, rest_starts, rest_ends)[::-1] + [runs[ties]]
+            order = np.lexsort(keys)
+            lines[ties] = lines[ties][order]
+            duplicate = (rest_ends - rest_starts)[order]
+            duplicate = duplicate[1:] == duplicate[:-1]
+            for key in keys:
+                key = key[order]
+                duplicate &= key[1:] == key[:-1]
+            lines[ties[1:][duplicate]] = -1
+        kept[multiple] = lines
+    kept = kept[kept >= 0]
+    #Lines adjacent in the input can be written out as one slice
+    breaks = np.flatnonzero(kept[1:] != kept[:-1] + 1) + 1
+    firsts = starts[kept[np.append(0, breaks)]].tolist()
+    lasts = ends[kept[np.append(breaks - 1, len(kept) - 1)]].tolist()
+    return [data[first:last] for first, last in zip(firsts, lasts)], tail
+
+
+def dedup_lines(input_handle, output_handle, line, ref_len_circles, circular="drop",
+                block=1 << 22):
+    """Deduplicate the SAM read lines from the handle, starting with the given line.
+
+    Reads the input in blocks of the given size (see dedup_block, which
+    also takes the circular mode).
+    """
+    data = line
+    while True:
+        more = input_handle.read(block)
+        data += more
+        if not more:
+            if data and not data.endswith("\n"):
+                data += "\n"
+            if data:
+                pieces, data = dedup_block(data, ref_len_circles, True, circular)
+                output_handle.write("".join(pieces))
+            break
+        cut = data.rfind("\n") + 1
+        if not cut:
+            continue
+        pieces, tail = dedup_block(data[:cut], ref_len_circles, False, circular)
+        output_handle.write("".join(pieces))
+        data = tail + data[cut:]
+
+
+def qname_spans(data):
+    """Start and end of each line, and the end of its QNAME (see line_columns)."""
+    starts, ends, columns = line_columns(data)
+    return starts, ends, columns[:, 0]
+
+
+def dedup_partition(job):
+    """Sort a partition file by QNAME then remove duplicates, returning the output filename.
+
+    Takes a tuple of the filename (from partition_lines, which is then
+    removed), the circular reference lengths, and the circular mode.
+    Lines with the same QNAME keep their order.
+    """
+    filename, ref_len_circles, circular = job
+    handle = open(filename)
+    data = handle.read()
+    handle.close()
+    os.remove(filename)
+    if data:
+        starts, ends, columns = line_columns(data)
+        words = byte_words(data)
+        #Grouping by the hash is enough (with a stable sort), unless two
+        #names share a hash, in which case sort by the names themselves
+        hashes = field_hashes(words, starts, columns[:, 0])
+        order = np.argsort(hashes, kind="mergesort")
+        same_name = same_as_previous(words, starts[order], columns[order, 0])
+        same_hash = np.zeros(len(order), bool)
+        same_hash[1:] = hashes[order][1:] == hashes[order][:-1]
+        if (same_hash & ~same_name).any():
+            order = np.lexsort(field_words(words, starts, columns[:, 0])[::-1])
+        data = "".join([data[start:end] for start, end
+                        in zip(starts[order].tolist(), ends[order].tolist())])
+    handle = open(filename + ".dedup", "wb")
+    dedup_lines(StringIO(data), handle, "", ref_len_circles, circular)
+    handle.close()
+    return filename + ".dedup"
 
 
 def get_fasta_ids_and_lengths(fasta_filename):
@@ -181,6 +696,27 @@ def main():
     parser.add_option("-o","--output", dest="output_reads",
                       type="string", metavar="FILE",
                       help="Output file for processed SAM format mapping (def. stdout)")
+    parser.add_option("--circular", dest="circular",
+                      type="choice", choices=["drop", "shift", "split"],
+                      default="drop", metavar="MODE",
+                      help="How to handle alignments starting in the second half of "
+                           "a doubled circular reference, 'drop' them (def.), 'shift' "
+                           "them to the first half, or 'split' to also split any "
+                           "alignment over the origin into two lines")
+    parser.add_option("--unsorted", dest="unsorted",
+                      action="store_true", default=False,
+                      help="""Input is not grouped by read name, so split it into
+                           partitions by read name in temporary files first
+                           (rather than needing 'samtools sort -n').""")
+    parser.add_option("-t", "--threads", dest="threads",
+                      type="int", metavar="N", default=1,
+                      help="Number of worker processes for the partitions with --unsorted (def. 1)")
+    parser.add_option("--memory", dest="memory",
+                      type="int", metavar="MB", default=1000,
+                      help="Memory to aim to use with --unsorted, in megabytes (def. 1000)")
+    parser.add_option("--temp", dest="temp_dir",
+                      type="string", metavar="DIR",
+                      help="Directory for the temporary files with --unsorted (def. system default)")
     
     (options, args) = parser.parse_args()
 
@@ -194,9 +730,17 @@ def main():
     if args:
         parser.error("No arguments expected")
 
+    if options.threads < 1:
+        parser.error("Need at least one thread")
+
+    if options.memory < 1:
+        parser.error("Need at least one megabyte of memory")
+
     paired = True
     go(options.input_reads, options.output_reads, paired,
-       options.linear_references, options.circular_references)
+       options.linear_references, options.circular_references,
+       options.unsorted, options.threads, options.memory, options.temp_dir,
+       options.circular)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,80 @@
+"""Compare the built in Bloom filter against dablooms.
+
+Adds random k-mer codes to each Bloom filter (with the capacity set
+to the number of k-mers), then checks a second set of random k-mer
+codes which were not added, and reports the false positive rate, the
+memory used (bytes per k-mer), and queries/second. The built in
+filter is timed both for NumPy arrays of keys (as in the batch mode)
+and for single integer codes (as in the per-read mode). The dablooms
+filter is only included if its Python bindings are installed.
+
+Run from this directory, optionally giving the number of k-mers,
+the error rate and the k-mer size, e.g.
+
+$ python bench_bloom.py 1000000 0.01 31
+"""
+import os
+import sys
+import random
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from blooming_reads import KmerTable, BloomFilter, DabloomsFilter, pydablooms, np
+
+count = 1000000
+error_rate = 0.01
+kmer = 31
+if len(sys.argv) > 1:
+    count = int(sys.argv[1])
+if len(sys.argv) > 2:
+    error_rate = float(sys.argv[2])
+if len(sys.argv) > 3:
+    kmer = int(sys.argv[3])
+single_count = min(count, 100000)
+
+random.seed(kmer)
+codes = set()
+while len(codes) < count:
+    codes.add(random.getrandbits(2 * kmer))
+others = set()
+while len(others) < count:
+    code = random.getrandbits(2 * kmer)
+    if code not in codes:
+        others.add(code)
+added = KmerTable.from_codes(codes, kmer).keys
+queries = KmerTable.from_codes(others, kmer).keys
+#Sorted keys would flatter the memory access pattern
+queries = queries[np.random.RandomState(kmer).permutation(len(queries))]
+single = list(others)[:single_count]
+del codes, others
+
+print("%i random %i-mers, requested error rate %r" % (count, kmer, error_rate))
+print("%-24s %10s %10s %12s %12s" % ("Backend", "FP rate", "Bytes/k-mer", "Build (s)", "Queries/s"))
+
+def report(name, bloom, build_time, check, queries):
+    t0 = time.time()
+    false_pos = check(queries)
+    taken = time.time() - t0
+    print("%-24s %10.5f %10.2f %12.2f %12.0f" \
+          % (name, float(false_pos) / len(queries), float(bloom.nbytes) / count,
+             build_time, len(queries) / taken))
+
+t0 = time.time()
+bloom = BloomFilter(count, error_rate, kmer)
+bloom.add(added)
+build_time = time.time() - t0
+report("builtin (arrays)", bloom, build_time,
+       lambda keys: bloom.contains(keys).sum(), queries)
+report("builtin (single codes)", bloom, build_time,
+       lambda codes: sum(1 for code in codes if code in bloom), single)
+
+if pydablooms is None:
+    print("dablooms not installed, skipped")
+else:
+    t0 = time.time()
+    bloom = DabloomsFilter(count, error_rate, kmer)
+    bloom.add(added)
+    build_time = time.time() - t0
+    report("dablooms (single codes)", bloom, build_time,
+           lambda codes: sum(1 for code in codes if code in bloom), single)
+    bloom.close()
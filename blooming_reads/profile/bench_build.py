@@ -0,0 +1,50 @@
+"""Check building the k-mer table scales linearly with reference size.
+
+Builds the table (as done for -c, exact k-mers only) for random circular
+references of increasing length, each with an ambiguous base (IUPAC code)
+about every 10kb and a run of 100 N about every 1Mb, and reports the
+build time and reference bases per second.
+
+Run from this directory, optionally giving the k-mer size and the
+largest reference length in Mb, e.g.
+
+$ python bench_build.py 31 16
+"""
+import os
+import sys
+import random
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from blooming_reads import build_filter, np
+
+kmer = 31
+largest = 16
+if len(sys.argv) > 1:
+    kmer = int(sys.argv[1])
+if len(sys.argv) > 2:
+    largest = int(sys.argv[2])
+
+random.seed(kmer)
+rng = np.random.RandomState(kmer)
+print("Random circular references with IUPAC codes and runs of N, %i-mers" % kmer)
+print("%10s %10s %12s %14s" % ("Length", "Keys", "Build (s)", "Bases/s"))
+size = 1
+while size <= largest:
+    length = size * 1000000
+    seq = np.frombuffer("ACGT", np.uint8)[rng.randint(0, 4, length)].copy()
+    for i in range(length // 10000):
+        seq[random.randrange(length)] = ord(random.choice("RYKMSWBDHVN"))
+    for i in range(size):
+        start = random.randrange(length - 100)
+        seq[start:start + 100] = ord("N")
+    handle, filename = tempfile.mkstemp(prefix="ref-", suffix=".fasta")
+    os.write(handle, ">random\n%s\n" % seq.tostring())
+    os.close(handle)
+    t0 = time.time()
+    table = build_filter(None, [filename], kmer, 0, False, False)
+    taken = time.time() - t0
+    os.remove(filename)
+    print("%10i %10i %12.1f %14.0f" % (length, len(table), taken, length / taken))
+    size *= 2
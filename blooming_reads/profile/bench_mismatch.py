@@ -0,0 +1,85 @@
+"""Compare allowing one mismatch by adding k-mer variants or via spaced seeds.
+
+Builds the k-mer table for a random reference three ways: exact k-mers
+only, with one mismatch allowed by adding the variant k-mers (plus the
+inserts and deletions, as done for -m 1), and with one mismatch allowed
+at query time using spaced seeds (-m 1 --spaced-seeds). Reports the
+build time and memory for each, and the fraction of reads kept (using
+the batch mode) for reads sampled from the reference with substitutions
+at about the given rate, with a single base insertion or deletion, and
+for random reads (which should not be kept).
+
+Run from this directory, optionally giving the k-mer size, reference
+length, and substitution rate, e.g.
+
+$ python bench_mismatch.py 35 20000 0.03
+"""
+import os
+import sys
+import random
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from blooming_reads import build_filter, batch_filter, np
+from Bio.Seq import reverse_complement
+
+kmer = 35
+ref_len = 20000
+sub_rate = 0.03
+if len(sys.argv) > 1:
+    kmer = int(sys.argv[1])
+if len(sys.argv) > 2:
+    ref_len = int(sys.argv[2])
+if len(sys.argv) > 3:
+    sub_rate = float(sys.argv[3])
+read_len = 100
+read_count = 2000
+
+random.seed(kmer)
+ref = "".join(random.choice("ACGT") for i in range(ref_len))
+handle, ref_filename = tempfile.mkstemp(prefix="ref-", suffix=".fasta")
+os.write(handle, ">random\n%s\n" % ref)
+os.close(handle)
+
+def sample(length):
+    start = random.randint(0, ref_len - length)
+    fragment = ref[start:start + length]
+    if random.random() < 0.5:
+        return reverse_complement(fragment)
+    return fragment
+
+def substitute(seq):
+    return "".join(random.choice("ACGT".replace(base, ""))
+                   if random.random() < sub_rate else base
+                   for base in seq)
+
+def indel(seq):
+    i = random.randint(kmer // 2, len(seq) - kmer // 2)
+    if random.random() < 0.5:
+        return seq[:i] + random.choice("ACGT") + seq[i:-1]
+    return seq[:i] + seq[i + 1:] + random.choice("ACGT")
+
+read_sets = [("Substitutions", [substitute(sample(read_len)) for i in range(read_count)]),
+             ("Indel", [indel(sample(read_len)) for i in range(read_count)]),
+             ("Random", ["".join(random.choice("ACGT") for i in range(read_len))
+                         for j in range(read_count)])]
+
+print("Random %i bp reference, %i-mers, %i reads of %i bp per set, substitution rate %r" \
+      % (ref_len, kmer, read_count, read_len, sub_rate))
+print("%-16s %10s %10s %10s %s" % ("Mode", "Build (s)", "Keys", "MB",
+                                    " ".join("%13s" % name for name, reads in read_sets)))
+for name, mismatches, spaced_seeds in [("Exact", 0, False),
+                                       ("Variants", 1, False),
+                                       ("Spaced seeds", 1, True)]:
+    t0 = time.time()
+    table = build_filter(None, [ref_filename], kmer, mismatches,
+                         bool(mismatches and not spaced_seeds),
+                         bool(mismatches and not spaced_seeds),
+                         spaced_seeds=spaced_seeds)
+    build_time = time.time() - t0
+    kept = ["%12.1f%%" % (100.0 * batch_filter([[read] for read in reads], kmer, table).mean())
+            for set_name, reads in read_sets]
+    print("%-16s %10.1f %10i %10.1f %s" % (name, build_time, len(table),
+                                          table.nbytes / 1e6, " ".join(kept)))
+os.remove(ref_filename)
@@ -0,0 +1,81 @@
+"""Compare FASTQ parsing speed, line by line against the chunked reader.
+
+Times parsing a FASTQ file (upper case sequence and raw record for each
+read) with the old readline based parser, Biopython's FastqGeneralIterator
+(rebuilding the raw record from the title, sequence and quality), the
+blooming_reads fastq_iterator, and record_blocks (which is what the main
+loop uses, with no per-record raw string). Reports reads/second.
+
+Run from this directory, giving a FASTQ file, or the number of reads to
+simulate (default 200000, of 100bp), e.g.
+
+$ python bench_parse.py example.fastq
+"""
+import os
+import sys
+import random
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from blooming_reads import fastq_iterator, record_blocks
+from Bio.SeqIO.QualityIO import FastqGeneralIterator
+
+filename = None
+read_count = 200000
+if len(sys.argv) > 1:
+    if os.path.isfile(sys.argv[1]):
+        filename = sys.argv[1]
+    else:
+        read_count = int(sys.argv[1])
+if filename is None:
+    random.seed(read_count)
+    handle, filename = tempfile.mkstemp(prefix="reads-", suffix=".fastq")
+    for i in range(read_count):
+        seq = "".join(random.choice("ACGT") for j in range(100))
+        os.write(handle, "@read%i\n%s\n+\n%s\n" % (i, seq, "I" * 100))
+    os.close(handle)
+    remove = True
+else:
+    remove = False
+
+def readline_iterator(handle):
+    """The parser as it was before record_blocks."""
+    while True:
+        title = handle.readline()
+        if not title:
+            raise StopIteration
+        if not title[0] == "@":
+            raise ValueError("Expected FASTQ @ line, got %r" % title)
+        seq = handle.readline()
+        plus = handle.readline()
+        if not plus[0] == "+":
+            raise ValueError("Expected FASTQ + line, got %r" % plus)
+        qual = handle.readline()
+        if len(seq) != len(qual): #both include newline
+            raise ValueError("Different FASTQ seq/qual lengths for %r" % title)
+        yield seq.strip().upper(), title+seq+"+\n"+qual
+
+def biopython_iterator(handle):
+    for title, seq, qual in FastqGeneralIterator(handle):
+        yield seq.upper(), "@%s\n%s\n+\n%s\n" % (title, seq, qual)
+
+def count_blocks(handle):
+    count = 0
+    for data, seqs, bounds in record_blocks(handle, "fastq", False, 10000):
+        count += len(seqs)
+    return count
+
+for name, parse in [("readline", lambda h: sum(1 for r in readline_iterator(h))),
+                    ("FastqGeneralIterator", lambda h: sum(1 for r in biopython_iterator(h))),
+                    ("fastq_iterator", lambda h: sum(1 for r in fastq_iterator(h))),
+                    ("record_blocks", count_blocks)]:
+    handle = open(filename)
+    t0 = time.time()
+    count = parse(handle)
+    taken = time.time() - t0
+    handle.close()
+    print("%-22s %8i reads/s (%i reads)" % (name, count / taken, count))
+
+if remove:
+    os.remove(filename)
@@ -0,0 +1,97 @@
+"""Compare read scanning by string slicing against the 2-bit k-mer codes.
+
+Uses a random reference and random reads (a tenth of which are sampled
+from the reference so there are some hits), and reports reads/second
+for the old approach (slice out every k-mer string, look it up in a
+set of strings), the per-read one (canonical integer k-mer codes from
+blooming_reads.kmer_codes, looked up in a set of integers), and the
+NumPy batch mode (blooming_reads.batch_filter, in batches of 10000).
+
+Run from this directory, optionally giving the k-mer size and read
+length, e.g.
+
+$ python bench_scan.py 35 100
+"""
+import os
+import sys
+import random
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from blooming_reads import encode_kmer, kmer_codes, np
+from Bio.Seq import reverse_complement
+
+kmer = 35
+read_len = 100
+if len(sys.argv) > 1:
+    kmer = int(sys.argv[1])
+if len(sys.argv) > 2:
+    read_len = int(sys.argv[2])
+ref_len = 100000
+read_count = 50000
+
+random.seed(kmer)
+ref = "".join(random.choice("ACGT") for i in range(ref_len))
+reads = []
+for i in range(read_count):
+    if i % 10:
+        reads.append("".join(random.choice("ACGT") for i in range(read_len)))
+    else:
+        start = random.randint(0, ref_len - read_len)
+        reads.append(ref[start:start + read_len])
+
+fragments = set(ref[i:i + kmer] for i in range(ref_len - kmer + 1))
+fragments.update([reverse_complement(f) for f in fragments])
+codes = set(encode_kmer(f) for f in fragments)
+
+def string_scan(reads):
+    """String slices against a set of strings (old)."""
+    kept = 0
+    for upper_seq in reads:
+        for i in range(0, len(upper_seq) - kmer + 1):
+            if upper_seq[i:i + kmer] in fragments:
+                kept += 1
+                break
+    return kept
+
+def string_scan_c(reads):
+    """String slices against a set of strings, lookups in C."""
+    kept = 0
+    for upper_seq in reads:
+        if not fragments.isdisjoint([upper_seq[i:i + kmer] for i in
+                                     range(0, len(upper_seq) - kmer + 1)]):
+            kept += 1
+    return kept
+
+def code_scan(reads):
+    """Canonical 2-bit codes against a set of integers, per read."""
+    kept = 0
+    for upper_seq in reads:
+        if not codes.isdisjoint(kmer_codes(upper_seq, kmer)):
+            kept += 1
+    return kept
+
+def batch_scan(reads):
+    """NumPy batch mode against a sorted array."""
+    from blooming_reads import batch_filter, batched
+    kept = 0
+    for chunk in batched(([upper_seq] for upper_seq in reads), 10000):
+        kept += batch_filter(chunk, kmer, table).sum()
+    return kept
+
+to_profile = [string_scan, string_scan_c, code_scan]
+if np is not None:
+    from blooming_reads import KmerTable
+    table = KmerTable.from_codes(codes, kmer)
+    to_profile.append(batch_scan)
+
+print "Using %i-mers, %i reads of length %i, reference length %i" \
+    % (kmer, read_count, read_len, ref_len)
+print "Set of %i strings vs %i canonical integer codes" \
+    % (len(fragments), len(codes))
+for p in to_profile:
+    start = time.time()
+    kept = p(reads)
+    taken = time.time() - start
+    print "%s - %0.2fs, %i reads/s, kept %i" \
+        % (p.__doc__, taken, read_count / taken, kept)
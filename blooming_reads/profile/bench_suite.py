@@ -0,0 +1,210 @@
+"""Reproducible benchmark of blooming_reads on simulated data.
+
+Generates synthetic references (two linear and one circular, with an
+ambiguous base, an IUPAC code, about every 500bp), and simulated read
+pairs with substitution errors at the given rate (plus an occasional
+single base indel). About a fifth of the pairs are sampled from the
+references (including fragments spanning the circular origin, and
+resolving any IUPAC code to one of its bases), the rest are random
+background. The pairs are written as interlaced FASTQ and as unmapped
+paired SAM, with the read names recording which are on-target.
+
+For each k-mer size and mismatch setting (plus sampling only window
+minimizers, with a window of 10 k-mers), blooming_reads.py is run once
+to build and save the index (reporting the build time, the peak memory
+of that process, and the index size), then for each input size and
+format loading that index and filtering the pairs. From the --stats
+summary of that run it reports the filtering reads/second and the peak
+memory, and from the kept read names the recall (on-target pairs kept)
+and precision (kept pairs which were on-target).
+
+Run from this directory, optionally giving comma separated lists of the
+number of pairs and k-mer sizes, and the error rate, plus any further
+options to pass on to blooming_reads.py when filtering (e.g. -t 4, or
+-b 0 for the per-read mode), e.g.
+
+$ python bench_suite.py 20000,200000 21,31 0.01 -t 2
+"""
+import os
+import sys
+import json
+import shutil
+import subprocess
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from blooming_reads import ambiguous_dna_values, np
+
+script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "blooming_reads.py")
+
+pair_counts = [20000, 200000]
+kmers = [21, 31]
+error_rate = 0.01
+extra = []
+if len(sys.argv) > 1:
+    pair_counts = [int(n) for n in sys.argv[1].split(",")]
+if len(sys.argv) > 2:
+    kmers = [int(k) for k in sys.argv[2].split(",")]
+if len(sys.argv) > 3:
+    error_rate = float(sys.argv[3])
+if len(sys.argv) > 4:
+    extra = sys.argv[4:]
+read_len = 100
+fragment_len = 300
+on_target = 0.2
+modes = [("Exact", ["-m", "0"]),
+         ("Variants", ["-m", "1"]),
+         ("Spaced seeds", ["-m", "1", "--spaced-seeds"]),
+         ("Minimizers 10", ["-m", "0", "--minimizers", "10"])]
+
+rng = np.random.RandomState(2013)
+acgt = np.frombuffer("ACGT", np.uint8)
+complement = np.arange(256, dtype=np.uint8)
+complement[acgt] = np.frombuffer("TGCA", np.uint8)
+
+def random_seq(length):
+    return acgt[rng.randint(0, 4, length)]
+
+def add_iupac(seq, spacing=500):
+    """Copy of the sequence with about one base per spacing replaced by an IUPAC code."""
+    ambiguous = seq.copy()
+    codes = [code for code in sorted(ambiguous_dna_values) if len(ambiguous_dna_values[code]) > 1]
+    for i in rng.randint(0, len(seq), len(seq) // spacing):
+        #Pick a code consistent with the base, so reads sampled from the
+        #base sequence still match
+        base = chr(seq[i])
+        ambiguous[i] = ord(rng.choice([code for code in codes if base in ambiguous_dna_values[code]]))
+    return ambiguous
+
+def mutate(reads):
+    """Add substitutions, and an indel to about one read in twenty (in place)."""
+    count, length = reads.shape
+    errors = rng.random_sample(reads.shape) < error_rate
+    #Adding 1 to 3 to the base's index gives a different base
+    index = np.searchsorted(acgt, reads[errors])
+    reads[errors] = acgt[(index + rng.randint(1, 4, len(index))) % 4]
+    for r in np.flatnonzero(rng.random_sample(count) < 0.05):
+        i = rng.randint(10, length - 10)
+        if rng.random_sample() < 0.5:
+            reads[r, i + 1:] = reads[r, i:-1].copy()
+            reads[r, i] = acgt[rng.randint(4)]
+        else:
+            reads[r, i:-1] = reads[r, i + 1:].copy()
+            reads[r, -1] = acgt[rng.randint(4)]
+
+def simulate_pairs(refs, count):
+    """Arrays of first and second reads, and a boolean array of on-target pairs."""
+    on = rng.random_sample(count) < on_target
+    fragments = np.empty((count, fragment_len), np.uint8)
+    fragments[~on] = random_seq((~on).sum() * fragment_len).reshape(-1, fragment_len)
+    which = rng.randint(0, len(refs), on.sum())
+    rows = np.flatnonzero(on)
+    for r, (seq, circular) in enumerate(refs):
+        chosen = rows[which == r]
+        if circular:
+            seq = np.concatenate((seq, seq[:fragment_len]))
+            starts = rng.randint(0, len(seq) - fragment_len, len(chosen))
+        else:
+            starts = rng.randint(0, len(seq) - fragment_len + 1, len(chosen))
+        fragments[chosen] = seq[starts[:, None] + np.arange(fragment_len)]
+    #Either strand, with the second read from the other end of the fragment
+    flip = rng.random_sample(count) < 0.5
+    fragments[flip] = complement[fragments[flip, ::-1]]
+    first = fragments[:, :read_len].copy()
+    second = complement[fragments[:, :-read_len - 1:-1]]
+    mutate(first)
+    mutate(second)
+    return first, second, on
+
+def write_reads(prefix, first, second, on):
+    """Write the pairs as FASTQ and SAM, returning the two filenames."""
+    names = ["%s%i" % ("on" if target else "off", i) for i, target in enumerate(on.tolist())]
+    qual = "I" * read_len
+    fastq = prefix + ".fastq"
+    sam = prefix + ".sam"
+    fastq_handle = open(fastq, "w")
+    sam_handle = open(sam, "w")
+    sam_handle.write("@HD\tVN:1.4\tSO:unsorted\n")
+    for name, seq1, seq2 in zip(names, first, second):
+        seq1 = seq1.tostring()
+        seq2 = seq2.tostring()
+        fastq_handle.write("@%s/1\n%s\n+\n%s\n@%s/2\n%s\n+\n%s\n"
+                           % (name, seq1, qual, name, seq2, qual))
+        sam_handle.write("%s\t77\t*\t0\t0\t*\t*\t0\t0\t%s\t%s\n%s\t141\t*\t0\t0\t*\t*\t0\t0\t%s\t%s\n"
+                         % (name, seq1, qual, name, seq2, qual))
+    fastq_handle.close()
+    sam_handle.close()
+    return fastq, sam
+
+def kept_names(filename, format):
+    """Set of the pair names in a blooming_reads output file."""
+    names = set()
+    handle = open(filename)
+    if format == "fastq":
+        for i, line in enumerate(handle):
+            if i % 4 == 0:
+                names.add(line[1:].rstrip().rsplit("/", 1)[0])
+    else:
+        for line in handle:
+            if line[0] != "@":
+                names.add(line[:line.index("\t")])
+    handle.close()
+    return names
+
+def run(args):
+    """Run blooming_reads.py, returning the wall time and peak memory in MB."""
+    t0 = time.time()
+    child = subprocess.Popen([sys.executable, script] + args, stderr=open(os.devnull, "w"))
+    pid, status, usage = os.wait4(child.pid, 0)
+    taken = time.time() - t0
+    if status:
+        sys.exit("Failed: blooming_reads.py %s" % " ".join(args))
+    #Linux reports this in kilobytes, Mac OS X in bytes
+    scale = 1024.0 * 1024.0 if sys.platform == "darwin" else 1024.0
+    return taken, usage.ru_maxrss / scale
+
+directory = tempfile.mkdtemp(prefix="bench-")
+refs = [(random_seq(60000), False), (random_seq(40000), False), (random_seq(16000), True)]
+ref_args = []
+for i, (seq, circular) in enumerate(refs):
+    filename = os.path.join(directory, "ref%i.fasta" % i)
+    handle = open(filename, "w")
+    handle.write(">ref%i\n%s\n" % (i, add_iupac(seq).tostring()))
+    handle.close()
+    ref_args.extend(["-c" if circular else "-l", filename])
+
+print("References %s, reads %ibp pairs from %ibp fragments, %0.0f%% on-target, error rate %r"
+      % (" + ".join("%i%s" % (len(seq), "bp circular" if circular else "bp")
+                    for seq, circular in refs),
+         read_len, fragment_len, 100 * on_target, error_rate))
+if extra:
+    print("Filtering with options: %s" % " ".join(extra))
+print("%8s %4s %-13s %9s %8s %8s %-6s %10s %8s %8s %9s"
+      % ("Pairs", "k", "Mode", "Build (s)", "MB", "Index MB", "Format",
+         "Reads/s", "MB", "Recall", "Precision"))
+read_sets = []
+for pair_count in pair_counts:
+    first, second, on = simulate_pairs(refs, pair_count)
+    fastq, sam = write_reads(os.path.join(directory, "reads%i" % pair_count), first, second, on)
+    read_sets.append((pair_count, on.sum(), fastq, sam))
+for kmer in kmers:
+    for name, mode_args in modes:
+        index = os.path.join(directory, "index")
+        build_time, build_memory = run(ref_args + ["-k", str(kmer), "--save-index", index] + mode_args)
+        index_size = os.path.getsize(index) / 1e6
+        for pair_count, wanted, fastq, sam in read_sets:
+            for format, filename in [("fastq", fastq), ("sam", sam)]:
+                output = os.path.join(directory, "kept." + format)
+                stats = os.path.join(directory, "stats.json")
+                taken, memory = run(["-f", format, "-i", filename, "-o", output,
+                                     "--load-index", index, "--stats", stats] + extra)
+                summary = json.loads(open(stats).readlines()[-1])
+                kept = kept_names(output, format)
+                correct = sum(1 for n in kept if n.startswith("on"))
+                print("%8i %4i %-13s %9.1f %8.1f %8.1f %-6s %10.0f %8.1f %7.2f%% %8.2f%%"
+                      % (pair_count, kmer, name, build_time, build_memory, index_size, format,
+                         summary["reads_per_s"], memory,
+                         100.0 * correct / max(1, wanted), 100.0 * correct / max(1, len(kept))))
+        os.remove(index)
+shutil.rmtree(directory)
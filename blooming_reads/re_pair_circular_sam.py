@@ -16,7 +16,23 @@ alignment end point would spill over).
 
 FASTQ file: Used to add missing unmapped reads, often left out
 in the SAM/BAM output of mapping tools. I want this to help
-with downstream analysis.
+with downstream analysis. Mates are looked up with a compact
+index saved next to the FASTQ file (as *.mates, see MateIndex),
+built the first time a mate is needed. Alternatively, if the
+FASTQ file is in the same read name order as the SAM file (e.g.
+straight from the mapper without sorting), --same-order reads
+through the FASTQ file alongside the SAM file instead, with no
+index at all.
+
+If the SAM file is not grouped by read name, use --unsorted to
+first split the reads into partitions by a hash of the read name,
+written to temporary files (see partition_lines). Each of these is
+then sorted by read name in memory and processed in turn (or in
+parallel with --threads). The output is then grouped by read name,
+but only sorted within each partition. Otherwise with --threads
+the SAM file is cut into chunks of reads (never splitting the lines
+for one read name), which are re-paired in parallel by worker
+processes, with the output written in the original order.
 
 Output:
 
@@ -25,6 +41,11 @@ via the FLAG field (the /1 and /2 are removed from the QNAME).
 Additionally unmapped partners are present (from the FASTQ file
 if not in the origin SAM file).
 
+Coverage file (optional): Five rows of coverage per reference (see
+count_coverage). By default this is a compact binary file (see
+write_coverage) which stack_coverage_plot.py can memory map, or
+with --coverage-format text as tab separated values.
+
 TODO:
 
 Rename reads, moving /1 and /2 suffix into FLAG.
@@ -46,36 +67,258 @@ end data, you might get two, three or even four lines in SAM
 
 import sys
 import os
+import mmap
+import hashlib
+import shutil
+import tempfile
+import itertools
+import multiprocessing
+from cStringIO import StringIO
 from optparse import OptionParser
 
-from Bio import SeqIO
-from Bio.SeqIO.QualityIO import _get_sanger_quality_str as qual_str
-
 def sys_exit(msg, error_level=1):
     """Print error message to stdout and quit with given error level."""
     sys.stderr.write("%s\n" % msg)
     sys.exit(error_level)
 
-VERSION = "0.0.0"
+try:
+    import numpy as np
+except ImportError:
+    #Only needed for the mate index, coverage and --unsorted
+    np = None
+
+from block_tools import ordered_results, partition_count, partition_lines
+
+VERSION = "0.0.3"
+
+MATE_INDEX_MAGIC = "re_pair_circular_sam mate index"
+MATE_INDEX_FORMAT = 1
+COVERAGE_MAGIC = "re_pair_circular_sam coverage"
+COVERAGE_FORMAT = 1
+
+
+def name_hash(name):
+    """64 bit hash of a read name (first 8 bytes of the MD5, little endian).
+
+    Unlike Python's hash function this is the same on every machine,
+    so it can be saved in an index file.
+    """
+    return hashlib.md5(name).digest()[:8]
+
+
+def fastq_record_at(data, offset):
+    """Read name, sequence and quality string of the FASTQ record at offset.
+
+    Takes a string or memory map of a FASTQ file (with the sequence and
+    quality each on one line, as from any Illumina pipeline).
+    """
+    end = data.find("\n", offset)
+    name = data[offset + 1:end].split(None, 1)[0]
+    start = end + 1
+    end = data.find("\n", start)
+    seq = data[start:end].rstrip("\r")
+    #Skip the plus line
+    start = data.find("\n", end + 1) + 1
+    end = data.find("\n", start)
+    if end == -1:
+        end = len(data)
+    return name, seq, data[start:end].rstrip("\r")
+
+
+def build_mate_index(fastq_filename, index_filename, chunk=1000000):
+    """Write a sorted table of read name hashes and file offsets for a FASTQ file.
+
+    This is a magic line including the format version, a line giving the
+    size and modification time of the FASTQ file and the number of reads,
+    then (starting at a 64 byte boundary) the sorted uint64 name hashes
+    (see name_hash) followed by the matching uint64 record offsets.
+
+    The file is written under a temporary name and then renamed.
+    """
+    stat = os.stat(fastq_filename)
+    handle = open(fastq_filename, "rb")
+    hashes = []
+    offsets = []
+    hash_chunks = []
+    offset_chunks = []
+    offset = 0
+    while True:
+        title = handle.readline()
+        if not title:
+            break
+        seq = handle.readline()
+        plus = handle.readline()
+        qual = handle.readline()
+        if title[0] != "@" or plus[:1] != "+":
+            sys_exit("%s does not look like four line FASTQ at byte %i" % (fastq_filename, offset))
+        hashes.append(name_hash(title[1:].split(None, 1)[0]))
+        offsets.append(offset)
+        offset += len(title) + len(seq) + len(plus) + len(qual)
+        if len(offsets) == chunk:
+            hash_chunks.append(np.frombuffer("".join(hashes), "<u8"))
+            offset_chunks.append(np.array(offsets, "<u8"))
+            hashes = []
+            offsets = []
+    handle.close()
+    hash_chunks.append(np.frombuffer("".join(hashes), "<u8"))
+    offset_chunks.append(np.array(offsets, "<u8"))
+    hashes = np.concatenate(hash_chunks)
+    offsets = np.concatenate(offset_chunks)
+    del hash_chunks, offset_chunks
+    order = np.argsort(hashes, kind="mergesort")
+    handle = open(index_filename + ".tmp", "wb")
+    handle.write("%s\t%i\n" % (MATE_INDEX_MAGIC, MATE_INDEX_FORMAT))
+    handle.write("%i\t%i\t%i\n" % (stat.st_size, stat.st_mtime, len(order)))
+    handle.write("\0" * (-handle.tell() % 64))
+    handle.write(hashes[order].tostring())
+    handle.write(offsets[order].tostring())
+    handle.close()
+    os.rename(index_filename + ".tmp", index_filename)
+    return len(order)
+
+
+class MateIndex(object):
+    """Look up FASTQ records by read name, via a memory mapped offset index.
+
+    The index (see build_mate_index) is kept next to the FASTQ file with
+    the suffix .mates, and is only loaded (or built, if missing or older
+    than the FASTQ file) when the first mate is looked up. Each look up
+    is then a binary search of the hashes, and a direct read of the
+    record from the memory mapped FASTQ file.
+    """
+
+    def __init__(self, fastq_filename):
+        self.filename = fastq_filename
+        self.index_filename = fastq_filename + ".mates"
+        self._data = None
+
+    def open(self):
+        """Load (or build) the index and memory map the FASTQ file, if not done already."""
+        if self._data is not None:
+            return
+        if np is None:
+            sys_exit("Missing 'numpy' module (needed for the FASTQ mate index, "
+                     "or try --same-order), available from http://numpy.org")
+        stat = os.stat(self.filename)
+        header = None
+        if os.path.isfile(self.index_filename):
+            handle = open(self.index_filename, "rb")
+            magic = handle.readline()
+            details = handle.readline()
+            start = handle.tell() + (-handle.tell() % 64)
+            handle.close()
+            if magic == "%s\t%i\n" % (MATE_INDEX_MAGIC, MATE_INDEX_FORMAT):
+                header = [int(v) for v in details.split("\t")]
+        if header and header[:2] == [stat.st_size, int(stat.st_mtime)]:
+            sys.stderr.write("Loading %s\n" % self.index_filename)
+            count = header[2]
+        else:
+            sys.stderr.write("Creating %s\n" % self.index_filename)
+            count = build_mate_index(self.filename, self.index_filename)
+            handle = open(self.index_filename, "rb")
+            handle.readline()
+            handle.readline()
+            start = handle.tell() + (-handle.tell() % 64)
+            handle.close()
+        sys.stderr.write("Have %i raw reads (used for unmapped partners)\n" % count)
+        if count and stat.st_size:
+            self._hashes = np.memmap(self.index_filename, "<u8", "r", start, (count,))
+            self._offsets = np.memmap(self.index_filename, "<u8", "r", start + 8 * count, (count,))
+            handle = open(self.filename, "rb")
+            self._data = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+            handle.close()
+        else:
+            #Can't memory map an empty file
+            self._hashes = self._offsets = np.zeros(0, "<u8")
+            self._data = ""
+
+    def __getitem__(self, name):
+        """Sequence and quality string of the named read."""
+        self.open()
+        key = np.frombuffer(name_hash(name), "<u8")[0]
+        i = int(np.searchsorted(self._hashes, key))
+        #Check the name, in case of a hash collision
+        while i < len(self._hashes) and self._hashes[i] == key:
+            found, seq, qual = fastq_record_at(self._data, int(self._offsets[i]))
+            if found == name:
+                return seq, qual
+            i += 1
+        sys_exit("Read %s not found in %s" % (name, self.filename))
+
+    def close(self):
+        if self._data:
+            self._data.close()
+        self._data = None
+
+
+class MateStream(object):
+    """Look up FASTQ records by read name, reading through the FASTQ file once.
+
+    For use when the FASTQ file is in the same read name order as the
+    SAM file, so each mate needed is found by reading forward (a merge
+    join), with no index and in constant memory.
+    """
 
-solo0 = solo1 = solo2 = solo12 = 0
+    def __init__(self, fastq_filename):
+        self.filename = fastq_filename
+        self._handle = None
 
+    def open(self):
+        """Open the FASTQ file, if not done already."""
+        if self._handle is None:
+            self._handle = open(self.filename)
 
-def go(input, output, raw_reads, linear_refs, circular_refs, coverage_file):
+    def __getitem__(self, name):
+        """Sequence and quality string of the named read."""
+        self.open()
+        handle = self._handle
+        while True:
+            title = handle.readline()
+            if not title:
+                sys_exit("Read %s not found in %s, is it in the same order as the SAM file?"
+                         % (name, self.filename))
+            seq = handle.readline()
+            handle.readline()
+            qual = handle.readline()
+            if title[1:].split(None, 1)[0] == name:
+                return seq.rstrip(), qual.rstrip()
+
+    def close(self):
+        if self._handle:
+            self._handle.close()
+        self._handle = None
+
+
+#Shared with the worker processes for --unsorted (inherited on forking)
+_worker_state = dict()
+
+
+def go(input, output, raw_reads, linear_refs, circular_refs, coverage_file,
+       same_order=False, unsorted=False, threads=1, memory=1000, temp_dir=None,
+       coverage_format="binary"):
+    """Re-pair the reads in the SAM file (see module docstring).
+
+    Any coverage is written in the given format, binary or text (see
+    write_coverage).
+
+    With unsorted, the input need not be grouped by read name, and is
+    split into partitions held in temporary files (in temp_dir, or the
+    system default) aiming to keep the memory used under the given
+    number of megabytes, processed with the given number of processes.
+    """
 
     if raw_reads:
         assert os.path.isfile(raw_reads)
-        idx = raw_reads + ".idx"
-        if os.path.isfile(idx):
-            sys.stderr.write("Loading %s\n" % idx)
-            raw = SeqIO.index_db(idx)
+        if same_order:
+            if unsorted or threads > 1:
+                sys_exit("Reading the raw reads in the same order needs a single "
+                         "thread, and the SAM file grouped by read name")
+            raw = MateStream(raw_reads)
         else:
-            sys.stderr.write("Creating %s\n" % idx)
-            raw= SeqIO.index_db(idx, raw_reads, "fastq")
+            raw = MateIndex(raw_reads)
     else:
-        raw = dict()
-    sys.stderr.write("Have %i raw reads (used for unmapped partners)\n" % len(raw))
-    
+        raw = None
+
     ref_len_linear = dict()
     if linear_refs:
         for f in linear_refs:
@@ -129,21 +372,94 @@ def go(input, output, raw_reads, linear_refs, circular_refs, coverage_file):
         output_handle.write(line)
         line = input_handle.readline()
 
-    global solo0, solo1, solo2,solo12
-    solo0 = solo1 = solo2 = solo12 = 0
+    #Counts of singletons, pairs with only /1 or /2 mapped, and both mapped
+    counts = [0, 0, 0, 0]
+    coverage = None
+    if coverage_file:
+        if np is None:
+            sys_exit("Missing 'numpy' module (needed for coverage), available from http://numpy.org")
+        coverage = CoverageCounter([(ref, length)
+                                    for lengths in [ref_len_linear, ref_len_circles]
+                                    for ref, length in lengths.iteritems()])
+
+    if unsorted or threads > 1:
+        if raw and threads > 1:
+            #Load (or build) the index now, rather than in every worker
+            raw.open()
+        _worker_state.update(raw=raw, ref_len_linear=ref_len_linear,
+                             ref_len_circles=ref_len_circles,
+                             coverage_lengths=coverage.lengths if coverage else None)
+    if unsorted:
+        if np is None:
+            sys_exit("Missing 'numpy' module (needed for --unsorted), available from http://numpy.org")
+        if isinstance(input, basestring):
+            size = os.path.getsize(input)
+        else:
+            size = None
+        directory = tempfile.mkdtemp(prefix="re_pair-", dir=temp_dir)
+        try:
+            #Sorting a partition as a list of lines takes more memory than
+            #the data itself, so allow four times its size
+            count = partition_count(size, threads, memory, 4.0)
+            filenames = partition_lines(input_handle, line, directory, count, memory,
+                                        read_name_spans)
+            if threads > 1:
+                pool = multiprocessing.Pool(threads)
+                results = pool.imap(re_pair_partition, filenames)
+            else:
+                results = (re_pair_partition(filename) for filename in filenames)
+            for filename, partition_counts, events in results:
+                handle = open(filename)
+                shutil.copyfileobj(handle, output_handle)
+                handle.close()
+                os.remove(filename)
+                counts = [a + b for a, b in zip(counts, partition_counts)]
+                if coverage:
+                    coverage.add_events(events)
+            if threads > 1:
+                pool.close()
+                pool.join()
+        finally:
+            shutil.rmtree(directory)
+    elif threads > 1 and line:
+        pool = multiprocessing.Pool(threads)
+        #Limit how many chunks are queued up, to bound the memory used,
+        #and write the results out in the order the chunks were queued
+        chunks = read_name_chunks(itertools.chain([line], input_handle))
+        for text, chunk_counts, events in ordered_results(pool, re_pair_chunk, chunks, 2 * threads):
+            output_handle.write(text)
+            counts = [a + b for a, b in zip(counts, chunk_counts)]
+            if coverage:
+                coverage.add_events(events)
+        pool.close()
+        pool.join()
+    elif line:
+        counts = re_pair_lines(itertools.chain([line], input_handle), output_handle, raw,
+                               ref_len_linear, ref_len_circles, coverage)
 
+    if raw:
+        raw.close()
+    if isinstance(input, basestring):
+        input_handle.close()
+    if isinstance(output, basestring):
+        output_handle.close()
 
-    global coverage
-    coverage = dict()
     if coverage_file:
-        import numpy
-        for lengths in [ref_len_linear, ref_len_circles]:
-            for ref, length in lengths.iteritems():
-                coverage[ref] = numpy.zeros((5, length), numpy.float)
+        write_coverage(coverage, coverage_file, coverage_format)
+    sys.stderr.write("%i singletons; %i where only /1 mapped, %i where only /2 mapped, %i where both mapped\n" % tuple(counts))
+
+
+def re_pair_lines(lines, output_handle, raw, ref_len_linear, ref_len_circles, coverage=None):
+    """Re-pair SAM read lines grouped by read name, writing them to the handle.
 
+    Returns a list of the counts of singletons, pairs with only /1 or
+    only /2 mapped, and with both mapped. If given, also updates the
+    coverage (a CoverageCounter).
+    """
+    counts = [0, 0, 0, 0]
     cur_read_name = None
     reads = set()
-    while line:
+    for line in lines:
         #SAM read
         qname, flag, rname, pos, rest = line.split("\t", 4)
         if " " in qname:
@@ -170,34 +486,114 @@ def go(input, output, raw_reads, linear_refs, circular_refs, coverage_file):
             #Using a set will eliminate duplicates after adjusting POS
             reads.add((qname, frag, rname, pos, flag, rest))
         else:
-            if coverage_file:
+            if coverage:
                 count_coverage(coverage, reads)
-            flush_cache(output_handle, reads, raw, ref_len_linear, ref_len_circles)
+            flush_cache(output_handle, reads, raw, ref_len_linear, ref_len_circles, counts)
             reads = set([(qname, frag, rname, pos, flag, rest)])
             cur_read_name = qname
-        #Next line...
-        line = input_handle.readline()
 
     if reads:
-        if coverage_file:
+        if coverage:
             count_coverage(coverage, reads)
-        flush_cache(output_handle, reads, raw, ref_len_linear, ref_len_circles)
+        flush_cache(output_handle, reads, raw, ref_len_linear, ref_len_circles, counts)
+    return counts
 
-    if isinstance(input, basestring):
-        input_handle.close()
-    if isinstance(output, basestring):
-        output_handle.close()
 
-    if coverage_file:
-        handle = open(coverage_file, "w")
-        for lengths in [ref_len_linear, ref_len_circles]:
-            for ref, length in lengths.iteritems():
-                handle.write(">%s length %i\n" % (ref, length))
-                for row in coverage[ref]:
-                    assert len(row) == length
-                    handle.write("\t".join("%.1f" % v for v in row) + "\n")
-        handle.close()
-    sys.stderr.write("%i singletons; %i where only /1 mapped, %i where only /2 mapped, %i where both mapped\n" % (solo0, solo1, solo2, solo12))
+def read_name_key(line):
+    """The read name of a SAM line, without any /1 or /2 suffix."""
+    qname = line[:line.index("\t")]
+    if " " in qname:
+        qname = qname.split(None, 1)[0]
+    if qname[-2:] in ("/1", "/2"):
+        qname = qname[:-2]
+    return qname
+
+
+def read_name_spans(data):
+    """Start and end of each line, and the end of its read name as in read_name_key.
+
+    Returns three integer arrays (the read names start with the lines).
+    The read name ends at the first tab or space, less any /1 or /2
+    suffix. Expects the data to end with a new line.
+    """
+    buf = np.frombuffer(data, np.uint8)
+    ends = np.flatnonzero(buf == 10) + 1
+    starts = np.zeros(len(ends), np.int64)
+    starts[1:] = ends[:-1]
+    #First tab or space at or after the start of each line, if any
+    breaks = np.flatnonzero((buf == 9) | (buf == 32))
+    name_ends = np.append(breaks, len(buf))[np.searchsorted(breaks, starts)]
+    bad = np.flatnonzero(name_ends >= ends)
+    if len(bad):
+        sys_exit("Expected tab separated fields in SAM line:\n%r"
+                 % data[starts[bad[0]]:ends[bad[0]]])
+    suffix = (name_ends - starts >= 2) & (buf[name_ends - 2] == ord("/")) \
+        & ((buf[name_ends - 1] == ord("1")) | (buf[name_ends - 1] == ord("2")))
+    name_ends[suffix] -= 2
+    return starts, ends, name_ends
+
+
+def read_name_chunks(lines, size=20000):
+    """Split SAM lines grouped by read name into lists of about size lines.
+
+    Each chunk is only ended where the read name changes (see
+    read_name_key), so all the lines for a read are in the same chunk.
+    """
+    chunk = []
+    for line in lines:
+        if len(chunk) >= size and read_name_key(line) != read_name_key(chunk[-1]):
+            yield chunk
+            chunk = []
+        chunk.append(line)
+    if chunk:
+        yield chunk
+
+
+def _worker_re_pair(lines, output_handle):
+    """Re-pair the lines with the settings in _worker_state.
+
+    Returns the counts (see re_pair_lines), and the coverage as an
+    array of events (see CoverageCounter), or None if not wanted.
+    """
+    if _worker_state["coverage_lengths"] is not None:
+        #No need to flush, as the events are passed back
+        coverage = CoverageCounter(_worker_state["coverage_lengths"], batch=None)
+    else:
+        coverage = None
+    counts = re_pair_lines(lines, output_handle, _worker_state["raw"],
+                           _worker_state["ref_len_linear"], _worker_state["ref_len_circles"],
+                           coverage)
+    return counts, coverage.events() if coverage else None
+
+
+def re_pair_chunk(lines):
+    """Re-pair a chunk of SAM lines (see read_name_chunks) in a worker process.
+
+    Returns the output as a string, plus the counts and coverage events
+    (see _worker_re_pair).
+    """
+    handle = StringIO()
+    counts, events = _worker_re_pair(lines, handle)
+    return handle.getvalue(), counts, events
+
+
+def re_pair_partition(filename):
+    """Sort a partition file by read name then re-pair the reads.
+
+    The partition file (from partition_lines) is removed, and the output
+    written to a new file. Returns its filename, plus the counts and
+    coverage events (see _worker_re_pair).
+    """
+    handle = open(filename)
+    lines = handle.readlines()
+    handle.close()
+    os.remove(filename)
+    #Stable sort, so lines with the same read name keep their order
+    lines.sort(key=read_name_key)
+    handle = open(filename + ".re_pair", "w")
+    counts, events = _worker_re_pair(lines, handle)
+    handle.close()
+    return filename + ".re_pair", counts, events
 
 
 def cigar_tuples(cigar_str):
@@ -223,65 +619,240 @@ def cigar_tuples(cigar_str):
     return answer
 
 
+_cigar_lengths = dict()
+
 def cigar_alen(cigar_str):
+    """Length of reference covered by an alignment, from the CIGAR string.
+
+    Results are cached, as most reads share a handful of CIGAR strings.
+    """
+    try:
+        return _cigar_lengths[cigar_str]
+    except KeyError:
+        pass
     alen = 0
     for operator, count in cigar_tuples(cigar_str):
         if operator in "MDN=X":
             alen += count
+    if len(_cigar_lengths) > 100000:
+        _cigar_lengths.clear()
+    _cigar_lengths[cigar_str] = alen
     return alen
 
 
+class CoverageCounter(object):
+    """Coverage of each reference, in five fields, from weighted alignments.
+
+    Rather than adding the weight to every base covered, each alignment
+    is recorded as an event (which reference and field, start, end and
+    weight). These are buffered, and every batch events are added to a
+    difference array (plus the weight at the start, minus it at the end,
+    with any alignment past the origin split in two). The coverage is
+    then the cumulative sum, taken once per reference at the end.
+
+    The lengths are a list of (reference name, length) tuples. With a
+    batch of None, events are only added to the difference array when
+    the coverage is needed (or they can be taken by the events method
+    instead, e.g. to pass back from a worker process).
+
+    An alignment can start past the origin (e.g. mapped to the second
+    half of a doubled reference), and can wrap round more than once:
+
+    >>> coverage = CoverageCounter([("c", 4)])
+    >>> coverage.add("c", 0, [(2, 11)], 1.0)
+    >>> coverage.add("c", 2, [(6, 8)], 0.5)
+    >>> coverage["c"][0].tolist()
+    [2.0, 2.0, 3.0, 2.0]
+    >>> coverage["c"][2].tolist()
+    [0.0, 0.0, 0.5, 0.5]
+    """
+
+    fields = 5
+
+    def __init__(self, lengths, batch=100000):
+        self.lengths = list(lengths)
+        self.batch = batch
+        self._rows = dict()
+        total = 0
+        for ref, length in self.lengths:
+            #Extra column, for events ending at the origin
+            self._rows[ref] = (total, length)
+            total += self.fields * (length + 1)
+        self._diff = np.zeros(total, np.float64)
+        self._events = []
+        #Arrays of events (see add_events), and their total length
+        self._arrays = []
+        self._buffered = 0
+
+    def add(self, ref, field, alignments, weight):
+        """Add weight to the coverage of each alignment on the reference.
+
+        The alignments are a list of (start, end) tuples, zero based with
+        the end exclusive (and may extend past the origin).
+        """
+        try:
+            offset, length = self._rows[ref]
+        except KeyError:
+            #Not a reference we were given
+            return
+        row = offset + field * (length + 1)
+        events = self._events
+        for start, end in alignments:
+            events.append((row, length, start, end, weight))
+        if self.batch and len(events) + self._buffered >= self.batch:
+            self.flush()
+
+    def events(self):
+        """Array of the buffered events (one per row), removing them from the buffer."""
+        events = np.concatenate([np.array(self._events, np.float64).reshape(-1, 5)] + self._arrays)
+        self._events = []
+        self._arrays = []
+        self._buffered = 0
+        return events
+
+    def add_events(self, events):
+        """Add an array of events, as from the events method of another counter.
+
+        This must be for the same list of reference lengths.
+        """
+        self._arrays.append(events)
+        self._buffered += len(events)
+        if self.batch and len(self._events) + self._buffered >= self.batch:
+            self.flush()
+
+    def flush(self):
+        """Add the buffered events to the difference array."""
+        if not self._events and not self._arrays:
+            return
+        events = self.events()
+        rows = events[:, 0].astype(np.int64)
+        lengths = events[:, 1].astype(np.int64)
+        starts = events[:, 2].astype(np.int64)
+        ends = events[:, 3].astype(np.int64)
+        weights = events[:, 4]
+        #Start within the reference, keeping the alignment length
+        ends -= starts - starts % lengths
+        starts %= lengths
+        pieces = []
+        while len(rows):
+            #Anything past the origin carries on from base zero
+            wrap = ends > lengths
+            pieces.append((rows, starts, np.minimum(ends, lengths), weights))
+            rows = rows[wrap]
+            lengths = lengths[wrap]
+            starts = np.zeros(len(rows), np.int64)
+            ends = ends[wrap] - lengths
+            weights = weights[wrap]
+        index = np.concatenate([rows + starts for rows, starts, ends, weights in pieces]
+                               + [rows + ends for rows, starts, ends, weights in pieces])
+        values = np.concatenate([weights for rows, starts, ends, weights in pieces]
+                                + [-weights for rows, starts, ends, weights in pieces])
+        index, inverse = np.unique(index, return_inverse=True)
+        self._diff[index] += np.bincount(inverse, values)
+
+    def __getitem__(self, ref):
+        """Array of coverage for the named reference (dimensions field, base)."""
+        self.flush()
+        offset, length = self._rows[ref]
+        diff = self._diff[offset:offset + self.fields * (length + 1)].reshape(self.fields, length + 1)
+        values = np.cumsum(diff, axis=1)[:, :length]
+        #Rounding errors can leave tiny values (which could show as -0.0)
+        values[np.abs(values) < 1e-9] = 0.0
+        return values
+
+
+def write_coverage(coverage, filename, format="binary"):
+    """Write the coverage (a CoverageCounter) to a file, as binary or text.
+
+    The binary format is a header of text lines, the COVERAGE_MAGIC and
+    COVERAGE_FORMAT, the number of fields (rows) and references, then
+    each reference name and length. This is padded with nulls to a
+    multiple of 64 bytes, followed by the coverage of each reference in
+    turn as little endian float32 values (one row per field), so it can
+    be memory mapped.
+
+    The text format has a >name line per reference, then a line of tab
+    separated values (to one decimal place) for each field.
+    """
+    if format == "text":
+        handle = open(filename, "w")
+        for ref, length in coverage.lengths:
+            handle.write(">%s length %i\n" % (ref, length))
+            for row in coverage[ref]:
+                assert len(row) == length
+                handle.write("\t".join("%.1f" % v for v in row) + "\n")
+        handle.close()
+        return
+    assert format == "binary", format
+    handle = open(filename, "wb")
+    handle.write("%s\t%i\n" % (COVERAGE_MAGIC, COVERAGE_FORMAT))
+    handle.write("%i\t%i\n" % (coverage.fields, len(coverage.lengths)))
+    for ref, length in coverage.lengths:
+        handle.write("%s\t%i\n" % (ref, length))
+    handle.write("\0" * (-handle.tell() % 64))
+    for ref, length in coverage.lengths:
+        handle.write(coverage[ref].astype("<f4").tostring())
+    handle.close()
+
+
 def count_coverage(coverage, reads):
-    """Update coverage (dict of arrays) using given mapping of a read/pair."""
-    reads1 = [(int(flag), rname, int(pos)-1, rest.split("\t",2)[1]) \
-              for (qname, frag, rname, pos, flag, rest) \
-              in reads if frag==1]
-    reads2 = [(int(flag), rname, int(pos)-1, rest.split("\t",2)[1]) \
-              for (qname, frag, rname, pos, flag, rest) \
-              in reads if frag==2]
-    reads0 = [(int(flag), rname, int(pos)-1, rest.split("\t",2)[1]) \
-              for (qname, frag, rname, pos, flag, rest) \
-              in reads if frag==0]
-    if reads0:
+    """Update coverage (a CoverageCounter) using given mapping of a read/pair.
+
+    The reads are tuples of the QNAME, fragment (0 for a singleton, 1 or
+    2 for part of a pair), RNAME, POS, FLAG and the rest of the SAM line.
+    Each alignment's weight is one over the number of alignments for that
+    fragment, added to one of five coverage fields: singletons all on
+    this reference (0) or also on others (1), pairs with both parts all
+    on this reference (2) or also on others (3), and pairs with only one
+    part on this reference (4). For example, a singleton on two references:
+
+    >>> coverage = CoverageCounter([("c", 4), ("l", 6)])
+    >>> count_coverage(coverage, [("r1", 0, "c", "3", "0", "30\\t4M\\t*\\t0\\t0\\tACGT\\tIIII"),
+    ...                           ("r1", 0, "l", "2", "256", "30\\t3M\\t*\\t0\\t0\\tACG\\tIII")])
+    >>> coverage["c"][1].tolist()
+    [0.5, 0.5, 0.5, 0.5]
+    >>> coverage["l"][1].tolist()
+    [0.0, 0.5, 0.5, 0.5, 0.0, 0.0]
+    """
+    #Number of lines for singletons, /1 and /2 reads, and for each
+    #reference the mapped alignments of each
+    counts = [0, 0, 0]
+    mapped = dict()
+    for qname, frag, rname, pos, flag, rest in reads:
+        counts[frag] += 1
+        if int(flag) & 0x4:
+            continue
+        start = int(pos) - 1
+        end = start + cigar_alen(rest.split("\t", 2)[1])
+        try:
+            mapped[rname][frag].append((start, end))
+        except KeyError:
+            mapped[rname] = ([], [], [])
+            mapped[rname][frag].append((start, end))
+    if counts[0]:
         #Singleton
-        assert not reads1 and not reads2
-        field = 0
-        for ref, length in coverage.iteritems():
-            length = values.shape[1]
-            r0 = [(pos, pos+cigar_alen(cigar)) for (flag, rname, pos, cigar) in reads0 if ref==rname and not (flag & 0x4)]
-            if len(r0) == len(reads0):
+        assert not counts[1] and not counts[2]
+    for ref, (r0, r1, r2) in mapped.iteritems():
+        if counts[0]:
+            if len(r0) == counts[0]:
                 #All on this ref
                 field = 0
             else:
                 #Also on other refs
                 field = 1
-            weight = 1.0 / len(reads0)
-            for start, end in r0:
-                for i in xrange(start, end):
-                    values[field, i % length] += weight
-    else:
-        #Paired
-        assert not reads0
-        for ref, values in coverage.iteritems():
-            length = values.shape[1]
-            r1 = [(pos, pos+cigar_alen(cigar)) for (flag, rname, pos, cigar) in reads1 if ref==rname and not (flag & 0x4)]
-            r2 = [(pos, pos+cigar_alen(cigar)) for (flag, rname, pos, cigar) in reads2 if ref==rname and not (flag & 0x4)]
-            if r1 and r2:
-                #Both read parts /1 and /2 map to same ref, good
-                if len(r1) == len(reads1) and len(r2) == len(reads2):
-                    #All on this ref
-                    field = 2
-                else:
-                    field = 3
+        elif r1 and r2:
+            #Both read parts /1 and /2 map to same ref, good
+            if len(r1) == counts[1] and len(r2) == counts[2]:
+                #All on this ref
+                field = 2
             else:
-                #Only one of parts maps to this ref, bad
-                field = 4
-            for reads, all_reads in [(r1, reads1), (r2, reads2)]:
-                if reads:
-                    weight = 1.0 / len(all_reads)
-                    for start, end in reads:
-                        for i in xrange(start, end):
-                            values[field, i % length] += weight
+                field = 3
+        else:
+            #Only one of parts maps to this ref, bad
+            field = 4
+        for alignments, count in [(r0, counts[0]), (r1, counts[1]), (r2, counts[2])]:
+            if alignments:
+                coverage.add(ref, field, alignments, 1.0 / count)
 
 
 def fixup_pairs(reads1, reads2, ref_len_linear, ref_len_circles):
@@ -357,8 +928,18 @@ def make_mapped_pair(read1, read2, template_len=0, happy=False):
     read2 = mark_mate(read2, read1, template_len, happy)
     return read1, read2
 
-def flush_cache(handle, set_of_read_tuples, raw_dict, ref_len_linear, ref_len_circles):
-    global solo0, solo1, solo2, solo12
+def mate_reads(raw_dict, name):
+    """Sequence and quality string of an unmapped mate, from the FASTQ file."""
+    if raw_dict is None:
+        sys_exit("Mate %s is not in the SAM file, and no FASTQ file was given" % name)
+    return raw_dict[name]
+
+def flush_cache(handle, set_of_read_tuples, raw_dict, ref_len_linear, ref_len_circles, counts):
+    """Write out the lines for a read or pair, adding any unmapped mate.
+
+    Adds one to the matching entry of counts (a list of the number of
+    singletons, pairs with only /1 or only /2 mapped, and both mapped).
+    """
     reads = sorted(set_of_read_tuples)
     if not reads:
         return
@@ -382,35 +963,35 @@ def flush_cache(handle, set_of_read_tuples, raw_dict, ref_len_linear, ref_len_ci
     if reads0:
         assert not reads1 and not reads2, reads
         #All singletons
-        solo0 += 1
+        counts[0] += 1
     else:
         assert not reads0, reads
         assert reads1 or reads2, reads
         #Pairs
         if not reads1:
-            solo2 += 1
+            counts[2] += 1
             #0x8 = partner unmapped
             reads2 = [(qname, flag | 0x8, rname, pos, rest) \
                       for (qname, flag, rname, pos, rest) in reads2]
             #Assume first read2 is best one
-            qname, rname, pos, flag, rest = reads2[0]
+            qname, flag, rname, pos, rest = reads2[0]
             flag = 0x1 + 0x4 + 0x40 #Paired, this is unmapped, first in pair
-            rec = raw_dict[qname + "/1"]
-            rest = "255\t*\t%s\t%s\t0\t%s\t%s\n" % (rname, pos, rec.seq, qual_str(rec))
+            seq, qual = mate_reads(raw_dict, qname + "/1")
+            rest = "255\t*\t%s\t%s\t0\t%s\t%s\n" % (rname, pos, seq, qual)
             reads1 = [(qname, flag, "*", "0", rest)]
         elif not reads2:
-            solo1 += 1
+            counts[1] += 1
             #0x8 = partner unmapped
             reads1 = [(qname, flag | 0x8, rname, pos, rest) \
                       for (qname, flag, rname, pos, rest) in reads1]
             #Assume first read1 is best one:
-            qname, rname, pos, flag, rest = reads1[0]
+            qname, flag, rname, pos, rest = reads1[0]
             flag = 0x1 + 0x4 + 0x80 #Paired, this is unmapped, second in pair
-            rec = raw_dict[qname + "/2"]
-            rest = "255\t*\t%s\t%s\t0\t%s\t%s\n" % (rname, pos, rec.seq, qual_str(rec))
+            seq, qual = mate_reads(raw_dict, qname + "/2")
+            rest = "255\t*\t%s\t%s\t0\t%s\t%s\n" % (rname, pos, seq, qual)
             reads2 = [(qname, flag, "*", "0", rest)]
         else:
-            solo12 += 1
+            counts[3] += 1
             reads1, reads2 = fixup_pairs(reads1, reads2, ref_len_linear, ref_len_circles)
 
     for qname, flag, rname, pos, rest in reads0+reads1+reads2:
@@ -448,7 +1029,13 @@ def main():
                            Several files can be given if required.""")
     parser.add_option("-v", "--coverage", dest="coverage_file",
                       type="string", metavar="FILE",
-                      help="Option file to record coverage to (JSON)."),
+                      help="Optional file to record coverage to (see --coverage-format).")
+    parser.add_option("--coverage-format", dest="coverage_format",
+                      type="choice", choices=["binary", "text"],
+                      default="binary", metavar="FORMAT",
+                      help="Format of the coverage file, 'binary' (def., compact and "
+                           "memory mapped by stack_coverage_plot.py) or 'text' "
+                           "(tab separated values)")
     #Reads
     parser.add_option("-i", "--input", dest="input_reads",
                       type="string", metavar="FILE",
@@ -456,9 +1043,29 @@ def main():
     parser.add_option("-r", "--reads", dest="raw_reads",
                       type="string", metavar="FILE",
                       help="Input file of FASTQ format unmapped reads (for finding unmapped partners)")
+    parser.add_option("--same-order", dest="same_order",
+                      action="store_true", default=False,
+                      help="""The FASTQ file is in the same read name order as the
+                           SAM file, so read through it alongside the SAM file
+                           rather than using an index to look up mates.""")
     parser.add_option("-o","--output", dest="output_reads",
                       type="string", metavar="FILE",
                       help="Output file for processed SAM format mapping (def. stdout)")
+    parser.add_option("--unsorted", dest="unsorted",
+                      action="store_true", default=False,
+                      help="""Input is not grouped by read name, so split it into
+                           partitions by read name in temporary files first
+                           (rather than needing 'samtools sort -n').""")
+    parser.add_option("-t", "--threads", dest="threads",
+                      type="int", metavar="N", default=1,
+                      help="Number of worker processes for re-pairing chunks of reads "
+                           "(or the partitions with --unsorted) (def. 1, no workers)")
+    parser.add_option("--memory", dest="memory",
+                      type="int", metavar="MB", default=1000,
+                      help="Memory to aim to use with --unsorted, in megabytes (def. 1000)")
+    parser.add_option("--temp", dest="temp_dir",
+                      type="string", metavar="DIR",
+                      help="Directory for the temporary files with --unsorted (def. system default)")
     
     (options, args) = parser.parse_args()
 
@@ -472,10 +1079,24 @@ def main():
     if args:
         parser.error("No arguments expected")
 
+    if options.same_order and options.unsorted:
+        parser.error("Options --same-order and --unsorted are incompatible")
+
+    if options.same_order and options.threads > 1:
+        parser.error("Option --same-order needs a single thread")
+
+    if options.threads < 1:
+        parser.error("Need at least one thread")
+
+    if options.memory < 1:
+        parser.error("Need at least one megabyte of memory")
+
     paired = True
     go(options.input_reads, options.output_reads, options.raw_reads,
        options.linear_references, options.circular_references,
-       options.coverage_file)
+       options.coverage_file, options.same_order,
+       options.unsorted, options.threads, options.memory, options.temp_dir,
+       options.coverage_format)
 
 if __name__ == "__main__":
     main()
@@ -2,9 +2,36 @@ import sys
 import numpy as np
 from matplotlib import pyplot as plt
 
+COVERAGE_MAGIC = "re_pair_circular_sam coverage"
+COVERAGE_FORMAT = 1
+
 def load(filename):
-    h = open(filename)
+    """Yield the name and coverage array of each reference in the file.
+
+    Binary files from re_pair_circular_sam.py are memory mapped (read
+    only), while text files are parsed.
+    """
+    h = open(filename, "rb")
     line = h.readline()
+    if line.startswith(COVERAGE_MAGIC + "\t"):
+        if line != "%s\t%i\n" % (COVERAGE_MAGIC, COVERAGE_FORMAT):
+            raise ValueError("Unsupported coverage file format: %r" % line)
+        fields, count = [int(v) for v in h.readline().split("\t")]
+        refs = [h.readline().rstrip("\n").split("\t") for i in range(count)]
+        offset = h.tell() + (-h.tell() % 64)
+        h.close()
+        total = sum(fields * int(length) for name, length in refs)
+        if total:
+            data = np.memmap(filename, "<f4", "r", offset, (total,))
+        else:
+            #Can't memory map nothing
+            data = np.zeros(0, "<f4")
+        start = 0
+        for name, length in refs:
+            length = int(length)
+            yield name, data[start:start + fields * length].reshape(fields, length)
+            start += fields * length
+        return
     assert line.startswith(">")
     while line and line[0] == ">":
         name = line[1:].split(None,1)[0]